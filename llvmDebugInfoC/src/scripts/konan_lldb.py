@@ -21,12 +21,51 @@
 # (lldb) p kotlin_variable
 #
 
+import argparse
+import array
+import atexit
+import bisect
+import collections
+import contextlib
+import json
 import lldb
+import os
 import struct
 import re
+import shlex
 import sys
+import time
 
 NULL = 'null'
+LLDB_INVALID_ADDRESS = 0xffffffffffffffff
+
+# Keep in sync with Konan_RuntimeType in runtime/src/main/cpp/TypeInfo.h.
+RT_INVALID = 0
+RT_OBJECT = 1
+RT_INT8 = 2
+RT_INT16 = 3
+RT_INT32 = 4
+RT_INT64 = 5
+RT_FLOAT32 = 6
+RT_FLOAT64 = 7
+RT_NATIVE_PTR = 8
+RT_BOOLEAN = 9
+RT_VECTOR128 = 10
+
+# Keep in sync with runtimeTypeSize and runtimeTypeAlignment in runtime/src/debug/cpp/KDebug.cpp, None stands
+# for the pointer size.
+RUNTIME_TYPE_SIZE = [-1, None, 1, 2, 4, 8, 4, 8, None, 1, 16]
+RUNTIME_TYPE_ALIGNMENT = [-1, None, 1, 2, 4, 8, 4, 8, None, 1, 16]
+# Formats of the `array` module to decode array elements of the given runtime type with, None for the pointer format.
+RUNTIME_TYPE_ARRAY_FORMAT = [None, None, 'b', 'h', 'i', 'q', 'f', 'd', None, 'B', None]
+
+# Keep in sync with OBJECT_TAG_MASK in runtime/src/main/cpp/Memory.h.
+OBJECT_TAG_MASK = 0x3
+# Sanity limits for decoding TypeInfo straight from memory, anything above is treated as garbage.
+MAX_FIELDS_COUNT = 0x10000
+FIELD_NAME_LIMIT = 0x1000
+FIELD_NAMES_CHUNK_LIMIT = 0x10000
+FIELD_NAMES_CHUNK_TAIL = 0x100
 
 def log(msg):
     if False:
@@ -44,61 +83,943 @@ def lldb_val_to_ptr(lldb_val):
     return '((struct ObjHeader *) {:#x})'.format(addr)
 
 
+class StatisticsScope:
+    """Attributes round trips made inside of it to the provider and the Kotlin type being worked on."""
+    def __init__(self, statistics, kind, provider, type):
+        self._statistics = statistics
+        self.kind = kind
+        self.provider = provider
+        self.type = type
+
+    def __enter__(self):
+        self._statistics._scopes.append(self)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self._statistics.record(self.kind, self._start)
+        self._statistics._scopes.pop()
+
+
+class Statistics:
+    """Number and wall time of expression evaluations, memory reads, summaries and synthetic children requests
+    per provider and per type, plus hit and miss counters of the caches, see `konan_stats` command.
+    When tracing, every recorded operation is kept as an event for a Chrome trace file (chrome://tracing).
+    Off unless KONAN_LLDB_STATS=1 or `konan_stats --enable`, measuring costs formatters an extra symbol lookup
+    per type and a wrapper around every synthetic children call."""
+    MAX_TRACE_EVENTS = 1000000
+
+    def __init__(self):
+        self.enabled = os.getenv('KONAN_LLDB_STATS', '0') == '1'
+        self.tracing = False
+        self._scopes = [StatisticsScope(self, None, '-', '-')]
+        self.reset()
+
+    def reset(self):
+        # (kind, provider, type) -> [count, seconds]
+        self.timings = collections.defaultdict(lambda: [0, 0.0])
+        self.counters = collections.Counter()
+        self.events = []
+        self._origin = time.perf_counter()
+
+    def scope(self, kind, provider, type):
+        return StatisticsScope(self, kind, provider, type)
+
+    def record(self, kind, start, details = None):
+        if not self.enabled:
+            return
+        end = time.perf_counter()
+        scope = self._scopes[-1]
+        timing = self.timings[(kind, scope.provider, scope.type)]
+        timing[0] += 1
+        timing[1] += end - start
+        if self.tracing and len(self.events) < Statistics.MAX_TRACE_EVENTS:
+            self.events.append((kind, scope.provider, scope.type, start - self._origin, end - start, details))
+
+    def count(self, name):
+        if self.enabled:
+            self.counters[name] += 1
+
+    def hit_rate(self, name):
+        hits = self.counters[name + '.hit']
+        misses = self.counters[name + '.miss']
+        return (hits, misses, 100.0 * hits / (hits + misses) if hits + misses else 0.0)
+
+    def dump_trace(self, path):
+        events = [{
+            'name': kind if details is None else '{} {}'.format(kind, details),
+            'cat': kind,
+            'ph': 'X',
+            'ts': int(start * 1e6),
+            'dur': int(duration * 1e6),
+            'pid': os.getpid(),
+            'tid': 0,
+            'args': {'provider': provider, 'type': type}
+        } for (kind, provider, type, start, duration, details) in self.events]
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': events, 'otherData': dict(self.counters)}, file)
+        return len(events)
+
+
+STATISTICS = Statistics()
+
+
 def evaluate(expr):
+    start = time.perf_counter()
     result = lldb.debugger.GetSelectedTarget().EvaluateExpression(expr, lldb.SBExpressionOptions())
+    STATISTICS.record('evaluate', start, expr)
     evallog = lambda : "{} => {}".format(expr, result)
     log(evallog)
     exelog(evallog)
     return result
 
+class TargetMemory:
+    """Reads raw memory of the inferior and decodes it with the target's pointer size and byte order."""
+    def __init__(self, target = None):
+        self._target = target if target is not None else lldb.debugger.GetSelectedTarget()
+        self._process = self._target.GetProcess()
+        self.pointer_size = self._target.GetAddressByteSize()
+        self.byte_order = self._target.GetByteOrder()
+        self.endian = '>' if self.byte_order == lldb.eByteOrderBig else '<'
+        self.pointer_format = 'Q' if self.pointer_size == 8 else 'I'
+
+    def read(self, address, size):
+        if not address or size < 0:
+            return None
+        if size == 0:
+            return b''
+        error = lldb.SBError()
+        start = time.perf_counter()
+        data = self._process.ReadMemory(address, size, error)
+        STATISTICS.record('memory_read', start)
+        if not error.Success() or data is None or len(data) != size:
+            log(lambda: "TargetMemory.read: failed {:#x}[{}]".format(address, size))
+            return None
+        return data
+
+    def unpack(self, format, data, offset = 0):
+        return struct.unpack_from(self.endian + format, data, offset)
+
+    def read_pointers(self, address, count):
+        data = self.read(address, count * self.pointer_size)
+        return None if data is None else self.unpack('{}{}'.format(count, self.pointer_format), data)
+
+    def read_pointer(self, address):
+        if not address:
+            return None
+        error = lldb.SBError()
+        start = time.perf_counter()
+        pointer = self._process.ReadPointerFromMemory(address, error)
+        STATISTICS.record('memory_read', start)
+        return pointer if error.Success() else None
+
+    def read_array(self, address, runtime_type, count):
+        """Reads `count` elements of the given runtime type with a single memory read,
+        returns (raw bytes, decoded array.array) or None."""
+        format = RUNTIME_TYPE_ARRAY_FORMAT[runtime_type] if 0 <= runtime_type < len(RUNTIME_TYPE_ARRAY_FORMAT) else None
+        if format is None and runtime_type in (RT_OBJECT, RT_NATIVE_PTR):
+            format = self.pointer_format
+        if format is None:
+            return None
+        values = array.array(format)
+        data = self.read(address, count * values.itemsize)
+        if data is None:
+            return None
+        values.frombytes(data)
+        if (self.endian == '<') != (sys.byteorder == 'little'):
+            values.byteswap()
+        return (data, values)
+
+    def type_size(self, runtime_type):
+        size = RUNTIME_TYPE_SIZE[runtime_type]
+        return self.pointer_size if size is None else size
+
+    def type_alignment(self, runtime_type):
+        alignment = RUNTIME_TYPE_ALIGNMENT[runtime_type]
+        return self.pointer_size if alignment is None else alignment
+
+    def read_c_string(self, address, limit = FIELD_NAME_LIMIT):
+        error = lldb.SBError()
+        start = time.perf_counter()
+        string = self._process.ReadCStringFromMemory(address, limit, error)
+        STATISTICS.record('memory_read', start)
+        return string if error.Success() else None
+
+    def read_c_strings(self, addresses, limit = FIELD_NAME_LIMIT):
+        """Reads C strings, which are usually allocated close to each other, with a single memory read."""
+        if not addresses:
+            return []
+        if not all(addresses):
+            return None
+        start = min(addresses)
+        size = max(addresses) - start + FIELD_NAMES_CHUNK_TAIL
+        chunk = self.read(start, size) if size <= FIELD_NAMES_CHUNK_LIMIT else None
+        result = []
+        for address in addresses:
+            end = -1 if chunk is None else chunk.find(b'\0', address - start)
+            if end >= 0:
+                result.append(chunk[address - start:end].decode('utf-8', 'replace'))
+                continue
+            string = self.read_c_string(address, limit)
+            if string is None:
+                return None
+            result.append(string)
+        return result
+
+
+class SymbolIndex:
+    """Symbols of a module, indexed with one pass over its symbol table: a hash map from name to address and
+    a sorted array of addresses for bisection. Addresses are kept as file addresses, so the index stays valid
+    for the module UUID regardless of where the module is loaded, and are slid on lookup."""
+    def __init__(self, module):
+        self._by_name = {}
+        entries = []
+        for symbol in module.symbols:
+            name = symbol.name
+            if not name:
+                continue
+            address = symbol.GetStartAddress().GetFileAddress()
+            if name not in self._by_name:
+                self._by_name[name] = address
+            entries.append((address, name))
+        entries.sort()
+        self._addresses = [address for (address, _) in entries]
+        self._names = [name for (_, name) in entries]
+        self._slide = 0
+        self._process_id = None
+        # Top level properties, see _kotlin_globals.
+        self.globals = None
+        log(lambda: "SymbolIndex: {} symbols of {}".format(len(entries), module.GetFileSpec()))
+
+    def relocate(self, module, target):
+        process_id = target.GetProcess().GetUniqueID()
+        if process_id == self._process_id:
+            return
+        self._process_id = process_id
+        header = module.GetObjectFileHeaderAddress()
+        load_address = header.GetLoadAddress(target)
+        self._slide = 0 if load_address == LLDB_INVALID_ADDRESS else load_address - header.GetFileAddress()
+
+    def address(self, name):
+        address = self._by_name.get(name)
+        return None if address is None else address + self._slide
+
+    def names_at(self, address):
+        file_address = address - self._slide
+        start = bisect.bisect_left(self._addresses, file_address)
+        end = bisect.bisect_right(self._addresses, file_address, start)
+        return self._names[start:end]
+
+    def items(self):
+        """(name, loaded address) of every distinct symbol name."""
+        slide = self._slide
+        return ((name, address + slide) for (name, address) in self._by_name.items())
+
+    def __len__(self):
+        return len(self._by_name)
+
+
+# Module UUID (or path, if there is none) -> SymbolIndex.
+SYMBOL_INDEX_CACHE = {}
+
+def _symbol_index(module, target):
+    key = module.GetUUIDString() or str(module.GetFileSpec())
+    index = SYMBOL_INDEX_CACHE.get(key)
+    if index is None:
+        index = SymbolIndex(module)
+        SYMBOL_INDEX_CACHE[key] = index
+    index.relocate(module, target)
+    return index
+
+# Module of the frame a command walking all frames is at, symbols are looked up there instead of in the module
+# of the selected frame, see konan_bt_all.
+__FRAME_MODULE = [None]
+
+def _selected_module(target):
+    if __FRAME_MODULE[0] is not None:
+        return __FRAME_MODULE[0]
+    return target.GetProcess().GetSelectedThread().GetSelectedFrame().GetModule()
+
 def _symbol_loaded_address(name, debugger = lldb.debugger):
     target = debugger.GetSelectedTarget()
-    process = target.GetProcess()
-    thread = process.GetSelectedThread()
-    frame = thread.GetSelectedFrame()
-    candidates = list(filter(lambda x: x.name == name, frame.module.symbols))
-    # take first
-    for candidate in candidates:
-        address = candidate.GetStartAddress().GetLoadAddress(target)
-        log(lambda: "_symbol_loaded_address:{} {:#x}".format(name, address))
-        return address
+    address = _symbol_index(_selected_module(target), target).address(name)
+    log(lambda: "_symbol_loaded_address:{} {}".format(name, address))
+    return address
 
 def _type_info_by_address(address, debugger = lldb.debugger):
     target = debugger.GetSelectedTarget()
-    process = target.GetProcess()
-    thread = process.GetSelectedThread()
-    frame = thread.GetSelectedFrame()
-    candidates = list(filter(lambda x: x.GetStartAddress().GetLoadAddress(target) == address, frame.module.symbols))
-    return candidates
+    module = target.ResolveLoadAddress(address).GetModule()
+    return _symbol_index(module if module.IsValid() else _selected_module(target), target).names_at(address)
+
+def _kotlin_class_name(tip, debugger = lldb.debugger):
+    for name in _type_info_by_address(tip, debugger):
+        if name.startswith('kclass:'):
+            return name[len('kclass:'):]
+    return '{:#x}'.format(tip)
+
+def _type_info_name(tip):
+    """Kotlin class name for statistics and diagnostics, only looked up if statistics are collected."""
+    return _kotlin_class_name(tip) if STATISTICS.enabled else '-'
 
 def is_instance_of(addr, typeinfo):
     return evaluate("(bool)IsInstance({}, {:#x})".format(addr, typeinfo)).GetValue() == "true"
 
-def is_string_or_array(value):
-    return evaluate("(int)IsInstance({0}, {1}) ? 1 : ((int)Konan_DebugIsArray({0}) ? 2 : 0)".format(lldb_val_to_ptr(value), _symbol_loaded_address('kclass:kotlin.String'))).unsigned
+def _string_type_info(tip, debugger = lldb.debugger):
+    """Loaded address of the TypeInfo of kotlin.String in the module containing the TypeInfo at `tip`, whatever frame
+    is selected. None if that module is unknown or has no such symbol."""
+    target = debugger.GetSelectedTarget()
+    module = target.ResolveLoadAddress(tip).GetModule()
+    if not module.IsValid():
+        return None
+    return _symbol_index(module, target).address('kclass:kotlin.String')
+
+def is_string_or_array(value, string_tip):
+    """1 for a String, 2 for another array, 0 otherwise. Without `string_tip` a String is taken for an array."""
+    if string_tip is None:
+        return 2 if evaluate("(int)Konan_DebugIsArray({})".format(lldb_val_to_ptr(value))).unsigned else 0
+    return evaluate("(int)IsInstance({0}, {1:#x}) ? 1 : ((int)Konan_DebugIsArray({0}) ? 2 : 0)".format(lldb_val_to_ptr(value), string_tip)).unsigned
 
 def type_info(value):
     """This method checks self-referencing of pointer of first member of TypeInfo including case when object has an
     meta-object pointed by TypeInfo. Two lower bits are reserved for memory management needs see runtime/src/main/cpp/Memory.h."""
     if value.GetTypeName() != "ObjHeader *":
         return False
-    expr = "*(void **)((uintptr_t)(*(void**){0:#x}) & ~0x3) == **(void***)((uintptr_t)(*(void**){0:#x}) & ~0x3) ? *(void **)((uintptr_t)(*(void**){0:#x}) & ~0x3) : (void *)0".format(value.unsigned)
-    result = evaluate(expr)
-    return result.unsigned if result.IsValid() and result.unsigned != 0 else None
+    return TYPE_INFO_KINDS.type_info(value.unsigned, TargetMemory())
+
+
+class TypeInfoKind(collections.namedtuple('TypeInfoKind', ['provider', 'element_type'])):
+    """What a TypeInfo describes: provider is 'string', 'array' or 'object' (see __FACTORY),
+    element_type is the runtime type of array elements, None if it isn't an array or is unknown."""
+    pass
+
+
+class TypeInfoKinds:
+    """Kinds of the TypeInfos seen in the current process. A TypeInfo is classified once, from its extended info
+    (or with expressions in optimized builds, which have none), later values of the same type only cost the reads
+    of their header and a dictionary lookup."""
+    def __init__(self):
+        self._kinds = {}
+        self._process_id = None
+
+    def _validate(self):
+        process_id = lldb.debugger.GetSelectedTarget().GetProcess().GetUniqueID()
+        if process_id != self._process_id:
+            self._process_id = process_id
+            self._kinds.clear()
+
+    def type_info(self, address, memory):
+        """TypeInfo of the object at `address`, read from memory, or None if it doesn't look like a Kotlin object."""
+        self._validate()
+        header = memory.read_pointer(address)
+        if not header:
+            return None
+        header &= ~OBJECT_TAG_MASK
+        # Objects without a meta-object reference their TypeInfo directly.
+        if header in self._kinds:
+            return header
+        tip = memory.read_pointer(header)
+        if not tip:
+            return None
+        if tip in self._kinds or memory.read_pointer(tip) == tip:
+            return tip
+        return None
+
+    def get(self, tip):
+        self._validate()
+        return self._kinds.get(tip)
+
+    def kind(self, tip, value, memory = None):
+        self._validate()
+        kind = self._kinds.get(tip)
+        if kind is None:
+            (kind, final) = self._classify(tip, value, memory if memory is not None else TargetMemory())
+            log(lambda: "TypeInfoKinds: {:#x}: {}{}".format(tip, kind, '' if final else ' (not cached)'))
+            if final:
+                self._kinds[tip] = kind
+        return kind
+
+    def _classify(self, tip, value, memory):
+        """(TypeInfoKind, final), a kind isn't final if it may be told better later, e.g. an array is seen
+        before the TypeInfo of kotlin.String can be found."""
+        extended_info = _extended_type_info(memory, tip)
+        if extended_info is None:
+            return _backend().type_kind(tip, value, memory)
+        count = extended_info[0]
+        if count >= 0:
+            return (TypeInfoKind('object', None), True)
+        # String is an array of Char as CharArray is, it can only be told apart by its TypeInfo.
+        string_tip = _string_type_info(tip)
+        if tip == string_tip:
+            return (TypeInfoKind('string', -count), True)
+        return (TypeInfoKind('array', -count), string_tip is not None)
+
+    def clear(self):
+        self._kinds.clear()
+
+
+# TypeInfoKind by TypeInfo address.
+TYPE_INFO_KINDS = TypeInfoKinds()
+
+
+def _extended_type_info(memory, tip):
+    """Decodes ExtendedTypeInfo (see runtime/src/main/cpp/TypeInfo.h) of the TypeInfo at `tip`.
+    Returns (fieldsCount_, fieldOffsets_, fieldTypes_, fieldNames_) or None if memory doesn't look like TypeInfo."""
+    header = memory.read_pointers(tip, 2)
+    # TypeInfo::typeInfo_ references itself, TypeInfo::extendedInfo_ is always at the second position.
+    if header is None or header[0] != tip or not header[1]:
+        return None
+    format = 'i4xQQQ' if memory.pointer_size == 8 else 'iIII'
+    data = memory.read(header[1], struct.calcsize('<' + format))
+    if data is None:
+        return None
+    return memory.unpack(format, data)
+
+
+def _read_object_layout(tip, memory = None):
+    """Builds [MemberLayout] for the type from TypeInfo extended info with bulk memory reads,
+    returns None if the layout can't be recognized and Konan_Debug* functions must be used."""
+    memory = memory if memory is not None else TargetMemory()
+    extended_info = _extended_type_info(memory, tip)
+    if extended_info is None:
+        return None
+    (count, offsets_address, types_address, names_address) = extended_info
+    # Negative count marks arrays.
+    if count < 0 or count > MAX_FIELDS_COUNT:
+        return None
+    if count == 0:
+        return []
+    offsets_data = memory.read(offsets_address, 4 * count)
+    types = memory.read(types_address, count)
+    names_addresses = memory.read_pointers(names_address, count)
+    if offsets_data is None or types is None or names_addresses is None:
+        return None
+    offsets = memory.unpack('{}i'.format(count), offsets_data)
+    types = bytearray(types)
+    if any(t == RT_INVALID or t > RT_VECTOR128 for t in types) or any(o <= 0 for o in offsets):
+        return None
+    names = memory.read_c_strings(names_addresses)
+    if names is None:
+        return None
+    log(lambda: "_read_object_layout: {:#x}: {}".format(tip, names))
+    return [MemberLayout(names[i], types[i], offsets[i]) for i in range(count)]
+
+
+def _align_up(value, alignment):
+    return (value + alignment - 1) & ~(alignment - 1)
+
+
+def _decode_utf16(memory, data):
+    # A surrogate pair cut by the preview limit is dropped rather than replaced.
+    if len(data) >= 2 and 0xd8 <= bytearray(data)[-2 if memory.endian == '>' else -1] <= 0xdb:
+        data = data[:-2]
+    return data.decode('utf-16-be' if memory.endian == '>' else 'utf-16-le', 'replace')
+
+
+def _read_string(address, limit, memory = None):
+    """Reads and decodes up to `limit` UTF-16 chars of kotlin.String at `address` (an array of Char,
+    see runtime/src/main/cpp/KString.cpp), returns (text, length of the whole string) or None."""
+    memory = memory if memory is not None else TargetMemory()
+    header_size = _align_up(memory.pointer_size + 4, memory.pointer_size)
+    # Optimistically read the count and the preview at once, it only fails if the string ends near unmapped memory.
+    data = memory.read(address + memory.pointer_size, header_size - memory.pointer_size + 2 * limit)
+    if data is not None:
+        count = memory.unpack('I', data)[0]
+        payload = data[header_size - memory.pointer_size:][:2 * min(count, limit)]
+    else:
+        data = memory.read(address + memory.pointer_size, 4)
+        if data is None:
+            return None
+        count = memory.unpack('I', data)[0]
+        payload = memory.read(address + header_size, 2 * min(count, limit))
+        if payload is None:
+            return None
+    return (_decode_utf16(memory, payload), count)
+
+
+def _read_array_layout(address, tip, memory = None):
+    """Reads ArrayHeader of the array at `address`, see runtime/src/main/cpp/Memory.h.
+    Returns (count, element type, offset of the first element, element size) or None if it can't be recognized."""
+    memory = memory if memory is not None else TargetMemory()
+    kind = TYPE_INFO_KINDS.get(tip)
+    element_type = kind.element_type if kind is not None else None
+    if element_type is None:
+        extended_info = _extended_type_info(memory, tip)
+        if extended_info is None:
+            return None
+        element_type = -extended_info[0]
+    if element_type <= RT_INVALID or element_type > RT_VECTOR128:
+        return None
+    data = memory.read(address + memory.pointer_size, 4)
+    if data is None:
+        return None
+    count = memory.unpack('I', data)[0]
+    # Same as Konan_DebugGetFieldAddressImpl.
+    header_size = _align_up(memory.pointer_size + 4, memory.pointer_size)
+    offset = _align_up(header_size, memory.type_alignment(element_type))
+    return (count, element_type, offset, memory.type_size(element_type))
+
+
+def _type_info_header(memory, tip):
+    """Reads (instanceSize_, objOffsets_, objOffsetsCount_) of TypeInfo, which optimized builds have too."""
+    format = 'QQIiQQi' if memory.pointer_size == 8 else 'IIIiIIi'
+    data = memory.read(tip, struct.calcsize('<' + format))
+    if data is None:
+        return None
+    (_, _, _, instance_size, _, offsets, offsets_count) = memory.unpack(format, data)
+    return (instance_size, offsets, offsets_count)
+
+
+class ExpressionBackend:
+    """Answers what memory alone can't with Konan_Debug* functions of the runtime, which needs a process able
+    to run code: kinds and layouts of types without extended info, fields made into values by expressions."""
+    name = 'expression'
+    # C type of the pointer to a field by its runtime type.
+    POINTER_TYPES = ['void *', None, 'int8_t *', 'int16_t *', 'int32_t *', 'int64_t *', 'float *', 'double *',
+                     'void **', 'bool *', None]
+
+    def type_kind(self, tip, value, memory):
+        string_tip = _string_type_info(tip)
+        soa = is_string_or_array(value, string_tip)
+        if soa == 1:
+            return (TypeInfoKind('string', RT_INT16), True)
+        if soa == 2:
+            return (TypeInfoKind('array', None), string_tip is not None)
+        return (TypeInfoKind('object', None), True)
+
+    def object_layout(self, value, tip, memory):
+        ptr = lldb_val_to_ptr(value)
+        count = evaluate("(int)Konan_DebugGetFieldCount({})".format(ptr)).signed
+        return [MemberLayout(self._field_name(ptr, i), self._field_type(ptr, i), self._field_address(ptr, i) - value.unsigned)
+                for i in range(count)]
+
+    def array_layout(self, value):
+        """(count, element type, offset of the first element, element size) of the array."""
+        ptr = lldb_val_to_ptr(value)
+        count = evaluate("(int)Konan_DebugGetFieldCount({})".format(ptr)).signed
+        type = self._field_type(ptr, 0)
+        zerro_address = self._field_address(ptr, 0)
+        first_address = self._field_address(ptr, 1)
+        return (count, type, zerro_address - value.unsigned, first_address - zerro_address)
+
+    def field_pointer(self, value, runtime_type, type, address, name):
+        """Value of the pointer to the field of the given runtime type (and SBType) at `address`."""
+        c_type = ExpressionBackend.POINTER_TYPES[runtime_type]
+        return value.CreateValueFromExpression(name, "({}){:#x}".format(c_type, address)) if c_type else None
+
+    def object_description(self, value):
+        """Kotlin toString() of the object, or None."""
+        buff_addr = evaluate("(void *)Konan_DebugBuffer()").unsigned
+        buff_len = evaluate(
+            '(int)Konan_DebugObjectToUtf8Array({}, (void *){:#x}, (int)Konan_DebugBufferSize());'.format(
+                lldb_val_to_ptr(value), buff_addr)
+        ).signed
+        if not buff_len:
+            return None
+        error = lldb.SBError()
+        s = value.GetProcess().ReadCStringFromMemory(int(buff_addr), int(buff_len), error)
+        if not error.Success():
+            raise DebuggerException()
+        return s
+
+    def type_name(self, expression):
+        return evaluate('(char *)Konan_DebugGetTypeName({})'.format(expression)).summary
+
+    def call_getters(self, c_type, getters):
+        return _evaluate_getters(c_type, getters)
+
+    def _field_name(self, ptr, index):
+        error = lldb.SBError()
+        address = evaluate("(void *)Konan_DebugGetFieldName({}, (int){})".format(ptr, index)).unsigned
+        name = lldb.debugger.GetSelectedTarget().GetProcess().ReadCStringFromMemory(address, 0x1000, error)
+        if not error.Success():
+            raise DebuggerException()
+        return name
+
+    def _field_address(self, ptr, index):
+        return evaluate("(void *)Konan_DebugGetFieldAddress({}, {})".format(ptr, index)).unsigned
+
+    def _field_type(self, ptr, index):
+        return evaluate("(int)Konan_DebugGetFieldType({}, {})".format(ptr, index)).unsigned
+
+
+class MemoryBackend:
+    """Never runs code in the process, so it works with core files. What only the runtime knows is approximated:
+    types without extended info (optimized builds) are told apart by their instance size, and only their reference
+    fields are known, named by offset; globals are only read from their storage."""
+    name = 'memory'
+    # Runtime type of elements of primitive arrays by element size, an IntArray and a FloatArray look the same.
+    ELEMENT_TYPES = {1: RT_INT8, 2: RT_INT16, 4: RT_INT32, 8: RT_INT64, 16: RT_VECTOR128}
+
+    def __init__(self):
+        # Layouts made from objOffsets_ are not stored in the persistent LayoutCache, as they lack names.
+        self._layouts = {}
+
+    def clear(self):
+        self._layouts.clear()
+
+    def type_kind(self, tip, value, memory):
+        header = _type_info_header(memory, tip)
+        if header is None or header[0] >= 0:
+            return (TypeInfoKind('object', None), True)
+        # kotlin.Array is the only array with objOffsetsCount_ set.
+        if header[2] > 0:
+            return (TypeInfoKind('array', RT_OBJECT), True)
+        string_tip = _string_type_info(tip)
+        if tip == string_tip:
+            return (TypeInfoKind('string', RT_INT16), True)
+        return (TypeInfoKind('array', MemoryBackend.ELEMENT_TYPES.get(-header[0])), string_tip is not None)
+
+    def object_layout(self, value, tip, memory):
+        key = (value.GetProcess().GetUniqueID(), tip)
+        if key not in self._layouts:
+            header = _type_info_header(memory, tip)
+            offsets = memory.read(header[1], 4 * header[2]) if header is not None and header[2] > 0 else None
+            offsets = memory.unpack('{}i'.format(header[2]), offsets) if offsets is not None else []
+            self._layouts[key] = [MemberLayout('field@{}'.format(offset), RT_OBJECT, offset) for offset in offsets]
+        return self._layouts[key]
+
+    def array_layout(self, value):
+        return None
+
+    def field_pointer(self, value, runtime_type, type, address, name):
+        memory = TargetMemory()
+        data = lldb.SBData()
+        data.SetData(lldb.SBError(), struct.pack(memory.endian + memory.pointer_format, address), memory.byte_order,
+                     memory.pointer_size)
+        return value.CreateValueFromData(name, data, type if runtime_type == RT_INVALID else type.GetPointerType())
+
+    def object_description(self, value):
+        return None
+
+    def type_name(self, expression):
+        tip = TYPE_INFO_KINDS.type_info(int(expression, 0), TargetMemory())
+        return '"{}"'.format(_kotlin_class_name(tip)) if tip else None
+
+    def call_getters(self, c_type, getters):
+        return None
+
+
+BACKENDS = {'expression': ExpressionBackend(), 'memory': MemoryBackend()}
+# 'auto' picks the backend by the process, see _backend and `konan_backend` command.
+BACKEND_MODE = 'auto'
+__BACKEND_OF_PROCESS = [None, None]
+
+def _can_run_code(process):
+    """Core files and processes without threads can't run expressions."""
+    if not process.IsValid() or process.GetNumThreads() == 0:
+        return False
+    plugin = process.GetPluginName() or ''
+    return 'core' not in plugin and 'minidump' not in plugin
+
+def _backend(target = None):
+    if BACKEND_MODE != 'auto':
+        return BACKENDS[BACKEND_MODE]
+    process = (target if target is not None else lldb.debugger.GetSelectedTarget()).GetProcess()
+    process_id = process.GetUniqueID()
+    if __BACKEND_OF_PROCESS[0] != process_id:
+        backend = BACKENDS['expression' if _can_run_code(process) else 'memory']
+        log(lambda: "_backend: {} for process {}".format(backend.name, process_id))
+        __BACKEND_OF_PROCESS[:] = [process_id, backend]
+    return __BACKEND_OF_PROCESS[1]
+
+
+def _default_layout_cache_path():
+    # Same data directory as the compiler uses, see KONAN_DATA_DIR.
+    data_dir = os.getenv('KONAN_DATA_DIR', os.path.join(os.path.expanduser('~'), '.konan'))
+    return os.path.join(data_dir, 'cache', 'lldb_layouts.json')
+
+
+class LayoutCache:
+    """LRU cache of object layouts ([MemberLayout]) persisted between debugger sessions.
+
+    Layouts are looked up by the runtime TypeInfo address, but stored under the UUID of the module the TypeInfo
+    belongs to plus its file address (offset from the module base), so they survive ASLR and lldb restarts.
+    Entries of a module are dropped as soon as the binary at the same path gets another UUID (or, if the module
+    has no UUID, another modification time or size)."""
+    VERSION = 1
+
+    def __init__(self, path = None, capacity = 4096, save_interval = 10.0):
+        self._path = path
+        self._capacity = capacity
+        self._save_interval = save_interval
+        self._entries = collections.OrderedDict()
+        # Module path -> module key, to notice rebuilt binaries.
+        self._modules = {}
+        # TypeInfo address -> entry key, valid while the process lives.
+        self._keys = {}
+        self._process_id = None
+        self._loaded = False
+        self._dirty = False
+        self._last_save = time.time()
+
+    def _load(self):
+        self._loaded = True
+        if not self._path or not os.path.exists(self._path):
+            return
+        try:
+            with open(self._path) as file:
+                data = json.load(file)
+            if data.get('version') != LayoutCache.VERSION:
+                return
+            self._modules.update(data['modules'])
+            for (module_key, file_address, members) in data['layouts']:
+                self._entries[(module_key, file_address)] = [MemberLayout(*member) for member in members]
+        except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+            log(lambda: "LayoutCache: can't load {}: {}".format(self._path, e))
+            self._entries.clear()
+
+    def save(self):
+        if not self._dirty or not self._path:
+            return
+        self._dirty = False
+        self._last_save = time.time()
+        persistent = [key for key in self._entries.keys() if not key[0].startswith('process:')]
+        data = {
+            'version': LayoutCache.VERSION,
+            'modules': self._modules,
+            'layouts': [[key[0], key[1], [[m.name(), m.type(), m.offset()] for m in self._entries[key]]]
+                        for key in persistent]
+        }
+        try:
+            directory = os.path.dirname(self._path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            temporary = '{}.{}'.format(self._path, os.getpid())
+            with open(temporary, 'w') as file:
+                json.dump(data, file)
+            os.replace(temporary, self._path)
+        except (IOError, OSError) as e:
+            log(lambda: "LayoutCache: can't save {}: {}".format(self._path, e))
+
+    def _module_key(self, module):
+        path = str(module.GetFileSpec())
+        uuid = module.GetUUIDString()
+        if uuid:
+            key = uuid
+        else:
+            try:
+                stat = os.stat(path)
+                key = '{}:{}:{}'.format(path, int(stat.st_mtime), stat.st_size)
+            except OSError:
+                return None
+        if self._modules.get(path) != key:
+            stale = self._modules.get(path)
+            if stale is not None:
+                log(lambda: "LayoutCache: {} changed, dropping {}".format(path, stale))
+                for entry in [entry for entry in self._entries.keys() if entry[0] == stale]:
+                    del self._entries[entry]
+            self._modules[path] = key
+            self._dirty = True
+        return key
+
+    def _key(self, tip):
+        target = lldb.debugger.GetSelectedTarget()
+        process_id = target.GetProcess().GetUniqueID()
+        if process_id != self._process_id:
+            self._keys.clear()
+            self._process_id = process_id
+        key = self._keys.get(tip)
+        if key is None:
+            address = target.ResolveLoadAddress(tip)
+            module = address.GetModule()
+            module_key = self._module_key(module) if module.IsValid() else None
+            if module_key is None:
+                key = ('process:{}'.format(process_id), tip)
+            else:
+                key = (module_key, address.GetFileAddress())
+            self._keys[tip] = key
+        return key
+
+    def get(self, tip):
+        if not self._loaded:
+            self._load()
+        key = self._key(tip)
+        layout = self._entries.get(key)
+        if layout is not None:
+            self._entries.move_to_end(key)
+        STATISTICS.count('layout_cache.miss' if layout is None else 'layout_cache.hit')
+        return layout
+
+    def put(self, tip, layout):
+        if not self._loaded:
+            self._load()
+        key = self._key(tip)
+        self._entries[key] = layout
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._capacity:
+            self._entries.popitem(last = False)
+        self._dirty = True
+        if time.time() - self._last_save > self._save_interval:
+            self.save()
+
+    def clear(self):
+        self._entries.clear()
+        self._modules.clear()
+        self._keys.clear()
+        self._loaded = True
+        self._dirty = True
+        self.save()
+
+    def __len__(self):
+        return len(self._entries)
 
 
 __FACTORY = {}
 
 
-# Cache type info pointer to [ChildMetaInfo]
-SYNTHETIC_OBJECT_LAYOUT_CACHE = {}
+# Cache of object layouts ([MemberLayout]) by type info pointer, see LayoutCache.
+SYNTHETIC_OBJECT_LAYOUT_CACHE = LayoutCache(_default_layout_cache_path())
+atexit.register(SYNTHETIC_OBJECT_LAYOUT_CACHE.save)
 TO_STRING_DEPTH = 2
 ARRAY_TO_STRING_LIMIT = 10
+# Number of chars of kotlin.String shown in summaries, see `konan_string_preview` and `konan_string` commands.
+STRING_PREVIEW_LENGTH = 256
+# Array elements are read from memory and made into values by pages of this size.
+ARRAY_PAGE_SIZE = 256
+ARRAY_CACHED_PAGES = 4
+
+class StopCache:
+    """Values which are only valid while the process stays stopped. The cache listens to state changes of the
+    process and drops everything once it resumes (expression evaluation doesn't count, as its events are hijacked);
+    the stop id is checked as well in case an event was missed."""
+    def __init__(self):
+        self._values = {}
+        self._listener = None
+        self._broadcaster = None
+        self._process_id = None
+        self._stop_id = None
+
+    def _validate(self):
+        process = lldb.debugger.GetSelectedTarget().GetProcess()
+        process_id = process.GetUniqueID()
+        if process_id != self._process_id:
+            # A single listener moves from process to process, events of the previous one are dropped below.
+            if self._listener is None:
+                self._listener = lldb.SBListener('konan_lldb.stop_cache')
+            else:
+                self._broadcaster.RemoveListener(self._listener, lldb.SBProcess.eBroadcastBitStateChanged)
+            self._process_id = process_id
+            self._broadcaster = process.GetBroadcaster()
+            self._broadcaster.AddListener(self._listener, lldb.SBProcess.eBroadcastBitStateChanged)
+            self._values.clear()
+        resumed = False
+        event = lldb.SBEvent()
+        while self._listener.GetNextEvent(event):
+            if lldb.SBProcess.GetStateFromEvent(event) != lldb.eStateStopped:
+                resumed = True
+        stop_id = process.GetStopID()
+        if resumed or stop_id != self._stop_id:
+            log(lambda: "StopCache: dropping {} values".format(len(self._values)))
+            self._stop_id = stop_id
+            self._values.clear()
+
+    def get(self, key):
+        self._validate()
+        return self._values.get(key)
+
+    def put(self, key, value):
+        self._values[key] = value
+
+    def clear(self):
+        self._values.clear()
+
+    def __len__(self):
+        return len(self._values)
+
+
+# Summaries by (object address, remaining to_string depth) for the current stop.
+SUMMARY_CACHE = StopCache()
+
+
+class TimeBudget:
+    """Time the formatters may spend on summaries and children during a single stop, see `konan_time_budget`.
+    Once it is spent, summaries are replaced with TIME_BUDGET_PLACEHOLDER, so that a huge heap or a slow target
+    leaves the IDE's variables view incomplete rather than blocked. Nested measurements are only counted once."""
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self._spent = StopCache()
+        self._depth = 0
+
+    def exhausted(self):
+        return self.seconds > 0 and (self._spent.get('spent') or 0.0) > self.seconds
+
+    def __enter__(self):
+        if self._depth == 0:
+            self._start = time.perf_counter()
+        self._depth += 1
+        return self
+
+    def __exit__(self, *_):
+        self._depth -= 1
+        if self._depth == 0:
+            self._spent.put('spent', (self._spent.get('spent') or 0.0) + time.perf_counter() - self._start)
+
+    @contextlib.contextmanager
+    def suspended(self):
+        """For commands with limits of their own: the time is not counted and summaries are not cut."""
+        (seconds, self.seconds) = (self.seconds, 0)
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            self.seconds = seconds
+
+
+TIME_BUDGET = TimeBudget(3.0)
+TIME_BUDGET_PLACEHOLDER = '<time budget exceeded, see konan_time_budget>'
+
+
+class RenderContext:
+    """State of rendering a single summary: objects on the path from the root, to print back-references instead
+    of following cycles. Summaries are memoized in SUMMARY_CACHE, unless they contain a back-reference to an object
+    above them, since such a summary depends on the path it was reached by."""
+    def __init__(self):
+        self._path = {}
+        # Smallest path index referenced by a back-reference since it was reset.
+        self._referenced = sys.maxsize
+
+    def render(self, lldb_val, internal_dict):
+        address = lldb_val.unsigned
+        index = self._path.get(address)
+        if index is not None:
+            self._referenced = min(self._referenced, index)
+            return "<cycle {:#x}>".format(address)
+
+        key = (address, internal_dict.get("to_string_depth", TO_STRING_DEPTH))
+        summary = SUMMARY_CACHE.get(key)
+        STATISTICS.count('summary_cache.miss' if summary is None else 'summary_cache.hit')
+        if summary is not None:
+            return summary
+        if TIME_BUDGET.exhausted():
+            return TIME_BUDGET_PLACEHOLDER
+
+        with TIME_BUDGET:
+            return self._render(lldb_val, address, key, internal_dict)
+
+    def _render(self, lldb_val, address, key, internal_dict):
+        tip = internal_dict["type_info"] if "type_info" in internal_dict.keys() else type_info(lldb_val)
+        if not tip:
+            return lldb_val.GetValue()
+
+        index = len(self._path)
+        self._path[address] = index
+        try:
+            with STATISTICS.scope('summary', 'select_provider', _type_info_name(tip)) as scope:
+                provider = select_provider(lldb_val, tip, internal_dict)
+                scope.provider = provider.__class__.__name__
+                summary = provider.to_string()
+        finally:
+            del self._path[address]
+        if self._referenced >= index:
+            self._referenced = sys.maxsize
+            SUMMARY_CACHE.put(key, summary)
+        return summary
+
 
 def kotlin_object_type_summary(lldb_val, internal_dict = {}):
     """Hook that is run by lldb to display a Kotlin object."""
     log(lambda: "kotlin_object_type_summary({:#x}, {})".format(lldb_val.unsigned, internal_dict))
-    fallback = lldb_val.GetValue()
     if str(lldb_val.type) != "struct ObjHeader *":
         if lldb_val.GetValue() is None:
             return NULL
@@ -106,20 +1027,19 @@ def kotlin_object_type_summary(lldb_val, internal_dict = {}):
 
     if lldb_val.unsigned == 0:
             return NULL
-    tip = internal_dict["type_info"] if "type_info" in internal_dict.keys() else type_info(lldb_val)
 
-    if not tip:
-        return fallback
-
-    return select_provider(lldb_val, tip, internal_dict).to_string()
+    context = internal_dict.get("render_context")
+    if context is None:
+        context = RenderContext()
+        internal_dict = dict(internal_dict, render_context = context)
+    return context.render(lldb_val, internal_dict)
 
 
 def select_provider(lldb_val, tip, internal_dict):
     log(lambda : "select_provider: name:{} : {}, {}".format(lldb_val.name, lldb_val, internal_dict))
-    soa = is_string_or_array(lldb_val)
-    log(lambda : "select_provider: {} : soa: {}".format(lldb_val, soa))
-    return __FACTORY['string'](lldb_val, tip, internal_dict) if soa == 1 else __FACTORY['array'](lldb_val, tip, internal_dict) if soa == 2 \
-        else __FACTORY['object'](lldb_val, tip, internal_dict)
+    kind = TYPE_INFO_KINDS.kind(tip, lldb_val)
+    log(lambda : "select_provider: {} : kind: {}".format(lldb_val, kind))
+    return __FACTORY[kind.provider](lldb_val, tip, internal_dict)
 
 class KonanHelperProvider(lldb.SBSyntheticValueProvider):
     def __init__(self, valobj, amString, internal_dict = {}):
@@ -131,42 +1051,38 @@ class KonanHelperProvider(lldb.SBSyntheticValueProvider):
             return
         self._internal_dict = internal_dict.copy()
         self._to_string_depth = TO_STRING_DEPTH if "to_string_depth" not in self._internal_dict.keys() else  self._internal_dict["to_string_depth"]
-        if self._children_count == 0:
-            self._children_count = evaluate("(int)Konan_DebugGetFieldCount({})".format(self._ptr)).signed
+        self._backend = _backend(self._target)
         self._children = []
-        self._type_conversion = [
-            lambda address, name: self._valobj.CreateValueFromExpression(name, "(void *){:#x}".format(address)),
-            lambda address, name: self._create_synthetic_child(address, name),
-            lambda address, name: self._valobj.CreateValueFromExpression(name, "(int8_t *){:#x}".format(address)),
-            lambda address, name: self._valobj.CreateValueFromExpression(name, "(int16_t *){:#x}".format(address)),
-            lambda address, name: self._valobj.CreateValueFromExpression(name, "(int32_t *){:#x}".format(address)),
-            lambda address, name: self._valobj.CreateValueFromExpression(name, "(int64_t *){:#x}".format(address)),
-            lambda address, name: self._valobj.CreateValueFromExpression(name, "(float *){:#x}".format(address)),
-            lambda address, name: self._valobj.CreateValueFromExpression(name, "(double *){:#x}".format(address)),
-            lambda address, name: self._valobj.CreateValueFromExpression(name, "(void **){:#x}".format(address)),
-            lambda address, name: self._valobj.CreateValueFromExpression(name, "(bool *){:#x}".format(address)),
-            lambda address, name: None]
-
-        self._types = [
-            valobj.GetType().GetBasicType(lldb.eBasicTypeVoid).GetPointerType(),
-            valobj.GetType(),
-            valobj.GetType().GetBasicType(lldb.eBasicTypeChar),
-            valobj.GetType().GetBasicType(lldb.eBasicTypeShort),
-            valobj.GetType().GetBasicType(lldb.eBasicTypeInt),
-            valobj.GetType().GetBasicType(lldb.eBasicTypeLongLong),
-            valobj.GetType().GetBasicType(lldb.eBasicTypeFloat),
-            valobj.GetType().GetBasicType(lldb.eBasicTypeDouble),
-            valobj.GetType().GetBasicType(lldb.eBasicTypeVoid).GetPointerType(),
-            valobj.GetType().GetBasicType(lldb.eBasicTypeBool)
-        ]
-
-    def _read_string(self, expr, error):
-        return self._process.ReadCStringFromMemory(evaluate(expr).unsigned, 0x1000, error)
+        self._basic_types = None
+
+    @property
+    def _types(self):
+        """SBType by runtime type, only looked up once children or summaries need them."""
+        if self._basic_types is None:
+            valobj = self._valobj
+            self._basic_types = [
+                valobj.GetType().GetBasicType(lldb.eBasicTypeVoid).GetPointerType(),
+                valobj.GetType(),
+                valobj.GetType().GetBasicType(lldb.eBasicTypeChar),
+                valobj.GetType().GetBasicType(lldb.eBasicTypeShort),
+                valobj.GetType().GetBasicType(lldb.eBasicTypeInt),
+                valobj.GetType().GetBasicType(lldb.eBasicTypeLongLong),
+                valobj.GetType().GetBasicType(lldb.eBasicTypeFloat),
+                valobj.GetType().GetBasicType(lldb.eBasicTypeDouble),
+                valobj.GetType().GetBasicType(lldb.eBasicTypeVoid).GetPointerType(),
+                valobj.GetType().GetBasicType(lldb.eBasicTypeBool)
+            ]
+        return self._basic_types
 
     def _read_value(self, index):
-        value_type = self._children[index].type()
+        value_type = int(self._children[index].type())
         address = self._valobj.unsigned + self._children[index].offset()
-        return self._type_conversion[int(value_type)](address, str(self._children[index].name()))
+        name = str(self._children[index].name())
+        if value_type == RT_OBJECT:
+            return self._create_synthetic_child(address, name)
+        if not RT_INVALID <= value_type < RT_VECTOR128:
+            return None
+        return self._backend.field_pointer(self._valobj, value_type, self._types[value_type], address, name)
 
     def _create_synthetic_child(self, address, name):
         if self._to_string_depth == 0:
@@ -185,7 +1101,7 @@ class KonanHelperProvider(lldb.SBSyntheticValueProvider):
         return type
 
     def _deref_or_obj_summary(self, index, internal_dict):
-        value = self._values[index]
+        value = self.get_child_at_index(index)
         if not value:
             log(lambda : "_deref_or_obj_summary: value none, index:{}, type:{}".format(index, self._children[index].type()))
             return None
@@ -202,32 +1118,24 @@ class KonanHelperProvider(lldb.SBSyntheticValueProvider):
 
         return kotlin_object_type_summary(value.deref, internal_dict)
 
-    def _field_address(self, index):
-        return evaluate("(void *)Konan_DebugGetFieldAddress({}, {})".format(self._ptr, index)).unsigned
-
-    def _field_type(self, index):
-        return evaluate("(int)Konan_DebugGetFieldType({}, {})".format(self._ptr, index)).unsigned
-
 class KonanStringSyntheticProvider(KonanHelperProvider):
     def __init__(self, valobj):
         self._children_count = 0
         super(KonanStringSyntheticProvider, self).__init__(valobj, True)
-        fallback = valobj.GetValue()
-        buff_addr = evaluate("(void *)Konan_DebugBuffer()").unsigned
-        buff_len = evaluate(
-            '(int)Konan_DebugObjectToUtf8Array({}, (void *){:#x}, (int)Konan_DebugBufferSize());'.format(
-                self._ptr, buff_addr)
-        ).signed
-
-        if not buff_len:
-            self._representation = fallback
+        self._memory = TargetMemory()
+        self._full_text = None
+        string = _read_string(valobj.unsigned, STRING_PREVIEW_LENGTH, self._memory)
+        if string is not None:
+            (self._representation, self._length) = string
+            if self._length > STRING_PREVIEW_LENGTH:
+                self._representation += '...'
+            else:
+                self._full_text = self._representation
             return
-
-        error = lldb.SBError()
-        s = self._process.ReadCStringFromMemory(int(buff_addr), int(buff_len), error)
-        if not error.Success():
-            raise DebuggerException()
-        self._representation = s if error.Success() else fallback
+        self._length = None
+        fallback = valobj.GetValue()
+        s = _backend(self._target).object_description(valobj)
+        self._representation = s if s is not None else fallback
         self._logger = lldb.formatters.Logger.Logger()
 
     def update(self):
@@ -248,6 +1156,13 @@ class KonanStringSyntheticProvider(KonanHelperProvider):
     def to_string(self):
         return self._representation
 
+    def full_text(self):
+        """The whole string, loaded on the first request only, as summaries show just the preview."""
+        if self._full_text is None:
+            string = _read_string(self._valobj.unsigned, self._length, self._memory) if self._length is not None else None
+            self._full_text = string[0] if string is not None else self._representation
+        return self._full_text
+
 
 class DebuggerException(Exception):
     pass
@@ -269,33 +1184,27 @@ class MemberLayout:
 
 class KonanObjectSyntheticProvider(KonanHelperProvider):
     def __init__(self, valobj, tip, internal_dict):
-        # Save an extra call into the process
-        if tip in SYNTHETIC_OBJECT_LAYOUT_CACHE:
-            log(lambda : "TIP: {:#x} EARLYHIT".format(tip))
-            self._children = SYNTHETIC_OBJECT_LAYOUT_CACHE[tip]
-            self._children_count = len(self._children)
+        layout = SYNTHETIC_OBJECT_LAYOUT_CACHE.get(tip)
+        if layout is None:
+            layout = _read_object_layout(tip)
+            if layout is not None:
+                log(lambda : "TIP: {:#x} DECODED".format(tip))
+                SYNTHETIC_OBJECT_LAYOUT_CACHE.put(tip, layout)
         else:
-            self._children_count = 0
-
+            log(lambda : "TIP: {:#x} HIT".format(tip))
         super(KonanObjectSyntheticProvider, self).__init__(valobj, False, internal_dict)
 
-        if not tip in SYNTHETIC_OBJECT_LAYOUT_CACHE:
-            SYNTHETIC_OBJECT_LAYOUT_CACHE[tip] = [
-                MemberLayout(self._field_name(i), self._field_type(i), self._field_address(i) - self._valobj.unsigned)
-                for i in range(self._children_count)]
+        if layout is None:
+            layout = self._backend.object_layout(valobj, tip, TargetMemory(self._target))
+            if self._backend is BACKENDS['expression']:
+                SYNTHETIC_OBJECT_LAYOUT_CACHE.put(tip, layout)
             log(lambda : "TIP: {:#x} MISSED".format(tip))
-        else:
-            log(lambda : "TIP: {:#x} HIT".format(tip))
-        self._children = SYNTHETIC_OBJECT_LAYOUT_CACHE[tip]
-        self._values = [self._read_value(index) for index in range(self._children_count)]
-
+        self._children = layout
+        self._children_count = len(layout)
+        # Children are only made once lldb asks for them.
+        self._values = [None] * self._children_count
+        self._indices = None
 
-    def _field_name(self, index):
-        error = lldb.SBError()
-        name =  self._read_string("(void *)Konan_DebugGetFieldName({}, (int){})".format(self._ptr, index), error)
-        if not error.Success():
-            raise DebuggerException()
-        return name
 
     def num_children(self):
         return self._children_count
@@ -303,45 +1212,121 @@ class KonanObjectSyntheticProvider(KonanHelperProvider):
     def has_children(self):
         return self._children_count > 0
 
+    def update(self):
+        # Fields may have changed since the previous stop, the layout of the type can't.
+        self._values = [None] * self._children_count
+        return False
+
     def get_child_index(self, name):
-        def __none(iterable, f):
-            return not any(f(x) for x in iterable)
-        if __none(self._children, lambda x: x.name() == name):
-            return -1
-        return next(i for i,v in enumerate(self._children) if v.name() == name)
+        if self._indices is None:
+            self._indices = {}
+            for (index, member) in enumerate(self._children):
+                self._indices.setdefault(member.name(), index)
+        return self._indices.get(name, -1)
 
     def get_child_at_index(self, index):
+        if not 0 <= index < self._children_count:
+            return None
         result = self._values[index]
         if result is None:
-            result = self._read_value(index)
+            with TIME_BUDGET:
+                result = self._read_value(index)
             self._values[index] = result
         return result
 
+    def _field_values(self):
+        """Values of primitive fields made from a single read of the object, by index, or None if it failed."""
+        primitives = [i for i in range(self._children_count) if RT_OBJECT < self._children[i].type() < RT_VECTOR128]
+        if not primitives:
+            return {}
+        memory = TargetMemory(self._target)
+        end = max(self._children[i].offset() + memory.type_size(self._children[i].type()) for i in primitives)
+        data = memory.read(self._valobj.unsigned, end)
+        if data is None:
+            return None
+        values = {}
+        for i in primitives:
+            (type, offset) = (self._children[i].type(), self._children[i].offset())
+            field = lldb.SBData()
+            field.SetData(lldb.SBError(), data[offset:offset + memory.type_size(type)], memory.byte_order, memory.pointer_size)
+            values[i] = self._valobj.CreateValueFromData(str(self._children[i].name()), field, self._types[type])
+        return values
+
+    def _field_summary(self, index, values, internal_dict):
+        if values is not None and index in values:
+            return kotlin_object_type_summary(values[index], internal_dict)
+        return self._deref_or_obj_summary(index, internal_dict)
 
-    # TODO: fix cyclic structures stringification.
     def to_string(self):
         if self._to_string_depth == 0:
             return "..."
         else:
             internal_dict = self._internal_dict.copy()
             internal_dict["to_string_depth"] = self._to_string_depth - 1
-            return dict([(self._children[i].name(), self._deref_or_obj_summary(i, internal_dict)) for i in range(self._children_count)])
+            values = self._field_values()
+            return dict([(self._children[i].name(), self._field_summary(i, values, internal_dict)) for i in range(self._children_count)])
+
+class ArrayLayout:
+    """Sequence of MemberLayout of array elements, which are made on demand rather than for every element."""
+    def __init__(self, type, offset, size, count):
+        self._type = type
+        self._offset = offset
+        self._size = size
+        self._count = count
+
+    def type(self):
+        return self._type
+
+    def offset(self, index):
+        return self._offset + index * self._size
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        return MemberLayout(str(index), self._type, self.offset(index))
 
 class KonanArraySyntheticProvider(KonanHelperProvider):
-    def __init__(self, valobj, internal_dict):
+    def __init__(self, valobj, tip, internal_dict):
+        self._memory = TargetMemory()
+        layout = _read_array_layout(valobj.unsigned, tip, self._memory)
         self._children_count = 0
         super(KonanArraySyntheticProvider, self).__init__(valobj, False, internal_dict)
         if self._ptr is None:
             return
         valobj.SetSyntheticChildrenGenerated(True)
-        type = self._field_type(0)
-        zerro_address = self._field_address(0)
-        first_address = self._field_address(1)
-        offset = zerro_address - valobj.unsigned
-        size = first_address - zerro_address
-        self._children = [MemberLayout(str(x), type, offset + x * size) for x in range(self.num_children())]
-        self._values = [self._read_value(i) for i in range(min(ARRAY_TO_STRING_LIMIT, self._children_count))]
-
+        # Pages are only read from memory if the array layout was recognized.
+        self._paged = layout is not None
+        if layout is None:
+            layout = self._backend.array_layout(valobj) or (0, RT_INVALID, 0, 0)
+        (self._children_count, type, offset, size) = layout
+        self._children = ArrayLayout(type, offset, size, self._children_count)
+        self._pages = {}
+        self._values = {}
+
+    def _page(self, index):
+        """Returns (raw bytes, decoded elements) of the page with ARRAY_PAGE_SIZE elements, read at once."""
+        if not self._paged:
+            return None
+        if index not in self._pages:
+            if len(self._pages) >= ARRAY_CACHED_PAGES:
+                del self._pages[next(iter(self._pages))]
+            start = index * ARRAY_PAGE_SIZE
+            count = min(ARRAY_PAGE_SIZE, self._children_count - start)
+            self._pages[index] = self._memory.read_array(
+                self._valobj.unsigned + self._children.offset(start), self._children.type(), count)
+        return self._pages[index]
+
+    def _create_element(self, index):
+        type = self._children.type()
+        page = self._page(index // ARRAY_PAGE_SIZE) if type != RT_OBJECT else None
+        if page is None:
+            return self._read_value(index)
+        size = page[1].itemsize
+        start = (index % ARRAY_PAGE_SIZE) * size
+        data = lldb.SBData()
+        data.SetData(lldb.SBError(), page[0][start:start + size], self._memory.byte_order, self._memory.pointer_size)
+        return self._valobj.CreateValueFromData(str(index), data, self._types[type])
 
     def cap_children_count(self):
         return self._children_count
@@ -353,120 +1338,704 @@ class KonanArraySyntheticProvider(KonanHelperProvider):
         return self._children_count > 0
 
     def get_child_index(self, name):
-        index = int(name)
+        try:
+            index = int(name.strip('[]'))
+        except ValueError:
+            return -1
         return index if (0 <= index < self._children_count) else -1
 
+    def update(self):
+        # Elements may have changed since the previous stop, the count can't.
+        self._pages = {}
+        self._values = {}
+        return False
+
     def get_child_at_index(self, index):
-        result = self._values[index]
+        if not 0 <= index < self._children_count:
+            return None
+        result = self._values.get(index)
         if result is None:
-            result = self._read_value(index)
+            with TIME_BUDGET:
+                result = self._create_element(index)
             self._values[index] = result
         return result
 
     def to_string(self):
-        return [self._deref_or_obj_summary(i, self._internal_dict.copy()) for i in range(min(ARRAY_TO_STRING_LIMIT, self._children_count))]
+        count = min(ARRAY_TO_STRING_LIMIT, self._children_count)
+        page = self._page(0) if count > 0 else None
+        if page is None:
+            return [self._deref_or_obj_summary(i, self._internal_dict.copy()) for i in range(count)]
+        if self._children.type() != RT_OBJECT:
+            return page[1][:count].tolist()
+        return [NULL if page[1][i] == 0 else self._deref_or_obj_summary(i, self._internal_dict.copy()) for i in range(count)]
 
 
 class KonanProxyTypeProvider:
     def __init__(self, valobj, internal_dict):
         log(lambda : "KonanProxyTypeProvider: {:#x}".format(valobj.unsigned))
-        tip = type_info(valobj)
+        self._valobj = valobj
+        self._internal_dict = internal_dict
+        self._key = None
+        self._type = '-'
+        self._proxy = lldb.SBSyntheticValueProvider(valobj)
+        self.update()
 
+    def update(self):
+        """lldb calls it whenever the value may have changed. The provider is only made anew if the value references
+        another object now, otherwise it just forgets the children it has made."""
+        tip = type_info(self._valobj)
+        key = (self._valobj.unsigned, tip)
+        if key == self._key:
+            return self._proxy.update()
+        self._key = key
         if not tip:
-            return
+            self._proxy = lldb.SBSyntheticValueProvider(self._valobj)
+            return False
         log(lambda : "KonanProxyTypeProvider: tip: {:#x}".format(tip))
-        self._proxy = select_provider(valobj, tip, internal_dict)
+        self._type = _type_info_name(tip)
+        with STATISTICS.scope('synthetic', 'select_provider', self._type) as scope:
+            self._proxy = select_provider(self._valobj, tip, self._internal_dict)
+            scope.provider = self._proxy.__class__.__name__
         log(lambda: "KonanProxyTypeProvider: _proxy: {}".format(self._proxy.__class__.__name__))
-        self.update()
+        return False
 
     def __getattr__(self, item):
-        return getattr(self._proxy, item)
+        attribute = getattr(self._proxy, item)
+        if not STATISTICS.enabled or not callable(attribute):
+            return attribute
+        def measured(*args):
+            with STATISTICS.scope('synthetic', self._proxy.__class__.__name__, self._type):
+                return attribute(*args)
+        return measured
 
 def clear_cache_command(debugger, command, result, internal_dict):
     SYNTHETIC_OBJECT_LAYOUT_CACHE.clear()
+    SUMMARY_CACHE.clear()
+    SYMBOL_INDEX_CACHE.clear()
+    TYPE_INFO_KINDS.clear()
+    BACKENDS['memory'].clear()
+    __BACKEND_OF_PROCESS[:] = [None, None]
+
+
+def string_preview_command(debugger, command, result, internal_dict):
+    global STRING_PREVIEW_LENGTH
+    tokens = command.split()
+    if tokens:
+        try:
+            STRING_PREVIEW_LENGTH = max(0, int(tokens[0], 0))
+        except ValueError:
+            result.SetError("usage: konan_string_preview [length]")
+            return
+    result.AppendMessage("{}".format(STRING_PREVIEW_LENGTH))
+
+
+def time_budget_command(debugger, command, result, internal_dict):
+    tokens = command.split()
+    if tokens:
+        try:
+            TIME_BUDGET.seconds = max(0.0, float(tokens[0]))
+        except ValueError:
+            result.SetError("usage: konan_time_budget [seconds, 0 for no limit]")
+            return
+    result.AppendMessage("{}".format(TIME_BUDGET.seconds))
+
+
+def backend_command(debugger, command, result, internal_dict):
+    global BACKEND_MODE
+    tokens = command.split()
+    if tokens:
+        if tokens[0] != 'auto' and tokens[0] not in BACKENDS:
+            result.SetError("usage: konan_backend [auto|expression|memory]")
+            return
+        BACKEND_MODE = tokens[0]
+    result.AppendMessage("{} ({})".format(BACKEND_MODE, _backend(debugger.GetSelectedTarget()).name))
+
+
+def string_command(debugger, command, result, internal_dict):
+    value = evaluate('(struct ObjHeader *)({})'.format(command))
+    if not value.IsValid() or value.unsigned == 0:
+        result.AppendMessage(NULL)
+        return
+    result.AppendMessage(KonanStringSyntheticProvider(value).full_text())
+
+
+def _stats_arguments(command):
+    parser = CommandArgumentParser(prog = 'konan_stats', add_help = False)
+    parser.add_argument('-k', '--keep', action = 'store_true', help = "don't reset statistics after printing")
+    parser.add_argument('-l', '--limit', type = int, default = 30, help = 'number of rows to print')
+    parser.add_argument('--enable', action = 'store_true', help = 'collect statistics')
+    parser.add_argument('--disable', action = 'store_true', help = 'stop collecting statistics')
+    parser.add_argument('--trace', choices = ['on', 'off'], help = 'keep every operation for the trace file')
+    parser.add_argument('-o', '--output', help = 'write collected operations to a Chrome trace file')
+    return parser.parse_command(command)
+
+def stats_command(debugger, command, result, internal_dict):
+    try:
+        arguments = _stats_arguments(command)
+    except ValueError as e:
+        result.SetError("{}\nusage: konan_stats [-k] [-l LIMIT] [--enable|--disable] [--trace on|off] [-o FILE]".format(e))
+        return
+    if arguments.enable or arguments.disable:
+        STATISTICS.enabled = arguments.enable
+    if arguments.trace:
+        STATISTICS.tracing = arguments.trace == 'on'
+    if arguments.output:
+        result.AppendMessage("{} events written to {}".format(STATISTICS.dump_trace(arguments.output), arguments.output))
+    if not STATISTICS.enabled:
+        result.AppendMessage("statistics are disabled, use konan_stats --enable")
+        return
+
+    rows = sorted(STATISTICS.timings.items(), key = lambda item: -item[1][1])
+    result.AppendMessage("{:<12} {:<32} {:<40} {:>8} {:>10} {:>8}".format(
+        "operation", "provider", "type", "count", "total ms", "avg ms"))
+    for ((kind, provider, type), (count, seconds)) in rows[:arguments.limit]:
+        result.AppendMessage("{:<12} {:<32} {:<40} {:>8} {:>10.1f} {:>8.2f}".format(
+            kind, provider, type, count, seconds * 1000, seconds * 1000 / count))
+    if len(rows) > arguments.limit:
+        result.AppendMessage("... {} more rows".format(len(rows) - arguments.limit))
+    for kind in ('evaluate', 'memory_read', 'summary', 'synthetic'):
+        count = sum(timing[0] for (key, timing) in STATISTICS.timings.items() if key[0] == kind)
+        seconds = sum(timing[1] for (key, timing) in STATISTICS.timings.items() if key[0] == kind)
+        result.AppendMessage("{}: {} in {:.1f} ms".format(kind, count, seconds * 1000))
+    for cache in ('layout_cache', 'summary_cache'):
+        result.AppendMessage("{}: {} hits, {} misses, {:.1f}% hit rate".format(cache, *STATISTICS.hit_rate(cache)))
+    if not arguments.keep:
+        STATISTICS.reset()
 
 
 def type_name_command(debugger, command, result, internal_dict):
-    result.AppendMessage(evaluate('(char *)Konan_DebugGetTypeName({})'.format(command)).summary)
+    result.AppendMessage(_backend().type_name(command))
 
 __KONAN_VARIABLE = re.compile('kvar:(.*)#internal')
-__KONAN_VARIABLE_TYPE = re.compile('^kfun:<get-(.*)>\\(\\)(.*)$')
+# Both `kfun:<get-NAME>()TYPE` and `kfun:PACKAGE#<get-NAME>(){}TYPE` manglings.
+__KONAN_VARIABLE_TYPE = re.compile('^kfun:(?:(.*)[.#])?<get-([^>]*)>\\(\\)(?:\\{\\})?(.*)$')
+# Kotlin type -> (C type of the getter result, extractor of the value from SBValue, struct format of the storage).
 __TYPES_KONAN_TO_C = {
-   'kotlin.Byte': ('int8_t', lambda v: v.signed),
-   'kotlin.Short': ('short', lambda v: v.signed),
-   'kotlin.Int': ('int', lambda v: v.signed),
-   'kotlin.Long': ('long', lambda v: v.signed),
-   'kotlin.UByte': ('int8_t', lambda v: v.unsigned),
-   'kotlin.UShort': ('short', lambda v: v.unsigned),
-   'kotlin.UInt': ('int', lambda v: v.unsigned),
-   'kotlin.ULong': ('long', lambda v: v.unsigned),
-   'kotlin.Char': ('short', lambda v: v.signed),
-   'kotlin.Boolean': ('bool', lambda v: v.signed),
-   'kotlin.Float': ('float', lambda v: v.value),
-   'kotlin.Double': ('double', lambda v: v.value)
+   'kotlin.Byte': ('int8_t', lambda v: v.signed, 'b'),
+   'kotlin.Short': ('short', lambda v: v.signed, 'h'),
+   'kotlin.Int': ('int', lambda v: v.signed, 'i'),
+   'kotlin.Long': ('long', lambda v: v.signed, 'q'),
+   'kotlin.UByte': ('int8_t', lambda v: v.unsigned, 'B'),
+   'kotlin.UShort': ('short', lambda v: v.unsigned, 'H'),
+   'kotlin.UInt': ('int', lambda v: v.unsigned, 'I'),
+   'kotlin.ULong': ('long', lambda v: v.unsigned, 'Q'),
+   'kotlin.Char': ('short', lambda v: v.signed, 'h'),
+   'kotlin.Boolean': ('bool', lambda v: v.signed, 'B'),
+   'kotlin.Float': ('float', lambda v: v.value, 'f'),
+   'kotlin.Double': ('double', lambda v: v.value, 'd')
 }
+__OBJECT_TO_C = ('struct ObjHeader *', lambda v: kotlin_object_type_summary(v), None)
+# Sections holding thread local storage templates, values there are not the ones of the current thread.
+__THREAD_LOCAL_SECTIONS = ('.tdata', '.tbss', '__thread_data', '__thread_bss', '__thread_vars')
+GLOBALS_PAGE_SIZE = 1000
+GLOBALS_BATCH_SIZE = 64
+GLOBALS_CHUNK_LIMIT = 0x10000
+
+def _kotlin_globals(index):
+    """Pairs `kvar:` storages with their getters in a single pass over the index, returns sorted
+    [(qualified name, package, Kotlin type, storage address, getter address)], computed once per module."""
+    if index.globals is None:
+        storages = {}
+        getters = {}
+        for (name, address) in index.items():
+            if not name.startswith('k'):
+                continue
+            match = __KONAN_VARIABLE.match(name)
+            if match:
+                storages[match.group(1)] = address
+                continue
+            match = __KONAN_VARIABLE_TYPE.match(name)
+            if match:
+                (package, property, type) = match.groups()
+                qualified = '{}.{}'.format(package, property) if package else property
+                getters[qualified] = (package or '', type, address)
+        globals = []
+        for (name, storage) in storages.items():
+            (package, type, getter) = getters.get(name, (name.rpartition('.')[0], None, None))
+            globals.append((name, package, type, storage, getter))
+        index.globals = sorted(globals)
+    return index.globals
+
+def _read_globals(memory, globals):
+    """Reads values of primitive globals straight from their storage, coalescing neighbouring storages into
+    single memory reads. Returns {qualified name: value}."""
+    values = {}
+    chunk = []
+    def flush():
+        if not chunk:
+            return
+        start = chunk[0][1]
+        end = max(address + struct.calcsize('<' + format) for (_, address, format) in chunk)
+        data = memory.read(start, end - start)
+        for (name, address, format) in chunk:
+            if data is not None:
+                values[name] = memory.unpack(format, data, address - start)[0]
+            else:
+                single = memory.read(address, struct.calcsize('<' + format))
+                if single is not None:
+                    values[name] = memory.unpack(format, single)[0]
+        del chunk[:]
+    for (name, address, format) in sorted(globals, key = lambda g: g[1]):
+        if chunk and address + 8 - chunk[0][1] > GLOBALS_CHUNK_LIMIT:
+            flush()
+        chunk.append((name, address, format))
+    flush()
+    return values
+
+def _evaluate_getters(c_type, getters):
+    """Calls getters returning `c_type` by batches of GLOBALS_BATCH_SIZE in a single expression each."""
+    results = []
+    for start in range(0, len(getters), GLOBALS_BATCH_SIZE):
+        batch = getters[start:start + GLOBALS_BATCH_SIZE]
+        calls = ['(({0} (*)()){1:#x})()'.format(c_type, address) for address in batch]
+        value = evaluate('({}[]){{{}}}'.format(c_type, ', '.join(calls))) if len(calls) > 1 else None
+        if value is not None and value.IsValid() and value.GetNumChildren() == len(calls):
+            results.extend(value.GetChildAtIndex(i) for i in range(len(calls)))
+        else:
+            results.extend(evaluate(call) for call in calls)
+    return results
+
+class CommandArgumentParser(argparse.ArgumentParser):
+    """Parser of lldb command arguments reporting errors with exceptions rather than exiting the interpreter."""
+    def error(self, message):
+        raise ValueError(message)
+
+    def parse_command(self, command):
+        return self.parse_args(shlex.split(command))
+
+def _globals_arguments(command):
+    parser = CommandArgumentParser(prog = 'konan_globals', add_help = False)
+    parser.add_argument('-p', '--package', help = 'only properties of the package and its subpackages')
+    parser.add_argument('-s', '--start', type = int, default = 0, help = 'index of the first property to show')
+    parser.add_argument('-c', '--count', type = int, default = GLOBALS_PAGE_SIZE, help = 'number of properties to show')
+    parser.add_argument('pattern', nargs = '?', help = 'regular expression to search in qualified names')
+    return parser.parse_command(command)
 
 def type_by_address_command(debugger, command, result, internal_dict):
     result.AppendMessage("DEBUG: {}".format(command))
     tokens = command.split()
-    target = debugger.GetSelectedTarget()
-    process = target.GetProcess()
-    thread = process.GetSelectedThread()
-    types = _type_info_by_address(tokens[0])
+    try:
+        address = int(tokens[0], 0)
+    except (IndexError, ValueError):
+        result.SetError("usage: type_by_address ADDRESS")
+        return
+    types = _type_info_by_address(address, debugger)
     result.AppendMessage("DEBUG: {}".format(types))
-    for t in types:
-        result.AppendMessage("{}: {:#x}".format(t.name, t.GetStartAddress().GetLoadAddress(target)))
+    for name in types:
+        result.AppendMessage("{}: {:#x}".format(name, address))
 
 def symbol_by_name_command(debugger, command, result, internal_dict):
     target = debugger.GetSelectedTarget()
-    process = target.GetProcess()
-    thread = process.GetSelectedThread()
-    frame = thread.GetSelectedFrame()
+    index = _symbol_index(_selected_module(target), target)
     tokens = command.split()
     mask = re.compile(tokens[0])
-    symbols = list(filter(lambda v: mask.match(v.name), frame.GetModule().symbols))
-    visited = list()
-    for symbol in symbols:
-       name = symbol.name
-       if name in visited:
-           continue
-       visited.append(name)
-       result.AppendMessage("{}: {:#x}".format(name, symbol.GetStartAddress().GetLoadAddress(target)))
+    for (name, address) in sorted(index.items()):
+       if mask.match(name):
+           result.AppendMessage("{}: {:#x}".format(name, address))
 
 def konan_globals_command(debugger, command, result, internal_dict):
+    try:
+        arguments = _globals_arguments(command)
+    except ValueError as e:
+        result.SetError("{}\nusage: konan_globals [-p PACKAGE] [-s START] [-c COUNT] [PATTERN]".format(e))
+        return
     target = debugger.GetSelectedTarget()
-    process = target.GetProcess()
-    thread = process.GetSelectedThread()
-    frame = thread.GetSelectedFrame()
-
-    konan_variable_symbols = list(filter(lambda v: __KONAN_VARIABLE.match(v.name), frame.GetModule().symbols))
-    visited = list()
-    for symbol in konan_variable_symbols:
-       name = __KONAN_VARIABLE.search(symbol.name).group(1)
-
-       if name in visited:
-           continue
-       visited.append(name)
-
-       getters = list(filter(lambda v: re.match('^kfun:<get-{}>\\(\\).*$'.format(name), v.name), frame.module.symbols))
-       if not getters:
-           result.AppendMessage("storage not found for name:{}".format(name))
-           continue
-
-       getter_functions = frame.module.FindFunctions(getters[0].name)
-       if not getter_functions:
-           continue
-
-       address = getter_functions[0].function.GetStartAddress().GetLoadAddress(target)
-       type = __KONAN_VARIABLE_TYPE.search(getters[0].name).group(2)
-       (c_type, extractor) = __TYPES_KONAN_TO_C[type] if type in __TYPES_KONAN_TO_C.keys() else ('struct ObjHeader *', lambda v: kotlin_object_type_summary(v))
-       value = evaluate('(({0} (*)()){1:#x})()'.format(c_type, address))
-       str_value = extractor(value)
-       result.AppendMessage('{} {}: {}'.format(type, name, str_value))
+    memory = TargetMemory(target)
+    globals = _kotlin_globals(_symbol_index(_selected_module(target), target))
+
+    if arguments.package:
+        globals = [g for g in globals if g[1] == arguments.package or g[1].startswith(arguments.package + '.')]
+    if arguments.pattern:
+        mask = re.compile(arguments.pattern)
+        globals = [g for g in globals if mask.search(g[0])]
+    page = globals[arguments.start:arguments.start + arguments.count]
+
+    # Primitives are read from the storage, the rest goes through (batched) getters, unless code can't be run.
+    backend = _backend(target)
+    direct = []
+    objects = []
+    getters = collections.defaultdict(list)
+    for (name, _, type, storage, getter) in page:
+        if type is None:
+            continue
+        section = target.ResolveLoadAddress(storage).GetSection()
+        thread_local = section.IsValid() and section.GetName() in __THREAD_LOCAL_SECTIONS
+        if type in __TYPES_KONAN_TO_C.keys() and not thread_local:
+            direct.append((name, storage, __TYPES_KONAN_TO_C[type][2]))
+            continue
+        if backend is BACKENDS['memory'] and not thread_local:
+            objects.append((name, storage, memory.pointer_format))
+            continue
+        (c_type, extractor, _) = __TYPES_KONAN_TO_C.get(type, __OBJECT_TO_C)
+        getters[c_type].append((name, getter, extractor))
+    values = _read_globals(memory, direct)
+    if objects:
+        object_type = target.FindFirstType('ObjHeader').GetPointerType()
+        for (name, address) in _read_globals(memory, objects).items():
+            data = lldb.SBData()
+            data.SetData(lldb.SBError(), struct.pack(memory.endian + memory.pointer_format, address),
+                         memory.byte_order, memory.pointer_size)
+            values[name] = kotlin_object_type_summary(target.CreateValueFromData(name, data, object_type))
+    for (c_type, batch) in getters.items():
+        results = backend.call_getters(c_type, [getter for (_, getter, _) in batch])
+        for ((name, _, extractor), value) in zip(batch, results or []):
+            values[name] = extractor(value)
+
+    for (name, _, type, _, _) in page:
+        if type is None:
+            result.AppendMessage("storage not found for name:{}".format(name))
+        elif name in values:
+            result.AppendMessage('{} {}: {}'.format(type, name, values[name]))
+        else:
+            result.AppendMessage('{} {}: <unavailable>'.format(type, name))
+    rest = len(globals) - arguments.start - len(page)
+    if rest > 0:
+        result.AppendMessage("... {} more, use --start {}".format(rest, arguments.start + len(page)))
+
+# Bytes read at once from the start of every object, enough for the header and fields of most objects.
+HEAP_READ_AHEAD = 64
+# Elements of object arrays are read by chunks of this many references.
+HEAP_ARRAY_CHUNK = 0x4000
+HEAP_MAX_OBJECTS = 1000000
+HEAP_TIME_LIMIT = 30.0
+HEAP_PROGRESS_INTERVAL = 2.0
+
+class HeapType:
+    """What the heap walk needs to know about a TypeInfo: instance size of objects (or element size of arrays)
+    and offsets of object references, taken from the cached layout or from TypeInfo::objOffsets_."""
+    def __init__(self, instance_size, element_size, references):
+        self.instance_size = instance_size
+        # Only set for arrays and strings.
+        self.element_size = element_size
+        # Offsets of reference fields, for arrays: whether elements are references.
+        self.references = references
+
+
+class HeapCensus:
+    """Breadth-first walk over objects reachable from roots, reading every object with as few memory reads as
+    possible, under a budget of visited objects and of time.
+
+    Objects are numbered in the order they are found, each one remembers the object it was found from, which
+    makes a spanning tree of the walked graph. Retained sizes are approximated with this tree rather than with
+    the dominator tree: an object shared by several others is retained by the one that reached it first."""
+    def __init__(self, memory, max_objects = HEAP_MAX_OBJECTS, time_limit = HEAP_TIME_LIMIT):
+        self._memory = memory
+        self._max_objects = max_objects
+        self._time_limit = time_limit
+        self._types = {}
+        self._ids = {}
+        self._addresses = []
+        self._parents = array.array('l')
+        self._tips = []
+        self._sizes = array.array('q')
+        self._next = 0
+        self.roots = 0
+        self.seconds = 0.0
+        # Why the walk stopped before visiting everything reachable, if it did.
+        self.stopped = None
+        header = 'QQIiQQi' if memory.pointer_size == 8 else 'IIIiIIi'
+        self._type_info_format = header
+        self._type_info_size = struct.calcsize('<' + header)
+
+    def add_root(self, address):
+        if address and address not in self._ids:
+            self.roots += 1
+            self._add(address, -1)
+
+    def _add(self, address, parent):
+        self._ids[address] = len(self._addresses)
+        self._addresses.append(address)
+        self._parents.append(parent)
+        self._tips.append(None)
+        self._sizes.append(0)
+
+    @property
+    def pending(self):
+        return len(self._addresses) - self._next
+
+    def _type(self, tip):
+        if tip in self._types:
+            return self._types[tip]
+        heap_type = None
+        data = self._memory.read(tip, self._type_info_size)
+        if data is not None:
+            (_, _, _, instance_size, _, offsets_address, offsets_count) = self._memory.unpack(self._type_info_format, data)
+            if instance_size < 0:
+                # kotlin.Array is the only array with objOffsetsCount_ set.
+                heap_type = HeapType(0, -instance_size, offsets_count > 0)
+            else:
+                layout = SYNTHETIC_OBJECT_LAYOUT_CACHE.get(tip)
+                if layout is not None:
+                    references = [member.offset() for member in layout if member.type() == RT_OBJECT]
+                else:
+                    offsets = self._memory.read(offsets_address, 4 * offsets_count) if offsets_count > 0 else b''
+                    references = list(self._memory.unpack('{}i'.format(offsets_count), offsets)) \
+                        if offsets is not None else []
+                heap_type = HeapType(instance_size, None, sorted(references))
+        self._types[tip] = heap_type
+        return heap_type
+
+    def _type_info(self, header):
+        header &= ~OBJECT_TAG_MASK
+        if self._types.get(header) is not None:
+            return header
+        tip = self._memory.read_pointer(header)
+        if not tip:
+            return None
+        if tip in self._types or self._memory.read_pointer(tip) == tip:
+            return tip
+        return None
+
+    def _visit(self, index):
+        """Reads the object `index`, returns addresses of objects it references."""
+        memory = self._memory
+        address = self._addresses[index]
+        chunk = memory.read(address, HEAP_READ_AHEAD) or memory.read(address, 2 * memory.pointer_size)
+        if chunk is None:
+            return []
+        tip = self._type_info(memory.unpack(memory.pointer_format, chunk)[0])
+        heap_type = self._type(tip) if tip else None
+        if heap_type is None:
+            return []
+        self._tips[index] = tip
+        if heap_type.element_size is None:
+            self._sizes[index] = heap_type.instance_size
+            if not heap_type.references:
+                return []
+            end = heap_type.references[-1] + memory.pointer_size
+            if end > len(chunk):
+                chunk = memory.read(address, end)
+                if chunk is None:
+                    return []
+            return [memory.unpack(memory.pointer_format, chunk, offset)[0] for offset in heap_type.references]
+
+        count = memory.unpack('I', chunk, memory.pointer_size)[0]
+        header_size = _align_up(memory.pointer_size + 4, memory.pointer_size)
+        offset = _align_up(header_size, min(heap_type.element_size, 16))
+        self._sizes[index] = _align_up(offset + count * heap_type.element_size, memory.pointer_size)
+        if not heap_type.references:
+            return []
+        references = []
+        for start in range(0, count, HEAP_ARRAY_CHUNK):
+            elements = memory.read_pointers(address + offset + start * memory.pointer_size,
+                                            min(HEAP_ARRAY_CHUNK, count - start))
+            if elements is None:
+                break
+            references.extend(elements)
+        return references
+
+    def walk(self, progress = None):
+        """Visits objects until none are left or the budget is exhausted, calls `progress(census)` now and then."""
+        start = time.time()
+        last_progress = start
+        while self._next < len(self._addresses):
+            index = self._next
+            self._next += 1
+            for reference in self._visit(index):
+                if reference and reference not in self._ids:
+                    # Objects found so far are still visited, references from them are not followed any more.
+                    if len(self._addresses) >= self._max_objects:
+                        self.stopped = 'object budget of {} exhausted'.format(self._max_objects)
+                        break
+                    self._add(reference, index)
+            if index & 0x3ff == 0:
+                now = time.time()
+                if now - start > self._time_limit:
+                    self.stopped = 'time budget of {}s exhausted'.format(self._time_limit)
+                    break
+                if progress is not None and now - last_progress > HEAP_PROGRESS_INTERVAL:
+                    last_progress = now
+                    self.seconds = now - start
+                    progress(self)
+        self.seconds = time.time() - start
+
+    def visited(self):
+        """(objects, bytes) visited so far."""
+        return (sum(1 for tip in self._tips if tip is not None), sum(self._sizes))
+
+    def census(self):
+        """{TypeInfo address: [count, shallow size, retained size]} of the visited objects."""
+        count = len(self._addresses)
+        retained = array.array('q', self._sizes)
+        # Children are always found after their parents.
+        for index in range(count - 1, -1, -1):
+            parent = self._parents[index]
+            if parent >= 0:
+                retained[parent] += retained[index]
+        first_child = array.array('l', [-1]) * count
+        next_sibling = array.array('l', [-1]) * count
+        for index in range(count - 1, -1, -1):
+            parent = self._parents[index]
+            if parent >= 0:
+                next_sibling[index] = first_child[parent]
+                first_child[parent] = index
+
+        result = collections.defaultdict(lambda: [0, 0, 0])
+        # Instances nested in instances of the same type are already accounted in the retained size of the outer one.
+        active = collections.Counter()
+        for root in range(count):
+            if self._parents[root] >= 0:
+                continue
+            stack = [root]
+            while stack:
+                index = stack.pop()
+                if index < 0:
+                    active[self._tips[~index]] -= 1
+                    continue
+                tip = self._tips[index]
+                if tip is not None:
+                    row = result[tip]
+                    row[0] += 1
+                    row[1] += self._sizes[index]
+                    if not active[tip]:
+                        row[2] += retained[index]
+                    active[tip] += 1
+                    stack.append(~index)
+                child = first_child[index]
+                while child >= 0:
+                    stack.append(child)
+                    child = next_sibling[child]
+        return result
+
+
+def _heap_roots(target, locals, globals):
+    """Addresses of objects referenced by the locals of the selected frame and by Kotlin globals."""
+    roots = []
+    if locals:
+        frame = target.GetProcess().GetSelectedThread().GetSelectedFrame()
+        for value in frame.GetVariables(True, True, False, True):
+            if value.GetTypeName() in ('ObjHeader *', 'struct ObjHeader *'):
+                roots.append(value.unsigned)
+    if globals:
+        memory = TargetMemory(target)
+        storages = []
+        for (name, _, type, storage, _) in _kotlin_globals(_symbol_index(_selected_module(target), target)):
+            if type is None or type in __TYPES_KONAN_TO_C.keys():
+                continue
+            section = target.ResolveLoadAddress(storage).GetSection()
+            if section.IsValid() and section.GetName() in __THREAD_LOCAL_SECTIONS:
+                continue
+            storages.append((name, storage, memory.pointer_format))
+        roots.extend(_read_globals(memory, storages).values())
+    return roots
+
+def _heap_arguments(command):
+    parser = CommandArgumentParser(prog = 'konan_heap', add_help = False)
+    parser.add_argument('-s', '--sort', choices = ['count', 'shallow', 'retained'], default = 'retained')
+    parser.add_argument('-c', '--count', type = int, default = 30, help = 'number of types to show')
+    parser.add_argument('-m', '--max-objects', type = int, default = HEAP_MAX_OBJECTS)
+    parser.add_argument('-t', '--time-limit', type = float, default = HEAP_TIME_LIMIT, help = 'seconds')
+    parser.add_argument('--no-locals', action = 'store_true', help = "don't start from locals of the selected frame")
+    parser.add_argument('--no-globals', action = 'store_true', help = "don't start from Kotlin globals")
+    return parser.parse_command(command)
+
+def _immediate_output(debugger, result):
+    """Makes messages appended to `result` show up while the command runs rather than once it has finished."""
+    try:
+        result.SetImmediateOutputFile(debugger.GetOutputFileHandle())
+    except (AttributeError, TypeError, NotImplementedError):
+        pass
+
+def heap_command(debugger, command, result, internal_dict):
+    try:
+        arguments = _heap_arguments(command)
+    except ValueError as e:
+        result.SetError("{}\nusage: konan_heap [-s count|shallow|retained] [-c COUNT] [-m MAX_OBJECTS] "
+                        "[-t TIME_LIMIT] [--no-locals] [--no-globals]".format(e))
+        return
+    target = debugger.GetSelectedTarget()
+    census = HeapCensus(TargetMemory(target), arguments.max_objects, arguments.time_limit)
+    for root in _heap_roots(target, not arguments.no_locals, not arguments.no_globals):
+        census.add_root(root)
+
+    _immediate_output(debugger, result)
+    def progress(census):
+        (objects, size) = census.visited()
+        result.AppendMessage("... {} objects, {} bytes, {} pending, {:.1f}s".format(
+            objects, size, census.pending, census.seconds))
+    census.walk(progress)
+
+    column = {'count': 0, 'shallow': 1, 'retained': 2}[arguments.sort]
+    rows = sorted(census.census().items(), key = lambda item: -item[1][column])
+    result.AppendMessage("{:>10} {:>14} {:>14}  {}".format('count', 'shallow', 'retained', 'type'))
+    for (tip, (count, shallow, retained)) in rows[:arguments.count]:
+        result.AppendMessage("{:>10} {:>14} {:>14}  {}".format(count, shallow, retained, _kotlin_class_name(tip, debugger)))
+    if len(rows) > arguments.count:
+        result.AppendMessage("... {} more types, use --count".format(len(rows) - arguments.count))
+    (objects, size) = census.visited()
+    result.AppendMessage("{} objects of {} types, {} bytes reachable from {} roots, walked in {:.1f}s".format(
+        objects, len(rows), size, census.roots, census.seconds))
+    if census.stopped:
+        missing = "{} found objects not visited".format(census.pending) if census.pending \
+            else "references from the last objects not followed"
+        result.AppendMessage("incomplete: {}, {}, see --max-objects and --time-limit".format(census.stopped, missing))
+
+BT_ALL_DEPTH = 1
+BT_ALL_SUMMARY_LIMIT = 200
+BT_ALL_MAX_FRAMES = 100
+BT_ALL_TIME_LIMIT = 60.0
+
+def _bt_all_arguments(command):
+    parser = CommandArgumentParser(prog = 'konan_bt_all', add_help = False)
+    parser.add_argument('-d', '--depth', type = int, default = BT_ALL_DEPTH, help = 'levels of nested objects shown')
+    parser.add_argument('-s', '--size', type = int, default = BT_ALL_SUMMARY_LIMIT, help = 'chars of a summary shown')
+    parser.add_argument('-f', '--frames', type = int, default = BT_ALL_MAX_FRAMES, help = 'frames shown per thread')
+    parser.add_argument('-t', '--time-limit', type = float, default = BT_ALL_TIME_LIMIT, help = 'seconds')
+    return parser.parse_command(command)
+
+def _local_summary(value, depth, size):
+    try:
+        if value.GetTypeName() in ('ObjHeader *', 'struct ObjHeader *'):
+            summary = NULL if value.unsigned == 0 else RenderContext().render(value, {'to_string_depth': depth})
+        else:
+            summary = value.GetValue()
+    except (DebuggerException, struct.error, AttributeError, TypeError, ValueError, IndexError, KeyError) as e:
+        # A local of a frame being set up or torn down may point anywhere, the rest of the backtrace is still shown.
+        summary = "<error: {}>".format(str(e) or type(e).__name__)
+    summary = str(summary)
+    return summary if len(summary) <= size else summary[:size] + '...'
+
+def bt_all_command(debugger, command, result, internal_dict):
+    """Backtraces of all threads with Kotlin locals. Symbols, layouts and summaries are shared by all frames,
+    so an object seen from many frames is only read once."""
+    try:
+        arguments = _bt_all_arguments(command)
+    except ValueError as e:
+        result.SetError("{}\nusage: konan_bt_all [-d DEPTH] [-s SIZE] [-f FRAMES] [-t TIME_LIMIT]".format(e))
+        return
+    process = debugger.GetSelectedTarget().GetProcess()
+    _immediate_output(debugger, result)
+    start = time.perf_counter()
+    skipped = 0
+    with TIME_BUDGET.suspended():
+        try:
+            for thread in process:
+                result.AppendMessage("thread #{}: tid = {:#x}, name = '{}'".format(
+                    thread.GetIndexID(), thread.GetThreadID(), thread.GetName()))
+                count = thread.GetNumFrames()
+                for index in range(min(count, arguments.frames)):
+                    frame = thread.GetFrameAtIndex(index)
+                    result.AppendMessage("  frame #{}: {:#018x} {}".format(index, frame.GetPC(), frame.GetFunctionName()))
+                    variables = frame.GetVariables(True, True, False, True)
+                    if not variables:
+                        continue
+                    if time.perf_counter() - start > arguments.time_limit:
+                        skipped += 1
+                        continue
+                    __FRAME_MODULE[0] = frame.GetModule()
+                    for value in variables:
+                        result.AppendMessage("    {} = {}".format(
+                            value.GetName(), _local_summary(value, arguments.depth, arguments.size)))
+                if count > arguments.frames:
+                    result.AppendMessage("  ... {} more frames, use --frames".format(count - arguments.frames))
+        finally:
+            __FRAME_MODULE[0] = None
+    if skipped:
+        result.AppendMessage("locals of {} frames not shown, see --time-limit".format(skipped))
 
 def __lldb_init_module(debugger, _):
     __FACTORY['object'] = lambda x, y, z: KonanObjectSyntheticProvider(x, y, z)
-    __FACTORY['array'] = lambda x, y, z: KonanArraySyntheticProvider(x, z)
+    __FACTORY['array'] = lambda x, y, z: KonanArraySyntheticProvider(x, y, z)
     __FACTORY['string'] = lambda x, y, _: KonanStringSyntheticProvider(x)
     debugger.HandleCommand('\
         type summary add \
@@ -485,6 +2054,14 @@ def __lldb_init_module(debugger, _):
     debugger.HandleCommand('type category enable Kotlin')
     debugger.HandleCommand('command script add -f {}.clear_cache_command clear_kotlin_cache'.format(__name__))
     debugger.HandleCommand('command script add -f {}.type_name_command type_name'.format(__name__))
+    debugger.HandleCommand('command script add -f {}.string_preview_command konan_string_preview'.format(__name__))
+    debugger.HandleCommand('command script add -f {}.string_command konan_string'.format(__name__))
+    debugger.HandleCommand('command script add -f {}.time_budget_command konan_time_budget'.format(__name__))
+    debugger.HandleCommand('command script add -f {}.backend_command konan_backend'.format(__name__))
     debugger.HandleCommand('command script add -f {}.type_by_address_command type_by_address'.format(__name__))
     debugger.HandleCommand('command script add -f {}.symbol_by_name_command symbol_by_name'.format(__name__))
+    debugger.HandleCommand('command script add -f {}.konan_globals_command konan_globals'.format(__name__))
+    debugger.HandleCommand('command script add -f {}.stats_command konan_stats'.format(__name__))
+    debugger.HandleCommand('command script add -f {}.heap_command konan_heap'.format(__name__))
+    debugger.HandleCommand('command script add -f {}.bt_all_command konan_bt_all'.format(__name__))
 
@@ -0,0 +1,397 @@
+#
+# Copyright 2010-2020 JetBrains s.r.o. Use of this source code is governed by the Apache 2.0 license
+# that can be found in the license/LICENSE.txt file.
+#
+
+"""Synthetic Kotlin/Native heap laid out as the runtime does it on a 64-bit little-endian target
+(see runtime/src/main/cpp/TypeInfo.h and Memory.h), together with an interpreter for the handful of
+expressions konan_lldb.py evaluates, which are answered the way Konan_Debug* functions would answer them."""
+
+import re
+import struct
+
+import lldb
+
+RT_OBJECT = 1
+RT_INT8 = 2
+RT_INT16 = 3
+RT_INT32 = 4
+RT_INT64 = 5
+RT_FLOAT32 = 6
+RT_FLOAT64 = 7
+RT_NATIVE_PTR = 8
+RT_BOOLEAN = 9
+
+_SIZES = {RT_OBJECT: 8, RT_INT8: 1, RT_INT16: 2, RT_INT32: 4, RT_INT64: 8, RT_FLOAT32: 4, RT_FLOAT64: 8,
+          RT_NATIVE_PTR: 8, RT_BOOLEAN: 1}
+_FORMATS = {RT_OBJECT: 'Q', RT_INT8: 'b', RT_INT16: 'h', RT_INT32: 'i', RT_INT64: 'q', RT_FLOAT32: 'f',
+            RT_FLOAT64: 'd', RT_NATIVE_PTR: 'Q', RT_BOOLEAN: 'B'}
+_C_TYPES = {RT_INT8: 'int8_t', RT_INT16: 'int16_t', RT_INT32: 'int32_t', RT_INT64: 'int64_t', RT_FLOAT32: 'float',
+            RT_FLOAT64: 'double', RT_BOOLEAN: 'bool', RT_NATIVE_PTR: 'void *'}
+_KOTLIN_TYPES = {RT_INT8: 'kotlin.Byte', RT_INT16: 'kotlin.Short', RT_INT32: 'kotlin.Int', RT_INT64: 'kotlin.Long',
+                 RT_FLOAT32: 'kotlin.Float', RT_FLOAT64: 'kotlin.Double', RT_BOOLEAN: 'kotlin.Boolean'}
+
+TYPE_INFO_SIZE = 128
+RELATIVE_NAME_OFFSET = 96
+PACKAGE_NAME_OFFSET = 88
+ARRAY_HEADER_SIZE = 16
+DEBUG_BUFFER_SIZE = 4096
+
+
+def _align(value, alignment):
+    return (value + alignment - 1) & ~(alignment - 1)
+
+
+class _MemoryFault(Exception):
+    pass
+
+
+class KotlinType(object):
+    def __init__(self, address, name, fields=None, element_type=None):
+        self.address = address
+        self.name = name
+        self.fields = fields or []
+        self.element_type = element_type
+        offset = 8
+        self.offsets = []
+        for (_, type) in self.fields:
+            offset = _align(offset, _SIZES[type])
+            self.offsets.append(offset)
+            offset += _SIZES[type]
+        self.instance_size = _align(offset, 8)
+
+    @property
+    def is_array(self):
+        return self.element_type is not None
+
+
+class Heap(object):
+    """Flat simulated address space; allocation is a bump pointer, so everything stays contiguous."""
+    module_base = 0x100000
+
+    def __init__(self, slide=0, extended_info=True):
+        # ASLR slide, file addresses of everything are `load address - slide`.
+        self.slide = slide
+        # Optimized builds have no ExtendedTypeInfo.
+        self.extended_info = extended_info
+        self.module_base = Heap.module_base + slide
+        self._memory = bytearray()
+        self._base = self.module_base
+        self.symbols = []
+        self.types = {}
+        self.objects = {}
+        self.globals = []
+        self.thread_locals = set()
+        self._string_type = None
+        self._debug_buffer = self._allocate(DEBUG_BUFFER_SIZE)
+        self._symbol('Konan_DebugBuffer', self._allocate(16))
+        self._string_type = self.define_array_type('kotlin.String', RT_INT16)
+        self._symbol('kclass:kotlin.String', self._string_type.address)
+
+    # Address space.
+
+    def _allocate(self, size, alignment=16):
+        start = _align(self._base + len(self._memory), alignment)
+        self._memory.extend(b'\0' * (start + size - self._base - len(self._memory)))
+        return start
+
+    def _symbol(self, name, address):
+        self.symbols.append((name, address))
+
+    def write(self, address, data):
+        offset = address - self._base
+        self._memory[offset:offset + len(data)] = data
+
+    def _pack(self, address, format, *values):
+        self.write(address, struct.pack('<' + format, *values))
+
+    def contains(self, address):
+        return self._base <= address < self._base + len(self._memory)
+
+    def read(self, address, size):
+        offset = address - self._base
+        if address < self._base or offset + size > len(self._memory) or size < 0:
+            return None
+        return bytes(self._memory[offset:offset + size])
+
+    def read_c_string(self, address, limit=0x1000):
+        offset = address - self._base
+        if address < self._base or offset >= len(self._memory):
+            return None
+        end = self._memory.find(b'\0', offset, offset + limit)
+        end = offset + limit - 1 if end < 0 else end
+        return self._memory[offset:end].decode('utf-8', 'replace')
+
+    def _pointer(self, address):
+        data = self.read(address, 8)
+        if data is None:
+            raise _MemoryFault(address)
+        return struct.unpack('<Q', data)[0]
+
+    def _c_string(self, string):
+        data = string.encode('utf-8') + b'\0'
+        address = self._allocate(len(data), 1)
+        self.write(address, data)
+        return address
+
+    # Types.
+
+    def _type_info(self, name, ext_count, offsets, types, names, instance_size, references):
+        """`references` are offsets of reference fields, TypeInfo::objOffsets_."""
+        address = self._allocate(TYPE_INFO_SIZE)
+        extended = self._allocate(48)
+        offsets_address = self._allocate(4 * len(offsets), 4) if offsets else 0
+        types_address = self._allocate(len(types), 1) if types else 0
+        names_address = self._allocate(8 * len(names), 8) if names else 0
+        for (i, offset) in enumerate(offsets):
+            self._pack(offsets_address + 4 * i, 'i', offset)
+        for (i, type) in enumerate(types):
+            self._pack(types_address + i, 'B', type)
+        for (i, field_name) in enumerate(names):
+            self._pack(names_address + 8 * i, 'Q', self._c_string(field_name))
+        self._pack(extended, 'i4xQQQi4xQ', ext_count, offsets_address, types_address, names_address, 13, 0)
+        references_address = self._allocate(4 * len(references), 4) if references else 0
+        for (i, offset) in enumerate(references):
+            self._pack(references_address + 4 * i, 'i', offset)
+        self._pack(address, 'QQIiQQi', address, extended if self.extended_info else 0, 0, instance_size, 0,
+                   references_address, len(references))
+        package, _, relative = name.rpartition('.')
+        if self._string_type is not None:
+            self._pack(address + RELATIVE_NAME_OFFSET, 'Q', self.string(relative))
+            if package:
+                self._pack(address + PACKAGE_NAME_OFFSET, 'Q', self.string(package))
+        self._symbol('kclass:' + name, address)
+        return address
+
+    def define_class(self, name, fields):
+        """`fields` is a list of (name, runtime type) pairs."""
+        type = KotlinType(None, name, fields)
+        type.address = self._type_info(name, len(fields), type.offsets, [t for (_, t) in fields],
+                                       [n for (n, _) in fields], type.instance_size,
+                                       [o for (o, (_, t)) in zip(type.offsets, fields) if t == RT_OBJECT])
+        self.types[type.address] = type
+        return type
+
+    def define_array_type(self, name, element_type):
+        type = KotlinType(None, name, element_type=element_type)
+        # kotlin.Array has a single (fake) reference offset to mark it as non-leaf.
+        type.address = self._type_info(name, -element_type, [], [], [], -_SIZES[element_type],
+                                       [0] if element_type == RT_OBJECT else [])
+        self.types[type.address] = type
+        return type
+
+    # Objects.
+
+    def _header(self, type, with_meta):
+        if not with_meta:
+            return type.address
+        meta = self._allocate(40)
+        self._pack(meta, 'Q', type.address)
+        # Lower bits of the header are reserved for memory management.
+        return meta | 0x2
+
+    def new_object(self, type, values=None, with_meta=False):
+        address = self._allocate(type.instance_size, 8)
+        self._pack(address, 'Q', self._header(type, with_meta))
+        self.objects[address] = type
+        for (name, value) in (values or {}).items():
+            self.set_field(address, name, value)
+        return address
+
+    def set_field(self, address, name, value):
+        type = self.objects[address]
+        index = [n for (n, _) in type.fields].index(name)
+        field_type = type.fields[index][1]
+        self._pack(address + type.offsets[index], _FORMATS[field_type], value)
+
+    def new_array(self, type, values):
+        size = _SIZES[type.element_type]
+        address = self._allocate(_align(ARRAY_HEADER_SIZE, size) + size * len(values), 8)
+        self._pack(address, 'QI', type.address, len(values))
+        data_start = address + _align(ARRAY_HEADER_SIZE, size)
+        format = _FORMATS[type.element_type]
+        if values:
+            self.write(data_start, struct.pack('<{}{}'.format(len(values), format), *values))
+        self.objects[address] = type
+        return address
+
+    def new_primitive_array(self, name, element_type, values):
+        type = self._array_type(name, element_type)
+        return self.new_array(type, values)
+
+    def _array_type(self, name, element_type):
+        for type in self.types.values():
+            if type.name == name:
+                return type
+        return self.define_array_type(name, element_type)
+
+    def string(self, text):
+        data = text.encode('utf-16-le')
+        address = self._allocate(ARRAY_HEADER_SIZE + len(data), 8)
+        self._pack(address, 'QI', self._string_type.address, len(data) // 2)
+        self.write(address + ARRAY_HEADER_SIZE, data)
+        self.objects[address] = self._string_type
+        return address
+
+    def define_global(self, package, name, type, value, kotlin_type=None, thread_local=False):
+        """Top level property with its storage (`kvar:`) and getter (`kfun:PACKAGE#<get-NAME>`) symbols."""
+        size = _SIZES[type]
+        storage = self._allocate(size, 8)
+        self._pack(storage, _FORMATS[type], value)
+        getter = self._allocate(16)
+        self._pack(getter, 'Q', storage)
+        qualified = '{}.{}'.format(package, name) if package else name
+        kotlin_type = kotlin_type or _KOTLIN_TYPES.get(type, 'kotlin.Any')
+        self._symbol('kvar:{}#internal'.format(qualified), storage)
+        self._symbol('kfun:{}#<get-{}>(){{}}{}'.format(package, name, kotlin_type), getter)
+        if thread_local:
+            self.thread_locals.add(storage)
+        self.globals.append((qualified, storage, type, getter))
+        return storage
+
+    def objects_of(self, type):
+        return [address for (address, t) in self.objects.items() if t is type]
+
+    # Introspection, used to implement expressions.
+
+    def type_of(self, address):
+        header = self._pointer(address) & ~0x3
+        return self.types.get(self._pointer(header))
+
+    def _element_offset(self, type, index):
+        size = _SIZES[type.element_type]
+        return _align(ARRAY_HEADER_SIZE, size) + index * size
+
+    def array_count(self, address):
+        return struct.unpack('<I', self.read(address + 8, 4))[0]
+
+    def string_value(self, address):
+        count = self.array_count(address)
+        return self.read(address + ARRAY_HEADER_SIZE, 2 * count).decode('utf-16-le')
+
+    def _field_count(self, address):
+        type = self.type_of(address)
+        return self.array_count(address) if type.is_array else len(type.fields)
+
+    def _field_type(self, address, index):
+        type = self.type_of(address)
+        if type.is_array:
+            return type.element_type
+        return type.fields[index][1] if 0 <= index < len(type.fields) else 0
+
+    def _field_address(self, address, index):
+        type = self.type_of(address)
+        if type.is_array:
+            return address + self._element_offset(type, index) if 0 <= index <= self.array_count(address) else 0
+        return address + type.offsets[index] if 0 <= index < len(type.fields) else 0
+
+    def _field_name(self, address, index):
+        type = self.type_of(address)
+        name = '' if type.is_array else type.fields[index][0]
+        return self._c_string(name)
+
+    def _to_string(self, address):
+        type = self.type_of(address)
+        if type is self._string_type:
+            return self.string_value(address)
+        return '{}@{:x}'.format(type.name.rpartition('.')[2], address)
+
+    def _to_utf8(self, address, buffer, size):
+        data = self._to_string(address).encode('utf-8')[:size - 1]
+        self.write(buffer, data + b'\0')
+        return len(data) + 1
+
+    def _type_name(self, address):
+        return self._c_string(self.type_of(address).name.rpartition('.')[2])
+
+    def _is_instance(self, address, type_info):
+        return self.type_of(address).address == type_info
+
+    def _call_getter(self, getter, c_type):
+        storage = self._pointer(getter)
+        global_type = [t for (_, s, t, _) in self.globals if s == storage][0]
+        return _FORMATS[global_type], storage
+
+    # Expressions.
+
+    _NUMBER = r'(0x[0-9a-fA-F]+|\d+)'
+    _OBJ = r'\(\(struct ObjHeader \*\) ' + _NUMBER + r'\)'
+
+    def evaluate(self, process, expression):
+        try:
+            return self._evaluate(process, expression)
+        except _MemoryFault:
+            return lldb.SBValue(process, '$', lldb._c_type('void *'))
+
+    def _evaluate(self, process, expression):
+        def value(name, type_name, number):
+            return lldb.SBValue(process, name, lldb._c_type(type_name), data=struct.pack(
+                '<' + ('Q' if type_name.endswith('*') else {'int': 'i', 'bool': '?'}.get(type_name, 'q')), number))
+
+        def number(text):
+            return int(text, 0)
+
+        expression = expression.strip().rstrip(';')
+        match = re.match(r'^\*\(void \*\*\)\(\(uintptr_t\)\(\*\(void\*\*\)' + self._NUMBER, expression)
+        if match:
+            address = number(match.group(1))
+            header = self._pointer(address) & ~0x3
+            type_info = self._pointer(header)
+            result = type_info if self._pointer(type_info) == type_info else 0
+            return value('$', 'void *', result)
+        match = re.match(r'^\(int\)IsInstance\(' + self._OBJ + r', ' + self._NUMBER + r'\) \? 1 : ', expression)
+        if match:
+            address = number(match.group(1))
+            if self._is_instance(address, number(match.group(2))):
+                return value('$', 'int', 1)
+            return value('$', 'int', 2 if self.type_of(address).is_array else 0)
+        match = re.match(r'^\(bool\)IsInstance\(' + self._OBJ + r', ' + self._NUMBER + r'\)$', expression)
+        if match:
+            return value('$', 'bool', self._is_instance(number(match.group(1)), number(match.group(2))))
+        match = re.match(r'^\(int\)Konan_DebugIsArray\(' + self._OBJ + r'\)$', expression)
+        if match:
+            return value('$', 'int', 1 if self.type_of(number(match.group(1))).is_array else 0)
+        match = re.match(r'^\(int\)Konan_DebugGetFieldCount\(' + self._OBJ + r'\)$', expression)
+        if match:
+            return value('$', 'int', self._field_count(number(match.group(1))))
+        match = re.match(r'^\(int\)Konan_DebugGetFieldType\(' + self._OBJ + r', ' + self._NUMBER + r'\)$', expression)
+        if match:
+            return value('$', 'int', self._field_type(number(match.group(1)), number(match.group(2))))
+        match = re.match(r'^\(void \*\)Konan_DebugGetFieldAddress\(' + self._OBJ + r', ' + self._NUMBER + r'\)$',
+                         expression)
+        if match:
+            return value('$', 'void *', self._field_address(number(match.group(1)), number(match.group(2))))
+        match = re.match(r'^\(void \*\)Konan_DebugGetFieldName\(' + self._OBJ + r', \(int\)' + self._NUMBER + r'\)$',
+                         expression)
+        if match:
+            return value('$', 'void *', self._field_name(number(match.group(1)), number(match.group(2))))
+        if expression == '(void *)Konan_DebugBuffer()':
+            return value('$', 'void *', self._debug_buffer)
+        if expression == '(int)Konan_DebugBufferSize()':
+            return value('$', 'int', DEBUG_BUFFER_SIZE)
+        match = re.match(r'^\(int\)Konan_DebugObjectToUtf8Array\(' + self._OBJ + r', \(void \*\)' + self._NUMBER +
+                         r', \(int\)(?:Konan_DebugBufferSize\(\)|' + self._NUMBER + r')\)$', expression)
+        if match:
+            size = number(match.group(3)) if match.group(3) else DEBUG_BUFFER_SIZE
+            return value('$', 'int', self._to_utf8(number(match.group(1)), number(match.group(2)), size))
+        match = re.match(r'^\(char \*\)Konan_DebugGetTypeName\((.*)\)$', expression)
+        if match:
+            argument = match.group(1)
+            inner = re.match(self._OBJ, argument)
+            address = number(inner.group(1) if inner else argument)
+            return value('$', 'char *', self._type_name(address))
+        match = re.match(r'^\((.*)\[\]\)\{(.*)\}$', expression)
+        if match:
+            calls = re.findall(r'\(\(.*? \(\*\)\(\)\)0x[0-9a-fA-F]+\)\(\)', match.group(2))
+            children = [self._evaluate(process, call) for call in calls]
+            return lldb.SBValue(process, '$', lldb._c_type(match.group(1) + ' *'), children=children)
+        match = re.match(r'^\(\((.*) \(\*\)\(\)\)' + self._NUMBER + r'\)\(\)$', expression)
+        if match:
+            (format, storage) = self._call_getter(number(match.group(2)), match.group(1))
+            type_name = match.group(1)
+            data = self.read(storage, struct.calcsize('<' + format))
+            return lldb.SBValue(process, '$', lldb._c_type(type_name), data=data)
+        match = re.match(r'^\((.*)\)\(?' + self._NUMBER + r'\)?$', expression)
+        if match:
+            return value('$', match.group(1), number(match.group(2)))
+        raise ValueError('Simulated lldb cannot evaluate: ' + expression)
@@ -0,0 +1,463 @@
+#!/usr/bin/env python3
+
+#
+# Copyright 2010-2020 JetBrains s.r.o. Use of this source code is governed by the Apache 2.0 license
+# that can be found in the license/LICENSE.txt file.
+#
+
+"""Benchmark and round trip regression suite for konan_lldb.py.
+
+Runs the real formatters against the simulated lldb module from this directory over synthetic heaps
+and reports, per scenario, how many expressions were evaluated and how many memory reads were made. Every
+scenario also states what the formatters are expected to show, so that round trips aren't saved at the cost
+of wrong summaries.
+Expression evaluation is what makes a real debugger slow (every one is compiled and run in the inferior),
+`--evaluation-latency` injects that cost so wall times get closer to a real session.
+
+    python3 konan_lldb_benchmark.py                      # print the report
+    python3 konan_lldb_benchmark.py --check              # exit with 1 if round trips exceed the baseline
+                                                         # or anything else than expected is shown
+    python3 konan_lldb_benchmark.py --update-baseline    # record the current round trips as the baseline
+"""
+
+import argparse
+import json
+import os
+import struct
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS = os.path.join(HERE, '..', '..', 'scripts')
+BASELINE = os.path.join(HERE, 'konan_lldb_benchmark.json')
+
+# Formatters must not see the layouts persisted by a developer's debugger sessions.
+os.environ['KONAN_DATA_DIR'] = tempfile.mkdtemp(prefix='konan_lldb_benchmark')
+sys.path[:0] = [HERE, SCRIPTS]
+
+import lldb
+import heap as H
+import konan_lldb
+
+konan_lldb.__lldb_init_module(lldb.debugger, {})
+
+# Counters compared against the baseline, wall time is too noisy for CI.
+CHECKED_COUNTERS = ('evaluations', 'memory_reads', 'symbol_scans')
+
+
+class Session(object):
+    """Simulated debugger stopped in a process whose memory is `heap`."""
+    def __init__(self, heap, threads=None, is_core=False):
+        self.heap = heap
+        self.debugger = lldb.debugger
+        self.target = self.debugger.attach(heap, threads, is_core)
+        self.process = self.target.GetProcess()
+        self.debugger.summary_function = konan_lldb.kotlin_object_type_summary
+        self.debugger.synthetic_class = konan_lldb.KonanProxyTypeProvider
+        konan_lldb.clear_cache_command(self.debugger, '', lldb.SBCommandReturnObject(), {})
+
+    def value(self, address, name='value'):
+        return lldb.SBValue(self.process, name, lldb.OBJ_HEADER_POINTER, data=struct.pack('<Q', address))
+
+    def summary(self, address):
+        return self.value(address).GetSummary()
+
+    def children(self, address, limit=None):
+        value = self.value(address)
+        count = value.GetNumChildren()
+        return [value.GetChildAtIndex(i) for i in range(count if limit is None else min(count, limit))]
+
+    def command(self, function, arguments=''):
+        result = lldb.SBCommandReturnObject()
+        function(self.debugger, arguments, result, {})
+        if not result.Succeeded():
+            raise RuntimeError(result.GetError())
+        return result.GetOutput()
+
+
+def _node_type(heap):
+    return heap.define_class('demo.Node', [('value', H.RT_INT32), ('next', H.RT_OBJECT), ('other', H.RT_OBJECT)])
+
+
+def point(heap):
+    """Variable view of a small object, the most common case: `frame variable p`."""
+    point = heap.define_class('demo.Point', [('x', H.RT_INT32), ('y', H.RT_INT32)])
+    address = heap.new_object(point, {'x': 1, 'y': 2})
+
+    def run(session):
+        return [session.summary(address)] + session.children(address)
+    return run, '\n'.join([
+        "{'x': 1, 'y': 2}",
+        'x = 1',
+        'y = 2'])
+
+
+def many_objects(heap):
+    """Same class seen many times, layouts are expected to be read once."""
+    holder = heap.define_class('demo.Holder', [('id', H.RT_INT64), ('ratio', H.RT_FLOAT64), ('flag', H.RT_BOOLEAN),
+                                               ('name', H.RT_OBJECT)])
+    addresses = [heap.new_object(holder, {'id': i, 'ratio': i / 2.0, 'flag': i % 2, 'name': heap.string('h' + str(i))})
+                 for i in range(200)]
+
+    def run(session):
+        return [session.summary(address) for address in addresses][::100]
+    return run, '\n'.join([
+        "{'id': 0, 'ratio': 0, 'flag': 0, 'name': 'h0'}",
+        "{'id': 100, 'ratio': 50, 'flag': 0, 'name': 'h100'}"])
+
+
+def deep_graph(heap):
+    """Linked list 1000 nodes long, expanded level by level like a user clicking through a variables view."""
+    node = _node_type(heap)
+    head = 0
+    for i in range(1000):
+        head = heap.new_object(node, {'value': i, 'next': head})
+
+    def run(session):
+        shown = [session.summary(head)]
+        value = session.value(head)
+        for _ in range(50):
+            value.GetSummary()
+            value = value.GetChildAtIndex(1)
+        return shown + [value]
+    return run, '\n'.join([
+        "{'value': 999, 'next': {'value': 998, 'next': '...', 'other': 'null'}, 'other': 'null'}",
+        "next = {'value': 949, 'next': {'value': 948, 'next': '...', 'other': 'null'}, 'other': 'null'}"])
+
+
+def wide_tree(heap):
+    """Binary tree 10 levels deep, summaries nest up to the default depth."""
+    node = _node_type(heap)
+
+    def tree(depth):
+        if depth == 0:
+            return 0
+        return heap.new_object(node, {'value': depth, 'next': tree(depth - 1), 'other': tree(depth - 1)})
+    root = tree(10)
+
+    def run(session):
+        shown = [session.summary(root)] + session.children(root)
+        for child in shown[1:]:
+            child.GetSummary()
+        return shown
+    return run, '\n'.join([
+        "{'value': 10, 'next': {'value': 9, 'next': '...', 'other': '...'}, "
+        "'other': {'value': 9, 'next': '...', 'other': '...'}}",
+        'value = 10',
+        "next = {'value': 9, 'next': {'value': 8, 'next': '...', 'other': '...'}, "
+        "'other': {'value': 8, 'next': '...', 'other': '...'}}",
+        "other = {'value': 9, 'next': {'value': 8, 'next': '...', 'other': '...'}, "
+        "'other': {'value': 8, 'next': '...', 'other': '...'}}"])
+
+
+def cycles(heap):
+    """Ring of nodes additionally pointing back to the first one, each node is summarized."""
+    node = _node_type(heap)
+    nodes = [heap.new_object(node, {'value': i}) for i in range(300)]
+    for (i, address) in enumerate(nodes):
+        heap.set_field(address, 'next', nodes[(i + 1) % len(nodes)])
+        heap.set_field(address, 'other', nodes[0])
+
+    def run(session):
+        return [session.summary(address) for address in nodes][::150]
+    return run, '\n'.join([
+        "{'value': 0, 'next': {'value': 1, 'next': '...', 'other': '<cycle 0x1011e8>'}, 'other': '<cycle 0x1011e8>'}",
+        "{'value': 150, 'next': {'value': 151, 'next': '...', 'other': '...'}, "
+        "'other': {'value': 0, 'next': '...', 'other': '<cycle 0x1011e8>'}}"])
+
+
+def huge_primitive_array(heap):
+    """IntArray of a million elements, summary plus elements from its start, middle and end."""
+    address = heap.new_primitive_array('kotlin.IntArray', H.RT_INT32, list(range(1000000)))
+
+    def run(session):
+        shown = [session.summary(address)]
+        value = session.value(address)
+        count = value.GetNumChildren()
+        for index in list(range(100)) + list(range(count // 2, count // 2 + 100)) + list(range(count - 100, count)):
+            shown.append(value.GetChildAtIndex(index))
+            shown[-1].GetValue()
+        return shown[:2] + shown[-1:]
+    return run, '\n'.join([
+        '[0, 1, 2, 3, 4, 5, 6, 7, 8, 9]',
+        '0 = 0',
+        '999999 = 999999'])
+
+
+def huge_object_array(heap):
+    """Array of 10000 objects, summary plus the first page of elements with their summaries."""
+    point = heap.define_class('demo.Point', [('x', H.RT_INT32), ('y', H.RT_INT32)])
+    array = heap.define_array_type('kotlin.Array', H.RT_OBJECT)
+    address = heap.new_array(array, [heap.new_object(point, {'x': i, 'y': -i}) for i in range(10000)])
+
+    def run(session):
+        shown = [session.summary(address)] + session.children(address, 100)
+        for child in shown[1:]:
+            child.GetSummary()
+        return shown[:2] + shown[-1:]
+    return run, '\n'.join([
+        "[{'x': 0, 'y': 0}, {'x': 1, 'y': -1}, {'x': 2, 'y': -2}, {'x': 3, 'y': -3}, {'x': 4, 'y': -4}, "
+        "{'x': 5, 'y': -5}, {'x': 6, 'y': -6}, {'x': 7, 'y': -7}, {'x': 8, 'y': -8}, {'x': 9, 'y': -9}]",
+        "0 = {'x': 0, 'y': 0}",
+        "99 = {'x': 99, 'y': -99}"])
+
+
+def many_strings(heap):
+    """Array of 2000 strings of different lengths, some of them far longer than the preview."""
+    array = heap.define_array_type('kotlin.Array', H.RT_OBJECT)
+    strings = [heap.string(u'string ❤ {} '.format(i) * (1 + i % 50)) for i in range(2000)]
+    address = heap.new_array(array, strings)
+
+    def run(session):
+        session.summary(address)
+        shown = [session.summary(string) for string in strings][:3:2]
+        # The longest string is printed in full, only its length is compared.
+        return shown + [len(session.command(konan_lldb.string_command, str(strings[-1])))]
+    return run, '\n'.join([
+        u'string ❤ 0 ',
+        u'string ❤ 2 string ❤ 2 string ❤ 2 ',
+        '701'])
+
+
+def resumes(heap):
+    """The same variables inspected over 20 stops, summaries must not leak between stops."""
+    node = _node_type(heap)
+    nodes = [heap.new_object(node, {'value': i}) for i in range(20)]
+    for (i, address) in enumerate(nodes[1:]):
+        heap.set_field(address, 'next', nodes[i])
+
+    def run(session):
+        shown = []
+        for _ in range(20):
+            shown = [session.summary(address) for address in nodes]
+            session.process.resume()
+        return shown[-1:]
+    return run, "{'value': 19, 'next': {'value': 18, 'next': '...', 'other': 'null'}, 'other': 'null'}"
+
+
+def globals(heap):
+    """konan_globals over 2000 top level properties, filtered and paged."""
+    for i in range(2000):
+        heap.define_global('demo.p{}'.format(i % 10), 'v{}'.format(i), H.RT_INT32 if i % 2 else H.RT_FLOAT64, i)
+
+    def run(session):
+        shown = session.command(konan_lldb.konan_globals_command).splitlines()[:2]
+        return shown + session.command(konan_lldb.konan_globals_command, '-p demo.p3 -c 50').splitlines()[-2:]
+    return run, '\n'.join([
+        'kotlin.Double demo.p0.v0: 0.0',
+        'kotlin.Double demo.p0.v10: 10.0',
+        'kotlin.Int demo.p3.v1433: 1433',
+        '... 150 more, use --start 50'])
+
+
+def heap_census(heap):
+    """konan_heap over 50000 objects reachable from a local and from a global."""
+    node = _node_type(heap)
+    array = heap.define_array_type('kotlin.Array', H.RT_OBJECT)
+    nodes = [heap.new_object(node, {'value': i}) for i in range(40000)]
+    for (i, address) in enumerate(nodes[1:]):
+        heap.set_field(address, 'next', nodes[i])
+        heap.set_field(address, 'other', nodes[i // 2])
+    strings = heap.new_array(array, [heap.string('s' + str(i)) for i in range(10000)])
+    heap.define_global('demo', 'strings', H.RT_OBJECT, strings, 'kotlin.Array<kotlin.String>')
+
+    def run(session):
+        return session.command(konan_lldb.heap_command).splitlines()[:4]
+    return run, '\n'.join([
+        '     count        shallow       retained  type',
+        '     40000        1280000        1280000  demo.Node',
+        '         1          80016         392016  kotlin.Array',
+        '     10000         312000         312000  kotlin.String']), {'threads': [[('main', [('last', nodes[-1])])]]}
+
+
+def threads_dump(heap):
+    """konan_bt_all over 200 threads of 5 frames, workers share most of the objects their locals refer to."""
+    node = _node_type(heap)
+    task = heap.define_class('demo.Task', [('id', H.RT_INT32), ('name', H.RT_OBJECT), ('queue', H.RT_OBJECT)])
+    queue = heap.new_object(node, {'value': -1, 'next': heap.new_object(node, {'value': -2})})
+    threads = []
+    for i in range(200):
+        current = heap.new_object(task, {'id': i, 'name': heap.string('task ' + str(i)), 'queue': queue})
+        frames = [('demo.Worker.run', [('task', current), ('queue', queue), ('attempt', 'int', i % 3)])]
+        frames += [('demo.Worker.loop', [('queue', queue)])] * 3
+        frames.append(('start_thread', []))
+        threads.append(frames)
+
+    def run(session):
+        return session.command(konan_lldb.bt_all_command).splitlines()[:6]
+    return run, '\n'.join([
+        "thread #1: tid = 0x1, name = 'thread-1'",
+        '  frame #0: 0x0000000000001000 demo.Worker.run',
+        "    task = {'id': 0, 'name': 'task 0', 'queue': '...'}",
+        "    queue = {'value': -1, 'next': '...', 'other': 'null'}",
+        '    attempt = 0',
+        '  frame #1: 0x0000000000001001 demo.Worker.loop']), {'threads': threads}
+
+
+def _mixed_heap(heap):
+    point = heap.define_class('demo.Point', [('x', H.RT_INT32), ('y', H.RT_FLOAT64)])
+    holder = heap.define_class('demo.Holder', [('point', H.RT_OBJECT), ('name', H.RT_OBJECT), ('ints', H.RT_OBJECT)])
+    array = heap.define_array_type('kotlin.Array', H.RT_OBJECT)
+    holders = [heap.new_object(holder, {'point': heap.new_object(point, {'x': i, 'y': i / 4.0}),
+                                        'name': heap.string('holder ' + str(i)),
+                                        'ints': heap.new_primitive_array('kotlin.IntArray', H.RT_INT32, [i] * 20)})
+               for i in range(100)]
+    root = heap.new_array(array, holders)
+    heap.define_global('demo', 'holders', H.RT_OBJECT, root, 'kotlin.Array<demo.Holder>')
+    heap.define_global('demo', 'count', H.RT_INT32, len(holders))
+    return root
+
+def _inspect_mixed_heap(session, root):
+    shown = [session.summary(root)]
+    for child in session.children(root, 20):
+        child.GetSummary()
+        for field in child.GetChildAtIndex(0), child.GetChildAtIndex(2):
+            field.GetSummary()
+            shown.append(field)
+    return shown[1:3] + session.command(konan_lldb.konan_globals_command).splitlines()[:1]
+
+
+def core_file(heap):
+    """Objects, strings and arrays of a core file, where no expression can be evaluated."""
+    root = _mixed_heap(heap)
+    expected = '\n'.join([
+        "point = {'x': 0, 'y': 0}",
+        'ints = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0]',
+        'kotlin.Int demo.count: 100'])
+    return (lambda session: _inspect_mixed_heap(session, root)), expected, {'is_core': True}
+
+
+def core_file_optimized(heap):
+    """Core file of an optimized build, TypeInfos have no extended info and fields have no names."""
+    heap.extended_info = False
+    root = _mixed_heap(heap)
+    expected = '\n'.join([
+        'field@8 = {}',
+        'field@24 = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0]',
+        'kotlin.Int demo.count: 100'])
+    return (lambda session: _inspect_mixed_heap(session, root)), expected, {'is_core': True}
+
+
+SCENARIOS = [point, many_objects, deep_graph, wide_tree, cycles, huge_primitive_array, huge_object_array,
+             many_strings, resumes, globals, heap_census, threads_dump, core_file, core_file_optimized]
+
+
+def _shown(items):
+    """Text of what a run has shown: summaries and command output as they are, values the way a variables view shows
+    them. Read after the counters are taken, so that dereferencing primitive fields isn't counted."""
+    lines = []
+    for item in items:
+        if isinstance(item, lldb.SBValue):
+            summary = item.GetSummary()
+            if summary is None and item.GetType().IsPointerType():
+                summary = item.Dereference().GetValue()
+            item = '{} = {}'.format(item.GetName(), summary if summary is not None else item.GetValue())
+        lines.append(str(item))
+    return '\n'.join(lines)
+
+
+def run_scenario(scenario, repeat):
+    heap = H.Heap()
+    # Scenarios return their run, what it is expected to show and optionally arguments of the session, such as threads
+    # of the process.
+    (run, expected, options) = (scenario(heap) + ({},))[:3]
+    session = Session(heap, **options)
+    lldb.counters.reset()
+    start = time.perf_counter()
+    shown = run(session)
+    result = lldb.counters.snapshot()
+    result['seconds'] = time.perf_counter() - start
+    result['shown'] = [_shown(shown)]
+    # Warm runs reuse the layouts and symbols the first run has read, but not the per-stop summaries.
+    for _ in range(repeat - 1):
+        session.process.resume()
+        start = time.perf_counter()
+        shown = run(session)
+        result['seconds'] = min(result['seconds'], time.perf_counter() - start)
+        result['shown'].append(_shown(shown))
+    result['expected'] = expected
+    return result
+
+
+def _arguments():
+    parser = argparse.ArgumentParser(description='Round trips and timings of konan_lldb.py formatters.')
+    parser.add_argument('scenarios', nargs='*', help='scenarios to run, all by default: ' +
+                        ', '.join(scenario.__name__ for scenario in SCENARIOS))
+    parser.add_argument('--evaluation-latency', type=float, default=0.0, metavar='MS',
+                        help='milliseconds added to every expression evaluation')
+    parser.add_argument('--memory-latency', type=float, default=0.0, metavar='MS',
+                        help='milliseconds added to every memory read')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per scenario, the fastest one is reported')
+    parser.add_argument('--json', metavar='FILE', help='also write the results to FILE')
+    parser.add_argument('--check', action='store_true',
+                        help='fail if any scenario exceeds its baseline or shows anything else than expected')
+    parser.add_argument('--update-baseline', action='store_true', help='record the results as the new baseline')
+    parser.add_argument('--baseline', default=BASELINE, help='baseline file, default: %(default)s')
+    return parser.parse_args()
+
+
+def _load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+
+def _regressions(results, baseline):
+    regressions = []
+    for (name, result) in results.items():
+        for (run, shown) in enumerate(result['shown']):
+            if shown != result['expected']:
+                regressions.append('{}: run {} has shown\n{}\ninstead of\n{}'.format(
+                    name, run + 1, shown, result['expected']))
+        for counter in CHECKED_COUNTERS:
+            limit = baseline.get(name, {}).get(counter)
+            if limit is not None and result[counter] > limit:
+                regressions.append('{}: {} {} > {} in the baseline'.format(name, counter, result[counter], limit))
+    return regressions
+
+
+def main():
+    arguments = _arguments()
+    scenarios = [s for s in SCENARIOS if not arguments.scenarios or s.__name__ in arguments.scenarios]
+    unknown = set(arguments.scenarios) - set(s.__name__ for s in SCENARIOS)
+    if unknown:
+        print('unknown scenarios: ' + ', '.join(sorted(unknown)), file=sys.stderr)
+        return 2
+    lldb.evaluation_latency = arguments.evaluation_latency / 1000.0
+    lldb.memory_read_latency = arguments.memory_latency / 1000.0
+
+    baseline = _load_baseline(arguments.baseline)
+    results = {}
+    print('{:<22} {:>12} {:>12} {:>12} {:>12} {:>10} {:>10}'.format(
+        'scenario', 'evaluations', 'mem reads', 'bytes read', 'sym scans', 'ms', 'baseline'))
+    for scenario in scenarios:
+        result = run_scenario(scenario, arguments.repeat)
+        results[scenario.__name__] = result
+        expected = baseline.get(scenario.__name__, {})
+        print('{:<22} {:>12} {:>12} {:>12} {:>12} {:>10.1f} {:>10}'.format(
+            scenario.__name__, result['evaluations'], result['memory_reads'], result['bytes_read'],
+            result['symbol_scans'], result['seconds'] * 1000,
+            '{}/{}'.format(expected.get('evaluations', '-'), expected.get('memory_reads', '-')) if expected else '-'))
+
+    if arguments.json:
+        with open(arguments.json, 'w') as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+    if arguments.update_baseline:
+        for (name, result) in results.items():
+            baseline[name] = dict((counter, result[counter]) for counter in CHECKED_COUNTERS)
+        with open(arguments.baseline, 'w') as file:
+            json.dump(baseline, file, indent=2, sort_keys=True)
+            file.write('\n')
+        print('baseline updated: ' + arguments.baseline)
+    if arguments.check:
+        regressions = _regressions(results, baseline)
+        for regression in regressions:
+            print('REGRESSION ' + regression, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,858 @@
+#
+# Copyright 2010-2020 JetBrains s.r.o. Use of this source code is governed by the Apache 2.0 license
+# that can be found in the license/LICENSE.txt file.
+#
+
+"""Stand-in for the `lldb` Python module, simulating the subset of the SB API used by konan_lldb.py
+over a synthetic Kotlin/Native heap (see heap.py). It only needs the standard library, so formatters
+can be exercised and measured on a box without lldb and without compiled Kotlin/Native binaries."""
+
+import hashlib
+import itertools
+import re
+import struct
+import time
+
+eByteOrderInvalid = 0
+eByteOrderBig = 1
+eByteOrderPDP = 2
+eByteOrderLittle = 4
+
+eBasicTypeInvalid = 0
+eBasicTypeVoid = 1
+eBasicTypeChar = 2
+eBasicTypeShort = 8
+eBasicTypeInt = 12
+eBasicTypeLongLong = 16
+eBasicTypeFloat = 22
+eBasicTypeDouble = 23
+eBasicTypeBool = 20
+
+eStateStopped = 5
+eStateRunning = 6
+
+eStopReasonNone = 1
+eStopReasonBreakpoint = 3
+
+SBProcess_eBroadcastBitStateChanged = 1
+
+
+class Counters(object):
+    """Round trips performed through the simulated SB API."""
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.evaluations = 0
+        self.memory_reads = 0
+        self.bytes_read = 0
+        self.values_created = 0
+        self.symbol_scans = 0
+
+    def snapshot(self):
+        return {
+            'symbol_scans': self.symbol_scans,
+            'evaluations': self.evaluations,
+            'memory_reads': self.memory_reads,
+            'bytes_read': self.bytes_read,
+            'values_created': self.values_created,
+        }
+
+
+counters = Counters()
+# Seconds spent by every simulated expression evaluation, models JIT compilation and the call into the inferior.
+evaluation_latency = 0.0
+# Seconds spent by every simulated memory read.
+memory_read_latency = 0.0
+
+
+def _sleep(seconds):
+    if seconds > 0:
+        time.sleep(seconds)
+
+
+class SBError(object):
+    def __init__(self):
+        self._success = True
+        self._message = None
+
+    def Success(self):
+        return self._success
+
+    def Fail(self):
+        return not self._success
+
+    def SetErrorString(self, message):
+        self._success = False
+        self._message = message
+
+    def GetCString(self):
+        return self._message
+
+    def __str__(self):
+        return self._message or 'success'
+
+
+class SBExpressionOptions(object):
+    pass
+
+
+class SBSyntheticValueProvider(object):
+    def __init__(self, valobj=None):
+        pass
+
+    def num_children(self):
+        return 0
+
+    def get_child_index(self, name):
+        return None
+
+    def get_child_at_index(self, index):
+        return None
+
+    def update(self):
+        pass
+
+    def has_children(self):
+        return False
+
+
+class SBType(object):
+    def __init__(self, name, size, pointee=None):
+        self._name = name
+        self._size = size
+        self._pointee = pointee
+
+    def GetName(self):
+        return self._name
+
+    def GetByteSize(self):
+        return self._size
+
+    def IsPointerType(self):
+        return self._pointee is not None
+
+    def GetPointeeType(self):
+        return self._pointee
+
+    def GetPointerType(self):
+        return SBType(self._name + ' *', 8, self)
+
+    def GetBasicType(self, basic_type):
+        return _BASIC_TYPES[basic_type]
+
+    def __str__(self):
+        return 'struct ObjHeader *' if self._name == 'ObjHeader *' else self._name
+
+    def __eq__(self, other):
+        return isinstance(other, SBType) and other._name == self._name
+
+    def __hash__(self):
+        return hash(self._name)
+
+
+_BASIC_TYPES = {
+    eBasicTypeVoid: SBType('void', 0),
+    eBasicTypeChar: SBType('char', 1),
+    eBasicTypeShort: SBType('short', 2),
+    eBasicTypeInt: SBType('int', 4),
+    eBasicTypeLongLong: SBType('long long', 8),
+    eBasicTypeFloat: SBType('float', 4),
+    eBasicTypeDouble: SBType('double', 8),
+    eBasicTypeBool: SBType('bool', 1),
+}
+_OBJ_HEADER = SBType('ObjHeader', 16)
+OBJ_HEADER_POINTER = SBType('ObjHeader *', 8, _OBJ_HEADER)
+_C_TYPES = {
+    'void *': SBType('void *', 8, _BASIC_TYPES[eBasicTypeVoid]),
+    'int8_t': SBType('int8_t', 1),
+    'int16_t': SBType('int16_t', 2),
+    'int32_t': SBType('int32_t', 4),
+    'int64_t': SBType('int64_t', 8),
+    'float': _BASIC_TYPES[eBasicTypeFloat],
+    'double': _BASIC_TYPES[eBasicTypeDouble],
+    'bool': _BASIC_TYPES[eBasicTypeBool],
+    'char': _BASIC_TYPES[eBasicTypeChar],
+    'short': _BASIC_TYPES[eBasicTypeShort],
+    'int': _BASIC_TYPES[eBasicTypeInt],
+    'long': SBType('long', 8),
+    'long long': _BASIC_TYPES[eBasicTypeLongLong],
+    'void **': SBType('void **', 8, SBType('void *', 8, _BASIC_TYPES[eBasicTypeVoid])),
+}
+_SCALAR_FORMATS = {1: 'b', 2: 'h', 4: 'i', 8: 'q'}
+
+
+def _c_type(name):
+    name = name.strip()
+    if name in ('struct ObjHeader *', 'ObjHeader *'):
+        return OBJ_HEADER_POINTER
+    if name in _C_TYPES:
+        return _C_TYPES[name]
+    if name.endswith('*'):
+        pointee = _c_type(name[:-1])
+        return SBType(pointee.GetName() + ' *', 8, pointee)
+    raise ValueError('unknown C type: ' + name)
+
+
+class SBData(object):
+    def __init__(self):
+        self._bytes = b''
+
+    def SetData(self, error, data, byte_order, address_size):
+        self._bytes = bytes(data)
+
+    def GetByteSize(self):
+        return len(self._bytes)
+
+
+class SBValue(object):
+    """Either a value stored in the simulated memory at `address`, or a constant held in `data`."""
+    def __init__(self, process, name, type, address=None, data=None, children=None):
+        counters.values_created += 1
+        self._process = process
+        self.name = name
+        self._type = type
+        self._address = address
+        self._data = data if children is None else b''
+        self._children = children
+        self._synthetic = None
+
+    def _bytes(self):
+        if self._data is not None:
+            return self._data
+        if self._address is None:
+            return None
+        return self._process.heap.read(self._address, self._type.GetByteSize())
+
+    def IsValid(self):
+        return self._bytes() is not None
+
+    def GetName(self):
+        return self.name
+
+    def GetType(self):
+        return self._type
+
+    @property
+    def type(self):
+        return self._type
+
+    def GetTypeName(self):
+        return self._type.GetName()
+
+    def GetLoadAddress(self):
+        return self._address if self._address is not None else 0xffffffffffffffff
+
+    def _scalar(self, signed):
+        data = self._bytes()
+        if data is None:
+            return 0
+        name = self._type.GetName()
+        if name == 'float':
+            return struct.unpack('<f', data)[0]
+        if name == 'double':
+            return struct.unpack('<d', data)[0]
+        if self._type.IsPointerType():
+            return struct.unpack('<Q', data)[0]
+        format = _SCALAR_FORMATS[len(data)]
+        return struct.unpack('<' + (format if signed else format.upper()), data)[0]
+
+    def GetValueAsUnsigned(self, default=0):
+        value = self._scalar(False)
+        return int(value) if value is not None else default
+
+    def GetValueAsSigned(self, default=0):
+        value = self._scalar(True)
+        return int(value) if value is not None else default
+
+    @property
+    def unsigned(self):
+        return self.GetValueAsUnsigned()
+
+    @property
+    def signed(self):
+        return self.GetValueAsSigned()
+
+    def GetValue(self):
+        if self._bytes() is None:
+            return None
+        if self._type.IsPointerType():
+            return '0x{:016x}'.format(self.unsigned)
+        if self._type.GetName() == 'bool':
+            return 'true' if self.unsigned else 'false'
+        return str(self._scalar(True))
+
+    @property
+    def value(self):
+        return self.GetValue()
+
+    def GetSummary(self):
+        if self._type == OBJ_HEADER_POINTER:
+            return self._process.target.debugger.summary(self)
+        if self._type.GetName() == 'char *':
+            return '"{}"'.format(self._process.heap.read_c_string(self.unsigned))
+        return None
+
+    @property
+    def summary(self):
+        return self.GetSummary()
+
+    def Dereference(self):
+        return SBValue(self._process, '*' + str(self.name), self._type.GetPointeeType(), address=self.unsigned)
+
+    @property
+    def deref(self):
+        return self.Dereference()
+
+    def CreateValueFromExpression(self, name, expression):
+        value = self._process.target.EvaluateExpression(expression)
+        value.name = name
+        return value
+
+    def CreateValueFromAddress(self, name, address, type):
+        return SBValue(self._process, name, type, address=address)
+
+    def CreateValueFromData(self, name, data, type):
+        return SBValue(self._process, name, type, data=data._bytes)
+
+    def GetProcess(self):
+        return self._process
+
+    def GetTarget(self):
+        return self._process.target
+
+    def CreateChildAtOffset(self, name, offset, type):
+        base = self.unsigned if self._type.IsPointerType() else self._address
+        return SBValue(self._process, name, type, address=base + offset)
+
+    def SetSyntheticChildrenGenerated(self, generated):
+        pass
+
+    def SetPreferSyntheticValue(self, prefer):
+        pass
+
+    def _synthetic_provider(self):
+        if self._synthetic is None:
+            self._synthetic = self._process.target.debugger.synthetic(self)
+        return self._synthetic
+
+    def GetNumChildren(self):
+        if self._children is not None:
+            return len(self._children)
+        provider = self._synthetic_provider()
+        return provider.num_children() if provider is not None else 0
+
+    def GetChildAtIndex(self, index):
+        if self._children is not None:
+            return self._children[index]
+        provider = self._synthetic_provider()
+        return provider.get_child_at_index(index) if provider is not None else None
+
+    def __str__(self):
+        return '({}) {} = {}'.format(self._type.GetName(), self.name, self.GetSummary() or self.GetValue())
+
+
+class SBAddress(object):
+    def __init__(self, address, module=None):
+        self._address = address
+        self._module = module
+
+    def IsValid(self):
+        return True
+
+    def GetLoadAddress(self, target):
+        return self._address
+
+    def GetFileAddress(self):
+        return self._address - self._module.slide if self._module is not None else self._address
+
+    def GetModule(self):
+        return self._module if self._module is not None else SBModule(None)
+
+    def GetSection(self):
+        if self._module is None:
+            return SBSection(None)
+        return SBSection('.tdata' if self._address in self._module._heap.thread_locals else '.data')
+
+
+class SBSection(object):
+    def __init__(self, name):
+        self._name = name
+
+    def IsValid(self):
+        return self._name is not None
+
+    def GetName(self):
+        return self._name
+
+
+class SBSymbol(object):
+    def __init__(self, name, address, module=None):
+        self.name = name
+        self._address = address
+        self._module = module
+
+    def IsValid(self):
+        return self.name is not None
+
+    def GetName(self):
+        return self.name
+
+    def GetStartAddress(self):
+        return SBAddress(self._address, self._module)
+
+
+class SBFunction(object):
+    def __init__(self, symbol):
+        self._symbol = symbol
+
+    def GetStartAddress(self):
+        return self._symbol.GetStartAddress()
+
+
+class SBSymbolContext(object):
+    def __init__(self, symbol):
+        self.symbol = symbol
+        self.function = SBFunction(symbol)
+
+
+class SBFileSpec(object):
+    def __init__(self, path):
+        self._path = path
+
+    def GetFilename(self):
+        return self._path.split('/')[-1]
+
+    def fullpath(self):
+        return self._path
+
+    def __str__(self):
+        return self._path
+
+
+class SBModule(object):
+    def __init__(self, heap, path='/tmp/program.kexe'):
+        self._heap = heap
+        # Like a linker-generated UUID, it changes whenever the contents of the binary (the types) change.
+        contents = [(name, address - heap.slide) for (name, address) in heap.symbols] if heap is not None else []
+        digest = hashlib.md5(repr(contents).encode('utf-8')).hexdigest().upper()
+        self._uuid = '-'.join([digest[0:8], digest[8:12], digest[12:16], digest[16:20], digest[20:32]])
+        self._path = path
+        self.slide = heap.slide if heap is not None else 0
+        self._symbols = [SBSymbol(name, address, self) for (name, address) in heap.symbols] if heap is not None else []
+
+    @property
+    def symbols(self):
+        counters.symbol_scans += 1
+        return list(self._symbols)
+
+    def IsValid(self):
+        return self._heap is not None
+
+    def GetUUIDString(self):
+        return self._uuid
+
+    def GetFileSpec(self):
+        return SBFileSpec(self._path)
+
+    @property
+    def file(self):
+        return self.GetFileSpec()
+
+    def GetNumSymbols(self):
+        return len(self._symbols)
+
+    def GetSymbolAtIndex(self, index):
+        return self._symbols[index]
+
+    def GetObjectFileHeaderAddress(self):
+        return SBAddress(self._heap.module_base, self)
+
+    def FindFunctions(self, name):
+        return [SBSymbolContext(symbol) for symbol in self.symbols if symbol.name == name]
+
+    def FindSymbol(self, name):
+        for symbol in self.symbols:
+            if symbol.name == name:
+                return symbol
+        return SBSymbol(None, 0)
+
+    def __iter__(self):
+        return iter(self.symbols)
+
+
+class SBFrame(object):
+    """`variables` are (name, object address) pairs for Kotlin objects and (name, C type, value) for primitives."""
+    def __init__(self, thread, index, function_name, variables):
+        self._thread = thread
+        self._index = index
+        self._function_name = function_name
+        self._variables = [self._variable(*variable) for variable in variables]
+
+    def _variable(self, name, type, value=None):
+        if value is None:
+            return SBValue(self._thread.process, name, OBJ_HEADER_POINTER, data=struct.pack('<Q', type))
+        type = _c_type(type)
+        format = {'float': 'f', 'double': 'd'}.get(type.GetName(), _SCALAR_FORMATS[type.GetByteSize()])
+        return SBValue(self._thread.process, name, type, data=struct.pack('<' + format, value))
+
+    def IsValid(self):
+        return True
+
+    def GetFrameID(self):
+        return self._index
+
+    @property
+    def idx(self):
+        return self._index
+
+    @property
+    def module(self):
+        return self._thread.process.target.module
+
+    def GetModule(self):
+        return self.module
+
+    def GetFunctionName(self):
+        return self._function_name
+
+    def GetPC(self):
+        return 0x1000 + self._index
+
+    def GetLineEntry(self):
+        return None
+
+    def GetVariables(self, arguments, locals, statics, in_scope_only):
+        return list(self._variables)
+
+    def get_locals(self):
+        return list(self._variables)
+
+    def __str__(self):
+        return 'frame #{}: {}'.format(self._index, self._function_name)
+
+
+class SBThread(object):
+    def __init__(self, process, thread_id, frames, stopped=True):
+        self.process = process
+        self._id = thread_id
+        self._frames = [SBFrame(self, i, name, variables) for (i, (name, variables)) in enumerate(frames)]
+        self._selected = 0
+        self._stopped = stopped
+
+    def IsValid(self):
+        return True
+
+    def GetThreadID(self):
+        return self._id
+
+    def GetIndexID(self):
+        return self._id
+
+    def GetName(self):
+        return 'thread-{}'.format(self._id)
+
+    def GetNumFrames(self):
+        return len(self._frames)
+
+    def GetFrameAtIndex(self, index):
+        return self._frames[index]
+
+    def GetSelectedFrame(self):
+        return self._frames[self._selected]
+
+    def GetStopReason(self):
+        return eStopReasonBreakpoint if self._stopped else eStopReasonNone
+
+    def IsStopped(self):
+        return self._stopped
+
+    def __iter__(self):
+        return iter(self._frames)
+
+
+class SBBroadcaster(object):
+    def __init__(self):
+        self.listeners = []
+
+    def AddListener(self, listener, mask):
+        self.listeners.append(listener)
+        return mask
+
+    def RemoveListener(self, listener, mask):
+        if listener not in self.listeners:
+            return False
+        self.listeners.remove(listener)
+        return True
+
+
+class SBProcess(object):
+    eBroadcastBitStateChanged = SBProcess_eBroadcastBitStateChanged
+    _unique_ids = itertools.count(1)
+
+    def __init__(self, target, heap, threads, is_core=False):
+        self.target = target
+        self.heap = heap
+        self._is_core = is_core
+        self._threads = [SBThread(self, i + 1, frames) for (i, frames) in enumerate(threads)]
+        self._unique_id = next(SBProcess._unique_ids)
+        self._stop_id = 1
+        self._state = eStateStopped
+        self._broadcaster = SBBroadcaster()
+
+    def IsValid(self):
+        return True
+
+    def GetProcessID(self):
+        return 4242
+
+    def GetUniqueID(self):
+        return self._unique_id
+
+    def GetState(self):
+        return self._state
+
+    def GetStopID(self, include_expression_stops=False):
+        return self._stop_id
+
+    def GetBroadcaster(self):
+        return self._broadcaster
+
+    def GetNumThreads(self):
+        return len(self._threads)
+
+    def GetThreadAtIndex(self, index):
+        return self._threads[index]
+
+    def GetSelectedThread(self):
+        return self._threads[0]
+
+    def GetPluginName(self):
+        return 'elf-core' if self._is_core else 'gdb-remote'
+
+    @property
+    def threads(self):
+        return list(self._threads)
+
+    def __iter__(self):
+        return iter(self._threads)
+
+    def resume(self):
+        """Simulates `continue` followed by the next stop."""
+        self._stop_id += 1
+        for listener in self._broadcaster.listeners:
+            listener.events.append(SBEvent(self, eStateRunning))
+            listener.events.append(SBEvent(self, eStateStopped))
+
+    def ReadMemory(self, address, size, error):
+        counters.memory_reads += 1
+        counters.bytes_read += size
+        _sleep(memory_read_latency)
+        data = self.heap.read(address, size)
+        if data is None:
+            error.SetErrorString('memory read failed for {:#x}'.format(address))
+        return data
+
+    def ReadPointerFromMemory(self, address, error):
+        data = self.ReadMemory(address, 8, error)
+        return struct.unpack('<Q', data)[0] if data is not None else 0
+
+    def ReadUnsignedFromMemory(self, address, size, error):
+        data = self.ReadMemory(address, size, error)
+        return struct.unpack('<' + _SCALAR_FORMATS[size].upper(), data)[0] if data is not None else 0
+
+    def ReadCStringFromMemory(self, address, limit, error):
+        counters.memory_reads += 1
+        _sleep(memory_read_latency)
+        string = self.heap.read_c_string(address, limit)
+        if string is None:
+            error.SetErrorString('memory read failed for {:#x}'.format(address))
+            return None
+        counters.bytes_read += len(string) + 1
+        return string
+
+
+class SBEvent(object):
+    def __init__(self, process=None, state=None):
+        self.process = process
+        self.state = state
+
+
+class SBListener(object):
+    def __init__(self, name=None):
+        self.events = []
+
+    def GetNextEvent(self, event):
+        if not self.events:
+            return False
+        next = self.events.pop(0)
+        event.process = next.process
+        event.state = next.state
+        return True
+
+    def PeekAtNextEvent(self, event):
+        if not self.events:
+            return False
+        event.process = self.events[0].process
+        event.state = self.events[0].state
+        return True
+
+
+def _event_process(event):
+    return event.process
+
+
+def _event_state(event):
+    return event.state
+
+
+SBProcess.GetProcessFromEvent = staticmethod(_event_process)
+SBProcess.GetStateFromEvent = staticmethod(_event_state)
+SBProcess.EventIsProcessEvent = staticmethod(lambda event: hasattr(event, 'process'))
+
+
+class SBTarget(object):
+    def __init__(self, debugger, heap, threads, is_core=False):
+        self.debugger = debugger
+        self.module = SBModule(heap)
+        self._process = SBProcess(self, heap, threads, is_core)
+        self._heap = heap
+
+    def IsValid(self):
+        return True
+
+    def GetProcess(self):
+        return self._process
+
+    @property
+    def process(self):
+        return self._process
+
+    def GetAddressByteSize(self):
+        return 8
+
+    def GetByteOrder(self):
+        return eByteOrderLittle
+
+    def GetNumModules(self):
+        return 1
+
+    def GetModuleAtIndex(self, index):
+        return self.module
+
+    @property
+    def modules(self):
+        return [self.module]
+
+    def GetExecutable(self):
+        return self.module.GetFileSpec()
+
+    def ResolveLoadAddress(self, address):
+        return SBAddress(address, self.module if self._heap.contains(address) else None)
+
+    def FindSymbols(self, name):
+        return [SBSymbolContext(symbol) for symbol in self.module.symbols if symbol.name == name]
+
+    def FindFirstType(self, name):
+        return _OBJ_HEADER if name == 'ObjHeader' else _c_type(name)
+
+    def CreateValueFromData(self, name, data, type):
+        return SBValue(self._process, name, type, data=data._bytes)
+
+    def EvaluateExpression(self, expression, options=None):
+        counters.evaluations += 1
+        _sleep(evaluation_latency)
+        if self._process._is_core:
+            # A core file can't run code, lldb fails such expressions.
+            return SBValue(self._process, '$', _c_type('void *'))
+        return self._evaluate(expression)
+
+    def _evaluate(self, expression):
+        return self._heap.evaluate(self._process, expression)
+
+
+class SBCommandReturnObject(object):
+    def __init__(self):
+        self.messages = []
+        self.errors = []
+
+    def AppendMessage(self, message):
+        self.messages.append(message)
+
+    def SetError(self, message):
+        self.errors.append(str(message))
+
+    def SetStatus(self, status):
+        pass
+
+    def Succeeded(self):
+        return not self.errors
+
+    def GetOutput(self):
+        return '\n'.join(self.messages) + ('\n' if self.messages else '')
+
+    def GetError(self):
+        return ''.join('error: {}\n'.format(error) for error in self.errors)
+
+
+eReturnStatusSuccessFinishResult = 2
+eReturnStatusFailed = 6
+
+
+class SBDebugger(object):
+    """Besides the SB API it plays the role of lldb's formatter registry: `summary` and `synthetic`
+    dispatch `ObjHeader *` values to the functions konan_lldb registered through `HandleCommand`."""
+    def __init__(self):
+        self._target = None
+        self.commands = []
+        self.summary_function = None
+        self.synthetic_class = None
+        self.command_functions = {}
+
+    def attach(self, heap, threads=None, is_core=False):
+        self._target = SBTarget(self, heap, threads or [[('main', [])]], is_core)
+        return self._target
+
+    def GetSelectedTarget(self):
+        return self._target
+
+    def GetNumTargets(self):
+        return 1 if self._target else 0
+
+    def GetTargetAtIndex(self, index):
+        return self._target
+
+    def GetListener(self):
+        return SBListener()
+
+    def HandleCommand(self, command):
+        self.commands.append(' '.join(command.split()))
+
+    def summary(self, value):
+        if self.summary_function is None:
+            return None
+        return self.summary_function(value, {})
+
+    def synthetic(self, value):
+        if self.synthetic_class is None:
+            return None
+        return self.synthetic_class(value, {})
+
+
+debugger = SBDebugger()
+
+
+class _Logger(object):
+    def __init__(self):
+        pass
+
+    def write(self, message):
+        pass
+
+    def __rshift__(self, message):
+        return self
+
+
+class formatters(object):
+    class Logger(object):
+        Logger = _Logger
@@ -0,0 +1,96 @@
+/*
+ * Copyright 2010-2020 JetBrains s.r.o. Use of this source code is governed by the Apache 2.0 license
+ * that can be found in the LICENSE file.
+ */
+
+import org.jetbrains.kotlin.addTimeListener
+import org.jetbrains.kotlin.createJsonReport
+import org.jetbrains.kotlin.getCodeSizeBenchmark
+import org.jetbrains.kotlin.getNativeCompileTime
+
+// Benchmarks of the kotlin_bridge Python extension of samples/python_extension: latency of each call, throughput of
+// concurrent calls and of the multi-process pool and cost of sessions, see src/main/python/launcher.py. Leaks of stable
+// pointers or memory fail konanRun. Only included with -PrunPythonBridgeBenchmarks, see settings.gradle.
+
+val applicationName = "PythonBridge"
+val dist = file(findProperty("kotlin.native.home") ?: "dist")
+val python = findProperty("pythonBridge.python") as String? ?: "python3"
+val compilerOpts = listOf("-opt")
+val sample = file("../../samples/python_extension")
+// The sample is built the way its build.sh does, in a copy of its own.
+val sampleBuild = buildDir.resolve("python_extension")
+val library = sampleBuild.resolve("build/${System.mapLibraryName("server")}")
+
+addTimeListener(project)
+
+tasks.create("clean", Delete::class.java) {
+    delete(buildDir)
+}
+
+val copySample = tasks.create("copySample", Copy::class.java) {
+    from(sample) {
+        include("src/**")
+    }
+    into(sampleBuild)
+}
+
+val buildServer = tasks.create("buildServer", Exec::class.java) {
+    dependsOn(copySample)
+    doFirst { mkdir(library.parentFile) }
+    workingDir = library.parentFile
+    commandLine("$dist/bin/kotlinc-native", "-p", "dynamic", "$sampleBuild/src/main/kotlin/Server.kt", "-o", "server",
+            *compilerOpts.toTypedArray())
+}
+
+val buildExtension = tasks.create("buildExtension", Exec::class.java) {
+    dependsOn(buildServer)
+    workingDir = sampleBuild
+    commandLine(python, "src/main/python/setup.py", "build_ext", "--inplace", "--rpath", library.parent)
+}
+
+val konanRun = tasks.create("konanRun", Exec::class.java) {
+    group = "benchmarking"
+    description = "Runs the benchmark for the Kotlin/Native Python bridge."
+    dependsOn(buildExtension)
+    environment("PYTHONPATH", listOf(sampleBuild, sampleBuild.resolve("src/main/python")).joinToString(File.pathSeparator))
+    commandLine(python, "$projectDir/src/main/python/launcher.py",
+            "-w", project.property("nativeWarmup"), "-r", project.property("attempts"), "-p", "$applicationName::",
+            "-o", buildDir.resolve(project.property("nativeBenchResults") as String))
+}
+
+tasks.create("konanJsonReport") {
+    group = "benchmarking"
+    description = "Builds the benchmarking report for the Kotlin/Native Python bridge."
+
+    doLast {
+        val properties = mapOf(
+                "cpu" to System.getProperty("os.arch"),
+                "os" to System.getProperty("os.name"),
+                "jdkVersion" to System.getProperty("java.version"),
+                "jdkVendor" to System.getProperty("java.vendor"),
+                "kotlinVersion" to project.property("kotlinVersion") as String,
+                "type" to "native",
+                "compilerVersion" to project.property("konanVersion") as String,
+                "flags" to compilerOpts.sorted(),
+                "benchmarks" to buildDir.resolve(project.property("nativeBenchResults") as String).readText(),
+                "compileTime" to listOf(getNativeCompileTime(project, applicationName,
+                        listOf("buildServer", "buildExtension"))),
+                "codeSize" to getCodeSizeBenchmark(applicationName, library.absolutePath)
+        )
+        buildDir.resolve(project.property("nativeJson") as String).writeText(createJsonReport(properties))
+    }
+    konanRun.finalizedBy(this)
+}
+
+val jvmRun = tasks.create("jvmRun") {
+    group = "benchmarking"
+    description = "Runs the benchmark for Kotlin/JVM."
+    doLast { println("JVM run isn't supported") }
+}
+
+tasks.create("jvmJsonReport") {
+    group = "benchmarking"
+    description = "Builds the benchmarking report for Kotlin/JVM."
+    doLast { println("JVM run isn't supported") }
+    jvmRun.finalizedBy(this)
+}
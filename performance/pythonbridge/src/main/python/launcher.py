@@ -0,0 +1,260 @@
+#!/usr/bin/python3
+#
+# Copyright 2010-2020 JetBrains s.r.o. Use of this source code is governed by the Apache 2.0 license
+# that can be found in the LICENSE file.
+#
+
+# Benchmarks of the kotlin_bridge extension of samples/python_extension. Takes the arguments of the benchmarks
+# launcher of performance/shared and prints results in the same JSON format, so that they are reported together
+# with the other interop benchmarks.
+
+import argparse
+import asyncio
+import gc
+import json
+import re
+import resource
+import sys
+import threading
+import time
+
+import kotlin_bridge
+
+try:
+    import kotlin_bridge_pool
+except ImportError:
+    kotlin_bridge_pool = None
+
+# Each attempt makes as many calls as fit in about this many seconds.
+EXPECTED_DURATION = 0.5
+THREADS = [2, 4, 8]
+BATCH = 1024
+PAYLOAD = b'a' * 1024
+# Calls made by the leak check, spread evenly over the benchmarks run.
+LEAK_CALLS = 2000000
+# Growth of the resident set (KB) still attributed to the allocator rather than to a leak.
+RSS_TOLERANCE = 32 << 10
+
+
+def log(verbose, message):
+    if verbose:
+        sys.stderr.write(message)
+        sys.stderr.flush()
+
+
+def repeated(call):
+    def run(count):
+        for _ in range(count):
+            call()
+    return run
+
+
+def awaited(loop, call):
+    async def calls(count):
+        for _ in range(count):
+            await call()
+    return lambda count: loop.run_until_complete(calls(count))
+
+
+def threaded(threads, call):
+    # Kotlin code runs with the GIL released, so calls of all the threads may run at the same time.
+    def run(count):
+        workers = [threading.Thread(target=repeated(call), args=(count // threads,)) for _ in range(threads)]
+        previous = kotlin_bridge.set_concurrent(True)
+        try:
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        finally:
+            kotlin_bridge.set_concurrent(previous)
+    return run
+
+
+def submitted(pool, function, *args):
+    def run(count):
+        futures = [pool.submit(function, *args) for _ in range(count)]
+        for future in futures:
+            future.result()
+    return run
+
+
+def open_close_session():
+    kotlin_bridge.close_session(kotlin_bridge.open_session(239, 'konan'))
+
+
+def open_close_session_object():
+    with kotlin_bridge.Session(239, 'konan'):
+        pass
+
+
+def collect_benchmarks(session, session_object, loop, pool):
+    numbers = [list(range(BATCH)), list(range(BATCH))]
+    strings = [['a'] * BATCH, ['b'] * BATCH]
+    out = bytearray(len(PAYLOAD) * 2 + 1024)
+    calls = {
+        'open_session': open_close_session,
+        'greet_server': lambda: kotlin_bridge.greet_server(session),
+        'concat_server': lambda: kotlin_bridge.concat_server(session, 'Coding', 'fun'),
+        'add_server': lambda: kotlin_bridge.add_server(session, 1, 2),
+        'add_server_batch': lambda: kotlin_bridge.add_server_batch(session, *numbers),
+        'concat_server_batch': lambda: kotlin_bridge.concat_server_batch(session, *strings),
+        'greet_server_bytes': lambda: kotlin_bridge.greet_server_bytes(session),
+        'concat_server_bytes': lambda: kotlin_bridge.concat_server_bytes(session, PAYLOAD, PAYLOAD, out),
+        'Session.open': open_close_session_object,
+        'Session.greet': lambda: session_object.greet(),
+        'Session.concat': lambda: session_object.concat('Coding', 'fun'),
+        'Session.add': lambda: session_object.add(1, 2),
+        'Session.add_batch': lambda: session_object.add_batch(*numbers),
+        'Session.concat_bytes': lambda: session_object.concat_bytes(PAYLOAD, PAYLOAD, out),
+    }
+    benchmarks = dict((name, repeated(call)) for name, call in calls.items())
+    if hasattr(kotlin_bridge, 'add_server_async'):
+        benchmarks['greet_server_async'] = awaited(loop, lambda: kotlin_bridge.greet_server_async(session))
+        benchmarks['add_server_async'] = awaited(loop, lambda: kotlin_bridge.add_server_async(session, 1, 2))
+    for threads in THREADS:
+        for name in ['add_server', 'concat_server']:
+            benchmarks['concurrent.{}.{}threads'.format(name, threads)] = threaded(threads, calls[name])
+    if pool is not None:
+        pool_session = pool.open_session(239, 'konan')
+        benchmarks['pool.add_server'] = submitted(pool, 'add_server', pool_session, 1, 2)
+        benchmarks['pool.concat_server'] = submitted(pool, 'concat_server', pool_session, 'Coding', 'fun')
+        benchmarks['pool.add_server_batch'] = repeated(lambda: pool.add_server_batch(pool_session, *numbers))
+    return benchmarks
+
+
+def measure(benchmark, count):
+    start = time.perf_counter()
+    benchmark(count)
+    return time.perf_counter() - start
+
+
+def result(name, status, score, repeat, warmup):
+    return {'name': name, 'status': status, 'score': score, 'metric': 'EXECUTION_TIME',
+            'runtimeInUs': score, 'repeat': repeat, 'warmup': warmup}
+
+
+def run_benchmark(arguments, name, benchmark):
+    log(arguments.verbose, 'Running benchmark {} '.format(name))
+    benchmark(arguments.warmup)
+    count = 1
+    duration = measure(benchmark, count)
+    while duration < EXPECTED_DURATION / 10:
+        count *= 10
+        duration = measure(benchmark, count)
+    count = max(1, int(count * EXPECTED_DURATION / duration))
+    results = []
+    for attempt in range(arguments.repeat):
+        log(arguments.verbose, '.')
+        # Score is the time of a single call in microseconds.
+        score = measure(benchmark, count) * 1e6 / count
+        results.append(result(arguments.prefix + name, 'PASSED', score, attempt + 1, arguments.warmup))
+    log(arguments.verbose, '\n')
+    return results
+
+
+def resident_set_kb():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() // 1024
+    except IOError:
+        # Peak resident set, it still grows if memory leaks.
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+# Kotlin objects referenced by the bridge of this process and of the workers of the pool.
+def stable_pointers(pool):
+    return kotlin_bridge.stable_pointers() + (pool.stable_pointers() if pool is not None else 0)
+
+
+# Makes --leak-calls calls spread over the benchmarks and returns descriptions of the leaks found: growth of the number
+# of Kotlin objects referenced by the bridge and of the resident set. Both are expected to stay flat. Leaks aren't
+# benchmark results, they have no time to compare, so they fail the run instead.
+def check_leaks(arguments, benchmarks, pool):
+    log(arguments.verbose, 'Checking leaks over {} calls\n'.format(arguments.leak_calls))
+    for benchmark in benchmarks.values():
+        benchmark(arguments.warmup)
+    gc.collect()
+    pointers = stable_pointers(pool)
+    rss = resident_set_kb()
+    count = max(1, arguments.leak_calls // len(benchmarks))
+    for name, benchmark in benchmarks.items():
+        log(arguments.verbose, '  {}\n'.format(name))
+        # A batch call counts as a call per item.
+        benchmark(max(1, count // BATCH) if 'batch' in name else count)
+    gc.collect()
+    pointers = stable_pointers(pool) - pointers
+    rss = resident_set_kb() - rss
+    log(arguments.verbose, 'Stable pointers grew by {}, resident set by {} KB\n'.format(pointers, rss))
+    leaks = []
+    if pointers != 0:
+        leaks.append('number of stable pointers changed by {}'.format(pointers))
+    if rss > RSS_TOLERANCE:
+        leaks.append('resident set grew by {} KB'.format(rss))
+    return leaks
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(prog='benchmark')
+    parser.add_argument('command', nargs='?', choices=['list'], help='Show list of benchmarks')
+    parser.add_argument('-w', '--warmup', type=int, default=20, help='Number of warm up iterations')
+    parser.add_argument('-r', '--repeat', type=int, default=60, help='Number of each benchmark run')
+    parser.add_argument('-p', '--prefix', default='', help='Prefix added to benchmark name')
+    parser.add_argument('-o', '--output', help='Output file')
+    parser.add_argument('-f', '--filter', action='append', default=[], help='Benchmark to run')
+    parser.add_argument('-fr', '--filterRegex', action='append', default=[],
+                        help='Benchmark to run, described by a regular expression')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Verbose mode of running')
+    parser.add_argument('--leak-calls', type=int, default=LEAK_CALLS,
+                        help='Number of calls made by the leak check after the benchmarks, 0 to skip it')
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    session = kotlin_bridge.open_session(239, 'konan')
+    session_object = kotlin_bridge.Session(239, 'konan')
+    loop = asyncio.new_event_loop()
+    # Worker processes of the pool serve requests of a single process, one per CPU.
+    pool = kotlin_bridge_pool.ServerPool() if kotlin_bridge_pool is not None else None
+    benchmarks = collect_benchmarks(session, session_object, loop, pool)
+    names = sorted(benchmarks)
+    if arguments.command == 'list':
+        print('\n'.join(names))
+        return
+    regexes = [re.compile(regex) for regex in arguments.filterRegex]
+    if arguments.filter or regexes:
+        names = [name for name in names if name in arguments.filter or any(regex.fullmatch(name) for regex in regexes)]
+    if not names:
+        sys.exit('No matching benchmarks found')
+    results = []
+    for name in names:
+        try:
+            results += run_benchmark(arguments, name, benchmarks[name])
+        except Exception as e:
+            sys.stderr.write('Failure while running benchmark {}: {}\n'.format(name, e))
+            results.append(result(arguments.prefix + name, 'FAILED', 0.0, arguments.repeat, arguments.warmup))
+    leaks = []
+    if arguments.leak_calls > 0:
+        try:
+            leaks = check_leaks(arguments, dict((name, benchmarks[name]) for name in names), pool)
+        except Exception as e:
+            leaks = ['check failed: {}'.format(e)]
+    loop.close()
+    if pool is not None:
+        pool.close()
+    session_object.close()
+    kotlin_bridge.close_session(session)
+    report = json.dumps(results)
+    if arguments.output:
+        with open(arguments.output, 'w') as output:
+            output.write(report)
+    else:
+        print(report)
+    if leaks:
+        sys.exit('Leaks found: {}'.format(', '.join(leaks)))
+
+
+if __name__ == '__main__':
+    main()
@@ -10,23 +10,39 @@
 #define __ server_symbols()->
 #define T_(name) server_kref_demo_ ## name
 
-// Note, that as we cache this in the global, and Kotlin/Native object references
-// are currently thread local, we make this global a TLS variable.
-#ifdef _MSC_VER
-#define TLSVAR __declspec(thread)
-#else
-#define TLSVAR __thread
-#endif
+// Number of stable pointers to Kotlin objects currently held by the bridge, only changed with the GIL held.
+static Py_ssize_t stable_pointers = 0;
 
-static TLSVAR server_kref_demo_Server server = { 0 };
+static void disposeStablePointer(void* pinned) {
+    __ DisposeStablePointer(pinned);
+    stable_pointers--;
+}
+
+// Server and Session freeze themselves, so a single server and all sessions can be used from any thread.
+// The server is created with the GIL held and lives as long as the module.
+static server_kref_demo_Server server = { 0 };
 
 static T_(Server) getServer(void) {
   if (!server.pinned) {
     server = __ kotlin.root.demo.Server.Server("the server");
+    stable_pointers++;
   }
   return server;
 }
 
+// In concurrent mode Kotlin code runs with the GIL released, so that calls from several Python threads run in
+// parallel. Statements of KOTLIN_CALL can't use the Python API and run in a block of their own.
+static int concurrent = 0;
+
+#define KOTLIN_CALL(statements) \
+    if (concurrent) { \
+        Py_BEGIN_ALLOW_THREADS \
+        statements \
+        Py_END_ALLOW_THREADS \
+    } else { \
+        statements \
+    }
+
 static T_(Session) getSession(PyObject* args) {
    T_(Session) result = { 0 };
    long long pinned;
@@ -36,12 +52,61 @@ static T_(Session) getSession(PyObject* args) {
    return result;
 }
 
+// Calls in progress per session handle. Only counted in concurrent mode, where the GIL is released during a call and
+// another thread could close the session under it. close_session refuses to dispose of a session in use.
+// kotlin_bridge.Session keeps such counts of its own and closes once its calls are done.
+static PyObject* session_calls = NULL;
+
+// Returns 1 if the call is counted, 0 if it needs not be and -1 on error.
+static int enterRawSession(T_(Session) session) {
+    PyObject* key;
+    PyObject* count;
+    int result;
+    if (!concurrent) return 0;
+    if (session_calls == NULL && (session_calls = PyDict_New()) == NULL) return -1;
+    key = PyLong_FromVoidPtr(session.pinned);
+    if (key == NULL) return -1;
+    count = PyDict_GetItem(session_calls, key);
+    count = PyLong_FromLong(count != NULL ? PyLong_AsLong(count) + 1 : 1);
+    result = count != NULL && PyDict_SetItem(session_calls, key, count) == 0 ? 1 : -1;
+    Py_XDECREF(count);
+    Py_DECREF(key);
+    return result;
+}
+
+static PyObject* leaveRawSession(T_(Session) session, int counted, PyObject* result) {
+    PyObject *type, *value, *traceback;
+    PyObject* key;
+    PyObject* count;
+    if (counted <= 0) return result;
+    // The call may have failed, its exception is kept.
+    PyErr_Fetch(&type, &value, &traceback);
+    key = PyLong_FromVoidPtr(session.pinned);
+    count = key != NULL ? PyDict_GetItem(session_calls, key) : NULL;
+    if (count != NULL) {
+        long left = PyLong_AsLong(count) - 1;
+        count = left > 0 ? PyLong_FromLong(left) : NULL;
+        if (count != NULL) {
+            PyDict_SetItem(session_calls, key, count);
+            Py_DECREF(count);
+        } else {
+            PyDict_DelItem(session_calls, key);
+        }
+    }
+    if (PyErr_Occurred()) PyErr_WriteUnraisable(session_calls);
+    Py_XDECREF(key);
+    PyErr_Restore(type, value, traceback);
+    return result;
+}
+
 static PyObject* open_session(PyObject* self, PyObject* args) {
     PyObject *result = NULL;
     char* string_arg = NULL;
     int int_arg = 0;
     if (PyArg_ParseTuple(args, "is", &int_arg, &string_arg)) {
-        T_(Session) session = __ kotlin.root.demo.Session.Session(string_arg, int_arg);
+        T_(Session) session;
+        KOTLIN_CALL(session = __ kotlin.root.demo.Session.Session(string_arg, int_arg);)
+        stable_pointers++;
         result = Py_BuildValue("L", session.pinned);
     }
     return result;
@@ -49,21 +114,61 @@ static PyObject* open_session(PyObject* self, PyObject* args) {
 
 static PyObject* close_session(PyObject* self, PyObject* args) {
     T_(Session) session = getSession(args);
-    __ DisposeStablePointer(session.pinned);
-    __ DisposeStablePointer(getServer().pinned);
-    server.pinned = 0;
+    PyObject* key;
+    int in_use;
+    if (PyErr_Occurred()) {
+        return NULL;
+    }
+    if (session_calls != NULL) {
+        key = PyLong_FromVoidPtr(session.pinned);
+        if (key == NULL) return NULL;
+        in_use = PyDict_Contains(session_calls, key);
+        Py_DECREF(key);
+        if (in_use < 0) return NULL;
+        if (in_use) {
+            PyErr_SetString(PyExc_RuntimeError, "session is in use by another thread");
+            return NULL;
+        }
+    }
+    disposeStablePointer(session.pinned);
     return Py_BuildValue("L", 0);
 }
 
-static PyObject* greet_server(PyObject* self, PyObject* args) {
+static PyObject* greet(T_(Session) session) {
     T_(Server) server = getServer();
-    T_(Session) session = getSession(args);
-    const char* string = __ kotlin.root.demo.Server.greet(server, session);
-    PyObject* result = Py_BuildValue("s", string);
+    const char* string;
+    PyObject* result;
+    KOTLIN_CALL(string = __ kotlin.root.demo.Server.greet(server, session);)
+    result = Py_BuildValue("s", string);
+    __ DisposeString(string);
+    return result;
+}
+
+static PyObject* concat(T_(Session) session, const char* a, const char* b) {
+    T_(Server) server = getServer();
+    const char* string;
+    PyObject* result;
+    KOTLIN_CALL(string = __ kotlin.root.demo.Server.concat(server, session, a, b);)
+    result = Py_BuildValue("s", string);
     __ DisposeString(string);
     return result;
 }
 
+static PyObject* add(T_(Session) session, int a, int b) {
+    T_(Server) server = getServer();
+    int sum;
+    KOTLIN_CALL(sum = __ kotlin.root.demo.Server.add(server, session, a, b);)
+    return Py_BuildValue("i", sum);
+}
+
+static PyObject* greet_server(PyObject* self, PyObject* args) {
+    T_(Session) session = getSession(args);
+    int counted;
+    if (PyErr_Occurred()) return NULL;
+    if ((counted = enterRawSession(session)) < 0) return NULL;
+    return leaveRawSession(session, counted, greet(session));
+}
+
 static PyObject* concat_server(PyObject* self, PyObject* args) {
     long long session_arg;
     char* string_arg1 = NULL;
@@ -71,11 +176,10 @@ static PyObject* concat_server(PyObject* self, PyObject* args) {
     PyObject* result = NULL;
 
     if (PyArg_ParseTuple(args, "Lss", &session_arg, &string_arg1, &string_arg2)) {
-       T_(Server) server = getServer();
        T_(Session) session = { (void*)(uintptr_t)session_arg };
-       const char* string = __ kotlin.root.demo.Server.concat(server, session, string_arg1, string_arg2);
-       result = Py_BuildValue("s", string);
-       __ DisposeString(string);
+       int counted = enterRawSession(session);
+       if (counted < 0) return NULL;
+       result = leaveRawSession(session, counted, concat(session, string_arg1, string_arg2));
     } else {
         result = Py_BuildValue("s", NULL);
     }
@@ -89,22 +193,921 @@ static PyObject* add_server(PyObject* self, PyObject* args) {
     PyObject* result = NULL;
 
     if (PyArg_ParseTuple(args, "Lii", &session_arg, &int_arg1, &int_arg2)) {
-       T_(Server) server = getServer();
        T_(Session) session = { (void*)(uintptr_t)session_arg };
-       int sum = __ kotlin.root.demo.Server.add(server, session, int_arg1, int_arg2);
-       result = Py_BuildValue("i", sum);
+       int counted = enterRawSession(session);
+       if (counted < 0) return NULL;
+       result = leaveRawSession(session, counted, add(session, int_arg1, int_arg2));
     } else {
         result = Py_BuildValue("i", 0);
     }
     return result;
 }
 
+#if PY_MAJOR_VERSION >= 3
+
+// Batch entry points: arguments are converted once per batch and demo.Server is called once per batch.
+
+// Items of a batch argument, borrowed from a buffer of 32-bit integers or copied from any other sequence.
+typedef struct {
+    Py_buffer view;
+    int* items;
+    Py_ssize_t count;
+} IntBatch;
+
+static int isIntBuffer(Py_buffer* view) {
+    const char* format = view->format;
+    if (format == NULL || view->itemsize != sizeof(int)) return 0;
+    if (*format == '@' || *format == '=' || (*format == '<' && PY_LITTLE_ENDIAN) || (*format == '>' && !PY_LITTLE_ENDIAN))
+        format++;
+    return (format[0] == 'i' || format[0] == 'l') && format[1] == '\0';
+}
+
+static int getIntBuffer(PyObject* object, Py_buffer* view, int flags) {
+    if (!PyObject_CheckBuffer(object) || PyObject_GetBuffer(object, view, flags | PyBUF_FORMAT | PyBUF_C_CONTIGUOUS) < 0) {
+        PyErr_Clear();
+        return 0;
+    }
+    if (!isIntBuffer(view)) {
+        PyBuffer_Release(view);
+        return 0;
+    }
+    return 1;
+}
+
+static int getIntBatch(PyObject* object, IntBatch* batch) {
+    PyObject* sequence;
+    Py_ssize_t i;
+    memset(batch, 0, sizeof(*batch));
+    if (getIntBuffer(object, &batch->view, PyBUF_SIMPLE)) {
+        batch->items = (int*)batch->view.buf;
+        batch->count = batch->view.len / sizeof(int);
+        return 1;
+    }
+    sequence = PySequence_Fast(object, "expected a sequence of ints or a buffer of 32-bit integers");
+    if (sequence == NULL) return 0;
+    batch->count = PySequence_Fast_GET_SIZE(sequence);
+    batch->items = PyMem_New(int, batch->count > 0 ? batch->count : 1);
+    if (batch->items == NULL) {
+        Py_DECREF(sequence);
+        PyErr_NoMemory();
+        return 0;
+    }
+    for (i = 0; i < batch->count; i++) {
+        long item = PyLong_AsLong(PySequence_Fast_GET_ITEM(sequence, i));
+        if (item == -1 && PyErr_Occurred()) break;
+        if (item < INT_MIN || item > INT_MAX) {
+            PyErr_SetString(PyExc_OverflowError, "batch item does not fit in a 32-bit integer");
+            break;
+        }
+        batch->items[i] = (int)item;
+    }
+    Py_DECREF(sequence);
+    if (i < batch->count) {
+        PyMem_Free(batch->items);
+        return 0;
+    }
+    return 1;
+}
+
+static void releaseIntBatch(IntBatch* batch) {
+    if (batch->view.obj != NULL) {
+        PyBuffer_Release(&batch->view);
+    } else {
+        PyMem_Free(batch->items);
+    }
+}
+
+// array.array('i') of `count` zeros, used as output when none is given.
+static PyObject* newIntArray(Py_ssize_t count) {
+    PyObject* result = NULL;
+    PyObject* array = PyImport_ImportModule("array");
+    if (array != NULL) {
+        PyObject* zero = PyObject_CallMethod(array, "array", "s[i]", "i", 0);
+        if (zero != NULL) {
+            result = PySequence_Repeat(zero, count);
+            Py_DECREF(zero);
+        }
+        Py_DECREF(array);
+    }
+    return result;
+}
+
+static PyObject* addBatch(T_(Session) session, PyObject* a_arg, PyObject* b_arg, PyObject* out) {
+    IntBatch a, b;
+    Py_buffer sums;
+    PyObject* result = NULL;
+
+    if (!getIntBatch(a_arg, &a)) return NULL;
+    if (!getIntBatch(b_arg, &b)) {
+        releaseIntBatch(&a);
+        return NULL;
+    }
+    if (a.count != b.count) {
+        PyErr_SetString(PyExc_ValueError, "batches differ in length");
+    } else if (a.count > INT_MAX) {
+        // demo.Server takes the length of a batch as an Int.
+        PyErr_SetString(PyExc_OverflowError, "batch is too long");
+    } else {
+        if (out == NULL || out == Py_None) {
+            result = newIntArray(a.count);
+        } else {
+            Py_INCREF(out);
+            result = out;
+        }
+        if (result != NULL && !getIntBuffer(result, &sums, PyBUF_WRITABLE)) {
+            PyErr_SetString(PyExc_TypeError, "output must be a writable buffer of 32-bit integers");
+            Py_CLEAR(result);
+        } else if (result != NULL) {
+            if (sums.len / (Py_ssize_t)sizeof(int) < a.count) {
+                PyErr_SetString(PyExc_ValueError, "output is shorter than the batch");
+                Py_CLEAR(result);
+            } else {
+                T_(Server) server = getServer();
+                KOTLIN_CALL(__ kotlin.root.demo.Server.addBatch(server, session, a.items, b.items, sums.buf, (int)a.count);)
+            }
+            PyBuffer_Release(&sums);
+        }
+    }
+    releaseIntBatch(&a);
+    releaseIntBatch(&b);
+    return result;
+}
+
+static PyObject* add_server_batch(PyObject* self, PyObject* args) {
+    long long session_arg;
+    PyObject* a_arg = NULL;
+    PyObject* b_arg = NULL;
+    PyObject* out = NULL;
+    T_(Session) session;
+    int counted;
+
+    if (!PyArg_ParseTuple(args, "LOO|O", &session_arg, &a_arg, &b_arg, &out)) return NULL;
+    session.pinned = (void*)(uintptr_t)session_arg;
+    if ((counted = enterRawSession(session)) < 0) return NULL;
+    return leaveRawSession(session, counted, addBatch(session, a_arg, b_arg, out));
+}
+
+// UTF-8 of every str of a sequence, valid while the sequence is alive.
+static const char** getStrings(PyObject* sequence, Py_ssize_t* size) {
+    Py_ssize_t count = PySequence_Fast_GET_SIZE(sequence);
+    Py_ssize_t i;
+    const char** strings = PyMem_New(const char*, count > 0 ? count : 1);
+    if (strings == NULL) {
+        PyErr_NoMemory();
+        return NULL;
+    }
+    for (i = 0; i < count; i++) {
+        PyObject* item = PySequence_Fast_GET_ITEM(sequence, i);
+        Py_ssize_t length;
+        strings[i] = PyUnicode_Check(item) ? PyUnicode_AsUTF8AndSize(item, &length) : NULL;
+        if (strings[i] == NULL) {
+            if (!PyErr_Occurred()) PyErr_SetString(PyExc_TypeError, "expected a sequence of str");
+            PyMem_Free(strings);
+            return NULL;
+        }
+        *size += length;
+    }
+    return strings;
+}
+
+static PyObject* concatBatch(T_(Session) session, PyObject* a_arg, PyObject* b_arg, PyObject* out) {
+    PyObject* a = NULL;
+    PyObject* b = NULL;
+    const char** a_strings = NULL;
+    const char** b_strings = NULL;
+    long long* ends = NULL;
+    char* buffer = NULL;
+    Py_ssize_t count, input_size = 0, i;
+    PyObject* result = NULL;
+
+    // Copies keep the strings alive even if the sequences change while the GIL is released.
+    a = PySequence_Tuple(a_arg);
+    b = a != NULL ? PySequence_Tuple(b_arg) : NULL;
+    if (b == NULL) goto done;
+    count = PySequence_Fast_GET_SIZE(a);
+    if (count != PySequence_Fast_GET_SIZE(b)) {
+        PyErr_SetString(PyExc_ValueError, "batches differ in length");
+        goto done;
+    }
+    if (count > INT_MAX) {
+        PyErr_SetString(PyExc_OverflowError, "batch is too long");
+        goto done;
+    }
+    if (out != NULL && out != Py_None && (!PyList_Check(out) || PyList_GET_SIZE(out) < count)) {
+        PyErr_SetString(PyExc_ValueError, "output must be a list at least as long as the batch");
+        goto done;
+    }
+    if ((a_strings = getStrings(a, &input_size)) == NULL || (b_strings = getStrings(b, &input_size)) == NULL) goto done;
+    ends = PyMem_New(long long, count > 0 ? count : 1);
+    if (ends == NULL) {
+        PyErr_NoMemory();
+        goto done;
+    }
+    {
+        T_(Server) server = getServer();
+        // Results are the inputs plus the prefix and the session, so the first guess is almost always enough.
+        long long capacity = input_size + 64 * count + 256;
+        long long size;
+        for (;;) {
+            buffer = PyMem_Malloc(capacity > 0 ? capacity : 1);
+            if (buffer == NULL) {
+                PyErr_NoMemory();
+                goto done;
+            }
+            KOTLIN_CALL(size = __ kotlin.root.demo.Server.concatBatch(server, session, (void*)a_strings, (void*)b_strings,
+                                                                      (int)count, buffer, capacity, ends);)
+            if (size <= capacity) break;
+            PyMem_Free(buffer);
+            capacity = size;
+        }
+    }
+    if (out == NULL || out == Py_None) {
+        result = PyList_New(count);
+    } else {
+        Py_INCREF(out);
+        result = out;
+    }
+    for (i = 0; result != NULL && i < count; i++) {
+        long long start = i > 0 ? ends[i - 1] : 0;
+        PyObject* string = PyUnicode_DecodeUTF8(buffer + start, ends[i] - start, NULL);
+        if (string == NULL) {
+            Py_CLEAR(result);
+        } else if (PyList_SetItem(result, i, string) < 0) {
+            Py_CLEAR(result);
+        }
+    }
+
+done:
+    PyMem_Free(buffer);
+    PyMem_Free(ends);
+    PyMem_Free(a_strings);
+    PyMem_Free(b_strings);
+    Py_XDECREF(a);
+    Py_XDECREF(b);
+    return result;
+}
+
+static PyObject* concat_server_batch(PyObject* self, PyObject* args) {
+    long long session_arg;
+    PyObject* a_arg = NULL;
+    PyObject* b_arg = NULL;
+    PyObject* out = NULL;
+    T_(Session) session;
+    int counted;
+
+    if (!PyArg_ParseTuple(args, "LOO|O", &session_arg, &a_arg, &b_arg, &out)) return NULL;
+    session.pinned = (void*)(uintptr_t)session_arg;
+    if ((counted = enterRawSession(session)) < 0) return NULL;
+    return leaveRawSession(session, counted, concatBatch(session, a_arg, b_arg, out));
+}
+
+// Bytes entry points: UTF-8 payloads of bytes-like objects are passed to Kotlin as they are, and Kotlin writes results
+// straight to a caller's buffer or to a new bytes object, so a payload is copied once instead of being encoded,
+// converted to a Kotlin String and back, and copied out of a C string.
+
+// Writes at most `capacity` bytes of the result to `buffer`, returns the size of the result.
+typedef long long (*BytesWriter)(void* context, char* buffer, long long capacity);
+
+// Size of the result written to `out` if it's given, or a new bytes object, allocated with `estimate` bytes first.
+static PyObject* bytesResult(PyObject* out, long long estimate, BytesWriter write, void* context) {
+    PyObject* result;
+    long long size;
+    if (out != NULL && out != Py_None) {
+        Py_buffer view;
+        Py_ssize_t capacity;
+        if (PyObject_GetBuffer(out, &view, PyBUF_WRITABLE) < 0) return NULL;
+        capacity = view.len;
+        size = write(context, view.buf, capacity);
+        PyBuffer_Release(&view);
+        if (size > capacity) {
+            PyErr_Format(PyExc_ValueError, "output is too small, %lld bytes needed", size);
+            return NULL;
+        }
+        return PyLong_FromLongLong(size);
+    }
+    result = PyBytes_FromStringAndSize(NULL, estimate);
+    if (result == NULL) return NULL;
+    size = write(context, PyBytes_AS_STRING(result), estimate);
+    if (size > estimate) {
+        Py_DECREF(result);
+        result = PyBytes_FromStringAndSize(NULL, size);
+        if (result == NULL) return NULL;
+        write(context, PyBytes_AS_STRING(result), size);
+    } else if (size < estimate && _PyBytes_Resize(&result, size) < 0) {
+        return NULL;
+    }
+    return result;
+}
+
+static long long writeGreeting(void* context, char* buffer, long long capacity) {
+    T_(Server) server = getServer();
+    T_(Session) session = *(T_(Session)*)context;
+    long long size;
+    KOTLIN_CALL(size = __ kotlin.root.demo.Server.greetBytes(server, session, buffer, capacity);)
+    return size;
+}
+
+static PyObject* greetBytes(T_(Session) session, PyObject* out) {
+    return bytesResult(out, 256, writeGreeting, &session);
+}
+
+typedef struct {
+    T_(Session) session;
+    Py_buffer a;
+    Py_buffer b;
+} ConcatBytes;
+
+static long long writeConcatenation(void* context, char* buffer, long long capacity) {
+    ConcatBytes* arguments = context;
+    T_(Server) server = getServer();
+    long long size;
+    KOTLIN_CALL(size = __ kotlin.root.demo.Server.concatBytes(server, arguments->session, arguments->a.buf, arguments->a.len,
+                                                              arguments->b.buf, arguments->b.len, buffer, capacity);)
+    return size;
+}
+
+static PyObject* concatBytes(T_(Session) session, PyObject* a, PyObject* b, PyObject* out) {
+    ConcatBytes arguments;
+    PyObject* result;
+    arguments.session = session;
+    if (PyObject_GetBuffer(a, &arguments.a, PyBUF_SIMPLE) < 0) return NULL;
+    if (PyObject_GetBuffer(b, &arguments.b, PyBUF_SIMPLE) < 0) {
+        PyBuffer_Release(&arguments.a);
+        return NULL;
+    }
+    // The result is the payloads plus the prefix and the session.
+    result = bytesResult(out, arguments.a.len + arguments.b.len + 256, writeConcatenation, &arguments);
+    PyBuffer_Release(&arguments.a);
+    PyBuffer_Release(&arguments.b);
+    return result;
+}
+
+static PyObject* greet_server_bytes(PyObject* self, PyObject* args) {
+    long long session_arg;
+    PyObject* out = NULL;
+    T_(Session) session;
+    int counted;
+
+    if (!PyArg_ParseTuple(args, "L|O", &session_arg, &out)) return NULL;
+    session.pinned = (void*)(uintptr_t)session_arg;
+    if ((counted = enterRawSession(session)) < 0) return NULL;
+    return leaveRawSession(session, counted, greetBytes(session, out));
+}
+
+static PyObject* concat_server_bytes(PyObject* self, PyObject* args) {
+    long long session_arg;
+    PyObject* a_arg = NULL;
+    PyObject* b_arg = NULL;
+    PyObject* out = NULL;
+    T_(Session) session;
+    int counted;
+
+    if (!PyArg_ParseTuple(args, "LOO|O", &session_arg, &a_arg, &b_arg, &out)) return NULL;
+    session.pinned = (void*)(uintptr_t)session_arg;
+    if ((counted = enterRawSession(session)) < 0) return NULL;
+    return leaveRawSession(session, counted, concatBytes(session, a_arg, b_arg, out));
+}
+
+#endif
+
+#if PY_MAJOR_VERSION >= 3 && !defined(_WIN32)
+
+#include <fcntl.h>
+#include <unistd.h>
+#include <pythread.h>
+
+// asyncio entry points. Requests run on the workers of a demo.Dispatcher, which pass results to `complete`.
+// It queues them and wakes the event loop up through a self-pipe, the loop then resolves futures of the requests.
+// So any number of requests may be in flight while only the workers' threads exist.
+
+typedef struct Completion {
+    struct Completion* next;
+    long long id;
+    int failed;
+    char* string;
+    int value;
+} Completion;
+
+static PyThread_type_lock completions_lock = NULL;
+// Finished requests, the most recent first.
+static Completion* completions = NULL;
+static int wakeup[2] = { -1, -1 };
+static T_(Dispatcher) dispatcher = { 0 };
+// Request id -> future.
+static PyObject* pending = NULL;
+// Loop the read end of `wakeup` is registered with.
+static PyObject* reader_loop = NULL;
+static PyObject* drain_callback = NULL;
+static PyObject* get_running_loop = NULL;
+static long long last_request = 0;
+
+// Called by workers, without the GIL.
+static void complete(long long id, int failed, const char* string, int value) {
+    Completion* completion = malloc(sizeof(Completion));
+    int wake;
+    if (completion == NULL) abort();
+    completion->id = id;
+    completion->failed = failed;
+    completion->string = string != NULL ? strdup(string) : NULL;
+    completion->value = value;
+    PyThread_acquire_lock(completions_lock, WAIT_LOCK);
+    // The loop is only woken up for the first completion since it has last drained the queue.
+    wake = completions == NULL;
+    completion->next = completions;
+    completions = completion;
+    PyThread_release_lock(completions_lock);
+    if (wake) {
+        char byte = 0;
+        while (write(wakeup[1], &byte, 1) < 0 && errno == EINTR) {}
+    }
+}
+
+static void resolve(Completion* completion) {
+    PyObject* key = PyLong_FromLongLong(completion->id);
+    PyObject* future = key != NULL ? PyDict_GetItemWithError(pending, key) : NULL;
+    PyObject* done;
+    PyObject* result = NULL;
+    if (future == NULL) {
+        Py_XDECREF(key);
+        return;
+    }
+    Py_INCREF(future);
+    PyDict_DelItem(pending, key);
+    Py_DECREF(key);
+    // Cancelled futures are done as well.
+    done = PyObject_CallMethod(future, "done", NULL);
+    if (done != NULL && !PyObject_IsTrue(done)) {
+        if (completion->failed) {
+            PyObject* error = PyObject_CallFunction(PyExc_RuntimeError, "s", completion->string);
+            if (error != NULL) result = PyObject_CallMethod(future, "set_exception", "O", error);
+            Py_XDECREF(error);
+        } else if (completion->string != NULL) {
+            result = PyObject_CallMethod(future, "set_result", "s", completion->string);
+        } else {
+            result = PyObject_CallMethod(future, "set_result", "i", completion->value);
+        }
+    }
+    if (PyErr_Occurred()) PyErr_WriteUnraisable(future);
+    Py_XDECREF(result);
+    Py_XDECREF(done);
+    Py_DECREF(future);
+}
+
+static PyObject* drain(PyObject* self, PyObject* unused) {
+    char bytes[64];
+    Completion* completion;
+    Completion* ordered = NULL;
+    // The pipe is emptied before the queue is taken, so that a completion coming in between wakes the loop again.
+    while (read(wakeup[0], bytes, sizeof(bytes)) > 0) {}
+    PyThread_acquire_lock(completions_lock, WAIT_LOCK);
+    completion = completions;
+    completions = NULL;
+    PyThread_release_lock(completions_lock);
+    while (completion != NULL) {
+        Completion* next = completion->next;
+        completion->next = ordered;
+        ordered = completion;
+        completion = next;
+    }
+    while (ordered != NULL) {
+        completion = ordered;
+        ordered = completion->next;
+        resolve(completion);
+        free(completion->string);
+        free(completion);
+    }
+    Py_RETURN_NONE;
+}
+
+static PyMethodDef drain_def = { "drain", (PyCFunction)drain, METH_NOARGS, NULL };
+
+static int startDispatcher(void) {
+    PyObject* asyncio;
+    long cpus;
+    if (dispatcher.pinned) return 1;
+    if (pipe(wakeup) < 0) {
+        PyErr_SetFromErrno(PyExc_OSError);
+        return 0;
+    }
+    fcntl(wakeup[0], F_SETFL, O_NONBLOCK);
+    fcntl(wakeup[1], F_SETFL, O_NONBLOCK);
+    completions_lock = PyThread_allocate_lock();
+    pending = PyDict_New();
+    drain_callback = PyCFunction_New(&drain_def, NULL);
+    asyncio = PyImport_ImportModule("asyncio");
+    get_running_loop = asyncio != NULL ? PyObject_GetAttrString(asyncio, "get_running_loop") : NULL;
+    Py_XDECREF(asyncio);
+    if (completions_lock == NULL || pending == NULL || drain_callback == NULL || get_running_loop == NULL) {
+        if (!PyErr_Occurred()) PyErr_NoMemory();
+        return 0;
+    }
+    cpus = sysconf(_SC_NPROCESSORS_ONLN);
+    dispatcher = __ kotlin.root.demo.Dispatcher.Dispatcher(cpus > 0 ? (int)cpus : 1);
+    stable_pointers++;
+    return 1;
+}
+
+static void stopDispatcher(void) {
+    if (!dispatcher.pinned) return;
+    Py_BEGIN_ALLOW_THREADS
+    __ kotlin.root.demo.Dispatcher.stop(dispatcher);
+    Py_END_ALLOW_THREADS
+    disposeStablePointer(dispatcher.pinned);
+    dispatcher.pinned = 0;
+    close(wakeup[0]);
+    close(wakeup[1]);
+    while (completions != NULL) {
+        Completion* next = completions->next;
+        free(completions->string);
+        free(completions);
+        completions = next;
+    }
+    PyThread_free_lock(completions_lock);
+    completions_lock = NULL;
+}
+
+// Cancels requests of `reader_loop` through the loop itself, which may still run on another thread. Those of a closed
+// loop can no longer be awaited and are just dropped. Completions coming for them later find no future.
+static void dropPending(void) {
+    PyObject* key;
+    PyObject* future;
+    Py_ssize_t position = 0;
+    while (PyDict_Next(pending, &position, &key, &future)) {
+        PyObject* cancel = PyObject_GetAttrString(future, "cancel");
+        PyObject* result = cancel != NULL
+                ? PyObject_CallMethod(reader_loop, "call_soon_threadsafe", "O", cancel) : NULL;
+        Py_XDECREF(result);
+        Py_XDECREF(cancel);
+        PyErr_Clear();
+    }
+    PyDict_Clear(pending);
+}
+
+// Future of a new request of the running loop, `*id` is set to its id.
+static PyObject* newRequest(long long* id) {
+    PyObject* loop;
+    PyObject* future;
+    PyObject* key;
+    if (!startDispatcher()) return NULL;
+    loop = PyObject_CallObject(get_running_loop, NULL);
+    if (loop == NULL) return NULL;
+    if (reader_loop != loop) {
+        PyObject* result;
+        if (reader_loop != NULL) {
+            // Completions are only resolved on a single loop, requests left by the previous one won't ever be.
+            dropPending();
+            result = PyObject_CallMethod(reader_loop, "remove_reader", "i", wakeup[0]);
+            Py_XDECREF(result);
+            PyErr_Clear();
+            Py_CLEAR(reader_loop);
+        }
+        result = PyObject_CallMethod(loop, "add_reader", "iO", wakeup[0], drain_callback);
+        if (result == NULL) {
+            Py_DECREF(loop);
+            return NULL;
+        }
+        Py_DECREF(result);
+        reader_loop = loop;
+        Py_INCREF(reader_loop);
+    }
+    future = PyObject_CallMethod(loop, "create_future", NULL);
+    Py_DECREF(loop);
+    if (future == NULL) return NULL;
+    *id = ++last_request;
+    key = PyLong_FromLongLong(*id);
+    if (key == NULL || PyDict_SetItem(pending, key, future) < 0) {
+        Py_XDECREF(key);
+        Py_DECREF(future);
+        return NULL;
+    }
+    Py_DECREF(key);
+    return future;
+}
+
+static PyObject* greetAsync(T_(Session) session) {
+    long long id;
+    PyObject* future = newRequest(&id);
+    if (future != NULL) {
+        __ kotlin.root.demo.Dispatcher.greet(dispatcher, getServer(), session, id, (void*)complete);
+    }
+    return future;
+}
+
+static PyObject* concatAsync(T_(Session) session, const char* a, const char* b) {
+    long long id;
+    PyObject* future = newRequest(&id);
+    if (future != NULL) {
+        __ kotlin.root.demo.Dispatcher.concat(dispatcher, getServer(), session, a, b, id, (void*)complete);
+    }
+    return future;
+}
+
+static PyObject* addAsync(T_(Session) session, int a, int b) {
+    long long id;
+    PyObject* future = newRequest(&id);
+    if (future != NULL) {
+        __ kotlin.root.demo.Dispatcher.add(dispatcher, getServer(), session, a, b, id, (void*)complete);
+    }
+    return future;
+}
+
+static PyObject* greet_server_async(PyObject* self, PyObject* args) {
+    long long session_arg;
+    T_(Session) session;
+    if (!PyArg_ParseTuple(args, "L", &session_arg)) return NULL;
+    session.pinned = (void*)(uintptr_t)session_arg;
+    return greetAsync(session);
+}
+
+static PyObject* concat_server_async(PyObject* self, PyObject* args) {
+    long long session_arg;
+    char* string_arg1 = NULL;
+    char* string_arg2 = NULL;
+    T_(Session) session;
+    if (!PyArg_ParseTuple(args, "Lss", &session_arg, &string_arg1, &string_arg2)) return NULL;
+    session.pinned = (void*)(uintptr_t)session_arg;
+    return concatAsync(session, string_arg1, string_arg2);
+}
+
+static PyObject* add_server_async(PyObject* self, PyObject* args) {
+    long long session_arg;
+    int int_arg1 = 0;
+    int int_arg2 = 0;
+    T_(Session) session;
+    if (!PyArg_ParseTuple(args, "Lii", &session_arg, &int_arg1, &int_arg2)) return NULL;
+    session.pinned = (void*)(uintptr_t)session_arg;
+    return addAsync(session, int_arg1, int_arg2);
+}
+
+#endif
+
+#if PY_VERSION_HEX >= 0x03070000
+
+// kotlin_bridge.Session owns the stable pointer of a demo.Session, disposed of by close(), at the end of a `with`
+// block or when the object is collected. Its methods are called with METH_FASTCALL, no argument tuples are built.
+
+typedef struct {
+    PyObject_HEAD
+    T_(Session) session;
+    // Calls in progress, the session is only disposed of once they are done, see `concurrent`.
+    int calls;
+    int closed;
+} SessionObject;
+
+static void disposeSession(SessionObject* self) {
+    if (self->session.pinned && self->calls == 0) {
+        disposeStablePointer(self->session.pinned);
+        self->session.pinned = NULL;
+    }
+}
+
+static int enterSession(SessionObject* self, T_(Session)* session) {
+    if (self->closed) {
+        PyErr_SetString(PyExc_ValueError, "session is closed");
+        return 0;
+    }
+    self->calls++;
+    *session = self->session;
+    return 1;
+}
+
+static PyObject* leaveSession(SessionObject* self, PyObject* result) {
+    self->calls--;
+    if (self->closed) disposeSession(self);
+    return result;
+}
+
+static int checkArgs(const char* name, Py_ssize_t nargs, Py_ssize_t min, Py_ssize_t max) {
+    if (nargs >= min && nargs <= max) return 1;
+    if (min == max) {
+        PyErr_Format(PyExc_TypeError, "%s() takes %zd arguments (%zd given)", name, min, nargs);
+    } else {
+        PyErr_Format(PyExc_TypeError, "%s() takes %zd to %zd arguments (%zd given)", name, min, max, nargs);
+    }
+    return 0;
+}
+
+static int toInt(PyObject* object, int* value) {
+    long result = PyLong_AsLong(object);
+    if (result == -1 && PyErr_Occurred()) return 0;
+    if (result < INT_MIN || result > INT_MAX) {
+        PyErr_SetString(PyExc_OverflowError, "argument does not fit in a 32-bit integer");
+        return 0;
+    }
+    *value = (int)result;
+    return 1;
+}
+
+static const char* toString(PyObject* object) {
+    if (!PyUnicode_Check(object)) {
+        PyErr_Format(PyExc_TypeError, "expected str, got %.200s", Py_TYPE(object)->tp_name);
+        return NULL;
+    }
+    return PyUnicode_AsUTF8(object);
+}
+
+static PyObject* Session_new(PyTypeObject* type, PyObject* args, PyObject* kwargs) {
+    static char* keywords[] = { "number", "name", NULL };
+    char* name = NULL;
+    int number = 0;
+    SessionObject* self;
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "is", keywords, &number, &name)) return NULL;
+    self = (SessionObject*)type->tp_alloc(type, 0);
+    if (self != NULL) {
+        T_(Session) session;
+        KOTLIN_CALL(session = __ kotlin.root.demo.Session.Session(name, number);)
+        stable_pointers++;
+        self->session = session;
+    }
+    return (PyObject*)self;
+}
+
+static void Session_dealloc(SessionObject* self) {
+    self->closed = 1;
+    disposeSession(self);
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+static PyObject* Session_close(SessionObject* self, PyObject* unused) {
+    self->closed = 1;
+    disposeSession(self);
+    Py_RETURN_NONE;
+}
+
+static PyObject* Session_enter(SessionObject* self, PyObject* unused) {
+    Py_INCREF(self);
+    return (PyObject*)self;
+}
+
+static PyObject* Session_exit(SessionObject* self, PyObject* const* args, Py_ssize_t nargs) {
+    return Session_close(self, NULL);
+}
+
+static PyObject* Session_greet(SessionObject* self, PyObject* const* args, Py_ssize_t nargs) {
+    T_(Session) session;
+    if (!checkArgs("greet", nargs, 0, 0) || !enterSession(self, &session)) return NULL;
+    return leaveSession(self, greet(session));
+}
+
+static PyObject* Session_concat(SessionObject* self, PyObject* const* args, Py_ssize_t nargs) {
+    T_(Session) session;
+    const char* a;
+    const char* b;
+    if (!checkArgs("concat", nargs, 2, 2)) return NULL;
+    if ((a = toString(args[0])) == NULL || (b = toString(args[1])) == NULL) return NULL;
+    if (!enterSession(self, &session)) return NULL;
+    return leaveSession(self, concat(session, a, b));
+}
+
+static PyObject* Session_add(SessionObject* self, PyObject* const* args, Py_ssize_t nargs) {
+    T_(Session) session;
+    int a, b;
+    if (!checkArgs("add", nargs, 2, 2) || !toInt(args[0], &a) || !toInt(args[1], &b)) return NULL;
+    if (!enterSession(self, &session)) return NULL;
+    return leaveSession(self, add(session, a, b));
+}
+
+static PyObject* Session_add_batch(SessionObject* self, PyObject* const* args, Py_ssize_t nargs) {
+    T_(Session) session;
+    if (!checkArgs("add_batch", nargs, 2, 3) || !enterSession(self, &session)) return NULL;
+    return leaveSession(self, addBatch(session, args[0], args[1], nargs > 2 ? args[2] : NULL));
+}
+
+static PyObject* Session_concat_batch(SessionObject* self, PyObject* const* args, Py_ssize_t nargs) {
+    T_(Session) session;
+    if (!checkArgs("concat_batch", nargs, 2, 3) || !enterSession(self, &session)) return NULL;
+    return leaveSession(self, concatBatch(session, args[0], args[1], nargs > 2 ? args[2] : NULL));
+}
+
+static PyObject* Session_greet_bytes(SessionObject* self, PyObject* const* args, Py_ssize_t nargs) {
+    T_(Session) session;
+    if (!checkArgs("greet_bytes", nargs, 0, 1) || !enterSession(self, &session)) return NULL;
+    return leaveSession(self, greetBytes(session, nargs > 0 ? args[0] : NULL));
+}
+
+static PyObject* Session_concat_bytes(SessionObject* self, PyObject* const* args, Py_ssize_t nargs) {
+    T_(Session) session;
+    if (!checkArgs("concat_bytes", nargs, 2, 3) || !enterSession(self, &session)) return NULL;
+    return leaveSession(self, concatBytes(session, args[0], args[1], nargs > 2 ? args[2] : NULL));
+}
+
+#ifndef _WIN32
+
+// Requests in flight hold their demo.Session, so the session may be closed before they are done.
+
+static PyObject* Session_greet_async(SessionObject* self, PyObject* const* args, Py_ssize_t nargs) {
+    T_(Session) session;
+    if (!checkArgs("greet_async", nargs, 0, 0) || !enterSession(self, &session)) return NULL;
+    return leaveSession(self, greetAsync(session));
+}
+
+static PyObject* Session_concat_async(SessionObject* self, PyObject* const* args, Py_ssize_t nargs) {
+    T_(Session) session;
+    const char* a;
+    const char* b;
+    if (!checkArgs("concat_async", nargs, 2, 2)) return NULL;
+    if ((a = toString(args[0])) == NULL || (b = toString(args[1])) == NULL) return NULL;
+    if (!enterSession(self, &session)) return NULL;
+    return leaveSession(self, concatAsync(session, a, b));
+}
+
+static PyObject* Session_add_async(SessionObject* self, PyObject* const* args, Py_ssize_t nargs) {
+    T_(Session) session;
+    int a, b;
+    if (!checkArgs("add_async", nargs, 2, 2) || !toInt(args[0], &a) || !toInt(args[1], &b)) return NULL;
+    if (!enterSession(self, &session)) return NULL;
+    return leaveSession(self, addAsync(session, a, b));
+}
+
+#endif
+
+static PyObject* Session_get_closed(SessionObject* self, void* unused) {
+    return PyBool_FromLong(self->closed);
+}
+
+static PyMethodDef Session_methods[] = {
+   { "greet", (PyCFunction)(void(*)(void))Session_greet, METH_FASTCALL, "Greeting service" },
+   { "concat", (PyCFunction)(void(*)(void))Session_concat, METH_FASTCALL, "Concatenation service: concat(a, b)" },
+   { "add", (PyCFunction)(void(*)(void))Session_add, METH_FASTCALL, "Addition service: add(a, b)" },
+   { "add_batch", (PyCFunction)(void(*)(void))Session_add_batch, METH_FASTCALL,
+     "Addition service for batches: add_batch(a, b[, out]) -> out" },
+   { "concat_batch", (PyCFunction)(void(*)(void))Session_concat_batch, METH_FASTCALL,
+     "Concatenation service for batches: concat_batch(a, b[, out]) -> out" },
+   { "greet_bytes", (PyCFunction)(void(*)(void))Session_greet_bytes, METH_FASTCALL,
+     "Greeting service for bytes: greet_bytes([out]) -> bytes, or size written to out" },
+   { "concat_bytes", (PyCFunction)(void(*)(void))Session_concat_bytes, METH_FASTCALL,
+     "Concatenation service for bytes-like payloads: concat_bytes(a, b[, out]) -> bytes, or size written to out" },
+#ifndef _WIN32
+   { "greet_async", (PyCFunction)(void(*)(void))Session_greet_async, METH_FASTCALL,
+     "Greeting service, returns an asyncio future" },
+   { "concat_async", (PyCFunction)(void(*)(void))Session_concat_async, METH_FASTCALL,
+     "Concatenation service, returns an asyncio future" },
+   { "add_async", (PyCFunction)(void(*)(void))Session_add_async, METH_FASTCALL,
+     "Addition service, returns an asyncio future" },
+#endif
+   { "close", (PyCFunction)Session_close, METH_NOARGS, "Disposes of the session" },
+   { "__enter__", (PyCFunction)Session_enter, METH_NOARGS, NULL },
+   { "__exit__", (PyCFunction)(void(*)(void))Session_exit, METH_FASTCALL, NULL },
+   { NULL }
+};
+
+static PyGetSetDef Session_getset[] = {
+   { "closed", (getter)Session_get_closed, NULL, "Whether the session is closed", NULL },
+   { NULL }
+};
+
+static PyTypeObject SessionType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "kotlin_bridge.Session",
+    .tp_doc = "Session(number, name), a demo.Session with its server operations",
+    .tp_basicsize = sizeof(SessionObject),
+    .tp_flags = Py_TPFLAGS_DEFAULT,
+    .tp_new = Session_new,
+    .tp_dealloc = (destructor)Session_dealloc,
+    .tp_methods = Session_methods,
+    .tp_getset = Session_getset,
+};
+
+#endif
+
+static PyObject* set_concurrent(PyObject* self, PyObject* args) {
+    int previous = concurrent;
+    int enabled = 0;
+    if (!PyArg_ParseTuple(args, "i", &enabled)) return NULL;
+    concurrent = enabled;
+    return PyBool_FromLong(previous);
+}
+
+static PyObject* stable_pointers_count(PyObject* self, PyObject* unused) {
+    return Py_BuildValue("n", stable_pointers);
+}
+
 static PyMethodDef kotlin_bridge_funcs[] = {
    { "open_session", (PyCFunction)open_session, METH_VARARGS, "Opens a session" },
    { "close_session", (PyCFunction)close_session, METH_VARARGS, "Closes the session" },
    { "greet_server", (PyCFunction)greet_server, METH_VARARGS, "Greeting service" },
    { "concat_server", (PyCFunction)concat_server, METH_VARARGS, "Concatenation service" },
    { "add_server", (PyCFunction)add_server, METH_VARARGS, "Addition service" },
+   { "set_concurrent", (PyCFunction)set_concurrent, METH_VARARGS,
+     "Releases the GIL around Kotlin calls if enabled, returns the previous mode" },
+   { "stable_pointers", (PyCFunction)stable_pointers_count, METH_NOARGS,
+     "Number of Kotlin objects currently referenced by the bridge" },
+#if PY_MAJOR_VERSION >= 3
+   { "add_server_batch", (PyCFunction)add_server_batch, METH_VARARGS,
+     "Addition service for batches: add_server_batch(session, a, b[, out]) -> out" },
+   { "concat_server_batch", (PyCFunction)concat_server_batch, METH_VARARGS,
+     "Concatenation service for batches: concat_server_batch(session, a, b[, out]) -> out" },
+   { "greet_server_bytes", (PyCFunction)greet_server_bytes, METH_VARARGS,
+     "Greeting service for bytes: greet_server_bytes(session[, out]) -> bytes, or size written to out" },
+   { "concat_server_bytes", (PyCFunction)concat_server_bytes, METH_VARARGS,
+     "Concatenation service for bytes-like payloads: concat_server_bytes(session, a, b[, out]) -> bytes, or size written to out" },
+#endif
+#if PY_MAJOR_VERSION >= 3 && !defined(_WIN32)
+   { "greet_server_async", (PyCFunction)greet_server_async, METH_VARARGS, "Greeting service, returns an asyncio future" },
+   { "concat_server_async", (PyCFunction)concat_server_async, METH_VARARGS,
+     "Concatenation service, returns an asyncio future" },
+   { "add_server_async", (PyCFunction)add_server_async, METH_VARARGS, "Addition service, returns an asyncio future" },
+#endif
    { NULL }
 };
 
@@ -122,6 +1125,16 @@ static int kotlin_bridge_clear(PyObject *m) {
     return 0;
 }
 
+static void kotlin_bridge_free(void *m) {
+#ifndef _WIN32
+    stopDispatcher();
+#endif
+    if (server.pinned) {
+        disposeStablePointer(server.pinned);
+        server.pinned = 0;
+    }
+}
+
 static struct PyModuleDef moduledef = {
         PyModuleDef_HEAD_INIT,
         "kotlin_bridge",
@@ -131,11 +1144,27 @@ static struct PyModuleDef moduledef = {
         NULL,
         kotlin_bridge_traverse,
         kotlin_bridge_clear,
-        NULL
+        kotlin_bridge_free
 };
 
 PyMODINIT_FUNC PyInit_kotlin_bridge(void) {
    PyObject *module = PyModule_Create(&moduledef);
+#if PY_VERSION_HEX >= 0x03070000
+   if (module == NULL) {
+       return NULL;
+   }
+   if (PyType_Ready(&SessionType) < 0) {
+       Py_DECREF(module);
+       return NULL;
+   }
+   // PyModule_AddObject() steals the reference only if it succeeds.
+   Py_INCREF(&SessionType);
+   if (PyModule_AddObject(module, "Session", (PyObject*)&SessionType) < 0) {
+       Py_DECREF(&SessionType);
+       Py_DECREF(module);
+       return NULL;
+   }
+#endif
    return module;
 }
 #else
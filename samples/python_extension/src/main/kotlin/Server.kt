@@ -5,10 +5,124 @@
 
 package demo
 
-class Session(val name: String, val number: Int)
+import kotlin.native.concurrent.*
+import kotlinx.cinterop.*
+import platform.posix.memcpy
+
+// Both classes are immutable and frozen once constructed, so that the Python bridge may share them between threads.
+
+class Session(val name: String, val number: Int) {
+    init {
+        freeze()
+    }
+}
 
 class Server(val prefix: String) {
+    init {
+        freeze()
+    }
+
     fun greet(session: Session) = "$prefix: Hello from Kotlin/Native in ${session}"
     fun concat(session: Session, a: String, b: String) = "$prefix: $a $b in ${session}"
     fun add(session: Session, a: Int, b: Int) = a + b + session.number
+
+    // Batch variants process `count` items of C arrays owned by the caller in a single call.
+
+    fun addBatch(session: Session, a: CPointer<IntVar>, b: CPointer<IntVar>, sums: CPointer<IntVar>, count: Int) {
+        val number = session.number
+        for (i in 0 until count) {
+            sums[i] = a[i] + b[i] + number
+        }
+    }
+
+    // Writes UTF-8 of the results one after another to `buffer` and the end offset of each one to `ends`.
+    // Returns the size of the results, if it exceeds `capacity` nothing is written.
+    fun concatBatch(session: Session, a: CPointer<CPointerVar<ByteVar>>, b: CPointer<CPointerVar<ByteVar>>, count: Int,
+                    buffer: CPointer<ByteVar>, capacity: Long, ends: CPointer<LongVar>): Long {
+        val results = Array(count) { concat(session, a[it]!!.toKString(), b[it]!!.toKString()).encodeToByteArray() }
+        val size = results.fold(0L) { size, result -> size + result.size }
+        if (size > capacity) return size
+        var offset = 0L
+        results.forEachIndexed { index, result ->
+            offset = buffer.put(offset, result)
+            ends[index] = offset
+        }
+        return size
+    }
+
+    // Bytes variants: UTF-8 payloads are copied from the caller's memory straight to `buffer`, no Kotlin strings are
+    // made of them. Return the size of the result, if it exceeds `capacity` nothing is written.
+
+    fun greetBytes(session: Session, buffer: CPointer<ByteVar>, capacity: Long): Long {
+        val result = greet(session).encodeToByteArray()
+        if (result.size > capacity) return result.size.toLong()
+        return buffer.put(0L, result)
+    }
+
+    fun concatBytes(session: Session, a: CPointer<ByteVar>, aSize: Long, b: CPointer<ByteVar>, bSize: Long,
+                    buffer: CPointer<ByteVar>, capacity: Long): Long {
+        val head = "$prefix: ".encodeToByteArray()
+        val tail = " in ${session}".encodeToByteArray()
+        val size = head.size + aSize + 1 + bSize + tail.size
+        if (size > capacity) return size
+        var offset = buffer.put(0L, head)
+        memcpy(buffer + offset, a, aSize.convert())
+        offset += aSize
+        buffer[offset++] = ' '.toByte()
+        memcpy(buffer + offset, b, bSize.convert())
+        offset += bSize
+        return buffer.put(offset, tail)
+    }
+
+    private fun CPointer<ByteVar>.put(offset: Long, bytes: ByteArray): Long {
+        if (bytes.isNotEmpty()) {
+            bytes.usePinned { memcpy(this + offset, it.addressOf(0), bytes.size.convert()) }
+        }
+        return offset + bytes.size
+    }
+}
+
+// C function called on a worker thread once a request is done: (request id, failed, string result or error, Int result).
+typealias Completion = CFunction<(Long, Int, CPointer<ByteVar>?, Int) -> Unit>
+
+// Runs requests on a pool of workers instead of the calling thread, results are passed to `completion`.
+class Dispatcher(size: Int) {
+    private val workers = Array(size) { Worker.start(name = "kotlin_bridge-$it") }
+    private val next = AtomicInt(0)
+
+    init {
+        freeze()
+    }
+
+    fun greet(server: Server, session: Session, id: Long, completion: CPointer<Completion>) =
+            submit(id, completion) { server.greet(session) }
+
+    fun concat(server: Server, session: Session, a: String, b: String, id: Long, completion: CPointer<Completion>) =
+            submit(id, completion) { server.concat(session, a, b) }
+
+    fun add(server: Server, session: Session, a: Int, b: Int, id: Long, completion: CPointer<Completion>) =
+            submit(id, completion) { server.add(session, a, b) }
+
+    fun stop() {
+        workers.forEach { it.requestTermination().result }
+    }
+
+    private fun submit(id: Long, completion: CPointer<Completion>, request: () -> Any) {
+        val operation = {
+            val result = try {
+                request()
+            } catch (e: Throwable) {
+                e
+            }
+            memScoped {
+                when (result) {
+                    is String -> completion(id, 0, result.cstr.ptr, 0)
+                    is Int -> completion(id, 0, null, result)
+                    else -> completion(id, 1, result.toString().cstr.ptr, 0)
+                }
+            }
+        }
+        val index = (next.addAndGet(1) and Int.MAX_VALUE) % workers.size
+        workers[index].executeAfter(0L, operation.freeze())
+    }
 }
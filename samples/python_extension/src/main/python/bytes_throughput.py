@@ -0,0 +1,41 @@
+#!/usr/bin/python3
+#
+# Copyright 2010-2018 JetBrains s.r.o. Use of this source code is governed by the Apache 2.0 license
+# that can be found in the license/LICENSE.txt file.
+#
+
+# Throughput of concatenation of 1 KB to 100 MB payloads through the str, bytes and bytes with output buffer paths.
+
+import time
+
+import kotlin_bridge
+
+SIZES = [1 << 10, 64 << 10, 1 << 20, 16 << 20, 100 << 20]
+# Each measurement moves about this many bytes, so that small payloads are measured over many calls.
+VOLUME = 256 << 20
+
+
+def measure(call, size):
+    repeat = max(1, VOLUME // size)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        call()
+    return size * repeat / (time.perf_counter() - start)
+
+
+def main():
+    with kotlin_bridge.Session(239, 'konan') as session:
+        print('{:>10} {:>14} {:>14} {:>14}'.format('payload', 'str MB/s', 'bytes MB/s', 'buffer MB/s'))
+        for size in SIZES:
+            text = 'a' * size
+            payload = text.encode()
+            out = bytearray(size + 1024)
+            paths = [lambda: session.concat(text, 'fun'),
+                     lambda: session.concat_bytes(payload, b'fun'),
+                     lambda: session.concat_bytes(payload, b'fun', out)]
+            print('{:>10} {:>14.0f} {:>14.0f} {:>14.0f}'.format(
+                '{} KB'.format(size >> 10), *[measure(path, size) / 1e6 for path in paths]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,528 @@
+#
+# Copyright 2010-2018 JetBrains s.r.o. Use of this source code is governed by the Apache 2.0 license
+# that can be found in the license/LICENSE.txt file.
+#
+
+# Serving mode running kotlin_bridge in a pool of worker processes, each with a libserver of its own, so that a single
+# Python process may keep every core busy with `demo.Server` work. Requests and responses are packed with `struct`
+# and travel through rings in shared memory, nothing is pickled. Python 3.8+ (multiprocessing.shared_memory).
+#
+#    with ServerPool() as pool:
+#        session = pool.open_session(239, 'konan')
+#        pool.add_server(session, 1, 2)
+#        futures = [pool.submit('add_server', session, i, i) for i in range(1000)]
+#        pool.close_session(session)
+
+import array
+import itertools
+import multiprocessing
+import os
+import struct
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+
+# Both sides run on the same machine, so native byte order and sizes are used throughout. Headers are padded to
+# 16 bytes to keep the arrays following them aligned.
+_COUNTER = struct.Struct('=Q')
+_SIZE = struct.Struct('=I')
+_REQUEST = struct.Struct('=QBI3x')  # request id, operation, session
+_RESPONSE = struct.Struct('=QB7x')  # request id, failed
+_INT = struct.Struct('=i')
+_INTS = struct.Struct('=ii')
+
+# A ring starts with the total numbers of bytes written (head) and read (tail), each on a cache line of its own.
+# Messages are their size followed by the payload, padded to 8 bytes; a size of _WRAP skips to the start.
+_HEAD = 0
+_TAIL = 64
+_DATA = 128
+_WRAP = 0xffffffff
+
+_STOP, _OPEN_SESSION, _CLOSE_SESSION, _GREET, _CONCAT, _ADD, _ADD_BATCH, _CONCAT_BATCH, _STABLE_POINTERS = range(9)
+
+RING_CAPACITY = 4 << 20
+# Batches are split in chunks of up to this many items spread over the workers.
+BATCH_CHUNK = 4096
+# Bytes demo.Server adds to each result of concat_server_batch at most, used to size chunks of string batches.
+_CONCAT_OVERHEAD = 64
+# Seconds between checks that workers are still alive, whether responses keep coming or not.
+_POLL_INTERVAL = 1.0
+
+
+def _align(size):
+    return (size + 7) & ~7
+
+
+class _Ring(object):
+    # Queue of messages in shared memory with a single producer and a single consumer.
+
+    def __init__(self, memory, capacity):
+        self.memory = memory
+        self.buffer = memory.buf
+        self.capacity = capacity
+
+    def _get(self, offset):
+        return _COUNTER.unpack_from(self.buffer, offset)[0]
+
+    def _set(self, offset, value):
+        _COUNTER.pack_into(self.buffer, offset, value)
+
+    def empty(self):
+        return self._get(_HEAD) == self._get(_TAIL)
+
+    # Returns False if there is no room for the message at the moment.
+    def put(self, parts):
+        parts = [memoryview(part).cast('B') for part in parts]
+        size = sum(len(part) for part in parts)
+        needed = _align(_SIZE.size + size)
+        # Up to `needed` bytes may be skipped at the end, so a larger message might never fit.
+        if needed > self.capacity // 2:
+            raise ValueError('message of {} bytes does not fit in a ring of {} bytes'.format(size, self.capacity))
+        head = self._get(_HEAD)
+        position = head % self.capacity
+        skip = self.capacity - position if position + needed > self.capacity else 0
+        if head + skip + needed - self._get(_TAIL) > self.capacity:
+            return False
+        if skip:
+            _SIZE.pack_into(self.buffer, _DATA + position, _WRAP)
+            position = 0
+        offset = _DATA + position
+        _SIZE.pack_into(self.buffer, offset, size)
+        offset += _SIZE.size
+        for part in parts:
+            self.buffer[offset:offset + len(part)] = part
+            offset += len(part)
+        self._set(_HEAD, head + skip + needed)
+        return True
+
+    # Returns a copy of the oldest message, or None if there is none.
+    def get(self):
+        tail = self._get(_TAIL)
+        if tail == self._get(_HEAD):
+            return None
+        position = tail % self.capacity
+        size = _SIZE.unpack_from(self.buffer, _DATA + position)[0]
+        if size == _WRAP:
+            tail += self.capacity - position
+            position = 0
+            size = _SIZE.unpack_from(self.buffer, _DATA)[0]
+        start = _DATA + position + _SIZE.size
+        message = bytes(self.buffer[start:start + size])
+        self._set(_TAIL, tail + _align(_SIZE.size + size))
+        return message
+
+    def close(self):
+        self.buffer.release()
+        self.memory.close()
+
+
+def _encode(string):
+    if not isinstance(string, str):
+        raise TypeError('expected str, got {}'.format(type(string).__name__))
+    return string.encode()
+
+
+def _pack_strings(encoded):
+    return [_SIZE.pack(len(encoded)), array.array('I', [len(item) for item in encoded]), b''.join(encoded)]
+
+
+def _unpack_strings(payload, decode):
+    count = _SIZE.unpack_from(payload)[0]
+    offset = _SIZE.size + count * 4
+    sizes = memoryview(payload)[_SIZE.size:offset].cast('I')
+    strings = []
+    for size in sizes:
+        strings.append(decode(payload[offset:offset + size]))
+        offset += size
+    return strings, payload[offset:]
+
+
+def _ints(values):
+    try:
+        view = memoryview(values)
+        if view.format == 'i' and view.c_contiguous:
+            return view.cast('B').cast('i')
+    except TypeError:
+        pass
+    return memoryview(array.array('i', values))
+
+
+# Operations run by workers: (kotlin_bridge, sessions of the worker, session, payload) -> parts of the response.
+
+def _open_session(bridge, sessions, session, payload):
+    number = _INT.unpack_from(payload)[0]
+    sessions[session] = bridge.open_session(number, bytes(payload[_INT.size:]).decode())
+    return []
+
+
+def _close_session(bridge, sessions, session, payload):
+    bridge.close_session(sessions.pop(session))
+    return []
+
+
+def _greet(bridge, sessions, session, payload):
+    return [bridge.greet_server_bytes(sessions[session])]
+
+
+def _concat(bridge, sessions, session, payload):
+    size = _SIZE.unpack_from(payload)[0]
+    start = _SIZE.size
+    return [bridge.concat_server_bytes(sessions[session], payload[start:start + size], payload[start + size:])]
+
+
+def _add(bridge, sessions, session, payload):
+    return [_INT.pack(bridge.add_server(sessions[session], *_INTS.unpack(payload)))]
+
+
+def _add_batch(bridge, sessions, session, payload):
+    half = len(payload) // 2
+    return [bridge.add_server_batch(sessions[session], payload[:half].cast('i'), payload[half:].cast('i'))]
+
+
+def _concat_batch(bridge, sessions, session, payload):
+    a, rest = _unpack_strings(payload, _decode)
+    b, _ = _unpack_strings(rest, _decode)
+    return _pack_strings([result.encode() for result in bridge.concat_server_batch(sessions[session], a, b)])
+
+
+def _stable_pointers(bridge, sessions, session, payload):
+    return [_COUNTER.pack(bridge.stable_pointers())]
+
+
+_OPERATIONS = {
+    _OPEN_SESSION: _open_session,
+    _CLOSE_SESSION: _close_session,
+    _GREET: _greet,
+    _CONCAT: _concat,
+    _ADD: _add,
+    _ADD_BATCH: _add_batch,
+    _CONCAT_BATCH: _concat_batch,
+    _STABLE_POINTERS: _stable_pointers,
+}
+
+
+def _put(ring, parts, taken, alive=None):
+    while not ring.put(parts):
+        if not taken.acquire(timeout=_POLL_INTERVAL) and alive is not None and not alive():
+            raise RuntimeError('worker process exited')
+
+
+def _serve(requests_name, responses_name, capacity, requests_ready, requests_taken, responses_ready, responses_taken):
+    import kotlin_bridge
+
+    # Segments belong to the pool, which unlinks them.
+    requests = _Ring(shared_memory.SharedMemory(requests_name), capacity)
+    responses = _Ring(shared_memory.SharedMemory(responses_name), capacity)
+    sessions = {}
+    try:
+        while True:
+            requests_ready.acquire()
+            message = memoryview(requests.get())
+            requests_taken.release()
+            id, operation, session = _REQUEST.unpack_from(message)
+            if operation == _STOP:
+                break
+            try:
+                response = [_RESPONSE.pack(id, 0)] + _OPERATIONS[operation](
+                    kotlin_bridge, sessions, session, message[_REQUEST.size:])
+                _put(responses, response, responses_taken)
+            except Exception as e:
+                if isinstance(e, KeyError) and e.args == (session,):
+                    e = 'unknown session {}'.format(session)
+                _put(responses, [_RESPONSE.pack(id, 1), str(e).encode()], responses_taken)
+            responses_ready.release()
+    finally:
+        for handle in sessions.values():
+            kotlin_bridge.close_session(handle)
+        requests.close()
+        responses.close()
+
+
+class _Worker(object):
+
+    def __init__(self, context, capacity, responses_ready):
+        size = _DATA + capacity
+        self.requests = _Ring(shared_memory.SharedMemory(create=True, size=size), capacity)
+        self.responses = _Ring(shared_memory.SharedMemory(create=True, size=size), capacity)
+        self.requests_ready = context.Semaphore(0)
+        self.requests_taken = context.Semaphore(0)
+        self.responses_taken = context.Semaphore(0)
+        self.process = context.Process(target=_serve, daemon=True, args=(
+            self.requests.memory.name, self.responses.memory.name, capacity,
+            self.requests_ready, self.requests_taken, responses_ready, self.responses_taken))
+        self.process.start()
+        # Requests sent and not answered yet, guarded by the lock of the pool.
+        self.outstanding = 0
+        self.exited = False
+        self.lock = threading.Lock()
+
+    def send(self, parts):
+        with self.lock:
+            _put(self.requests, parts, self.requests_taken, self.process.is_alive)
+            self.requests_ready.release()
+
+    def release(self):
+        for ring in (self.requests, self.responses):
+            ring.close()
+            ring.memory.unlink()
+
+
+def _decode(payload):
+    return bytes(payload).decode()
+
+
+def _decode_int(payload):
+    return _INT.unpack(payload)[0]
+
+
+def _decode_counter(payload):
+    return _COUNTER.unpack(payload)[0]
+
+
+def _decode_none(payload):
+    return None
+
+
+def _decode_strings(payload):
+    return _unpack_strings(payload, _decode)[0]
+
+
+class ServerPool(object):
+    # Runs `processes` workers (one per CPU by default). Requests go to the worker with the fewest outstanding ones,
+    # sessions are opened in every worker, so that any of them may serve any session. `capacity` is the size of each
+    # ring in bytes, a single message shall not exceed half of it.
+
+    def __init__(self, processes=None, capacity=RING_CAPACITY):
+        context = multiprocessing.get_context('spawn')
+        self._ids = itertools.count(1)
+        self._sessions = itertools.count(1)
+        # Request id -> (future, worker, decode), guarded by `_lock`.
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._closed = False
+        self._stopped = False
+        capacity = self._capacity = _align(capacity)
+        # A chunk of a batch of ints takes a quarter of a ring at most.
+        self._chunk = max(1, min(BATCH_CHUNK, capacity // 32))
+        self._responses_ready = context.Semaphore(0)
+        self._workers = [_Worker(context, capacity, self._responses_ready)
+                         for _ in range(processes or os.cpu_count() or 1)]
+        self._reader = threading.Thread(target=self._read, name='kotlin_bridge_pool', daemon=True)
+        self._reader.start()
+
+    def open_session(self, number, name):
+        session = next(self._sessions)
+        payload = [_INT.pack(number), _encode(name)]
+        self._broadcast(_OPEN_SESSION, session, payload)
+        return session
+
+    def close_session(self, session):
+        self._broadcast(_CLOSE_SESSION, session, [])
+        return 0
+
+    def greet_server(self, session):
+        return self.submit('greet_server', session).result()
+
+    def concat_server(self, session, a, b):
+        return self.submit('concat_server', session, a, b).result()
+
+    def add_server(self, session, a, b):
+        return self.submit('add_server', session, a, b).result()
+
+    # Batches are split in chunks served by all workers at once.
+
+    def add_server_batch(self, session, a, b, out=None):
+        a, b = _ints(a), _ints(b)
+        if len(a) != len(b):
+            raise ValueError('batches differ in length')
+        if out is None:
+            out = array.array('i', bytes(len(a) * 4))
+        sums = memoryview(out).cast('B').cast('i')
+        if len(sums) < len(a):
+            raise ValueError('output is shorter than the batch')
+
+        def chunk(start, end):
+            def decode(payload):
+                sums[start:end] = memoryview(payload).cast('i')
+            return self._submit(_ADD_BATCH, session, [a[start:end], b[start:end]], decode)
+
+        self._wait([chunk(start, min(start + self._chunk, len(a))) for start in range(0, len(a), self._chunk)])
+        return out
+
+    def concat_server_batch(self, session, a, b, out=None):
+        a, b = [_encode(item) for item in a], [_encode(item) for item in b]
+        if len(a) != len(b):
+            raise ValueError('batches differ in length')
+
+        def chunk(start, end):
+            return self._submit(_CONCAT_BATCH, session, _pack_strings(a[start:end]) + _pack_strings(b[start:end]),
+                                _decode_strings)
+
+        # Requests and results of a chunk take a quarter of a ring at most, unless a single item is larger.
+        futures = []
+        start = size = 0
+        for end in range(len(a)):
+            item = len(a[end]) + len(b[end]) + _CONCAT_OVERHEAD
+            if end > start and (size + item > self._capacity // 4 or end - start == self._chunk):
+                futures.append(chunk(start, end))
+                start, size = end, 0
+            size += item
+        if start < len(a):
+            futures.append(chunk(start, len(a)))
+        self._wait(futures)
+        results = [result for future in futures for result in future.result()]
+        if out is None:
+            return results
+        for i, result in enumerate(results):
+            out[i] = result
+        return out
+
+    # Sends a request without waiting for it, returns a concurrent.futures.Future of its result. `function` is one of
+    # 'greet_server', 'concat_server' and 'add_server', taking the same arguments as the method of that name.
+    def submit(self, function, session, *args):
+        if function == 'greet_server' and not args:
+            return self._submit(_GREET, session, [], _decode)
+        if function == 'concat_server' and len(args) == 2:
+            a = _encode(args[0])
+            return self._submit(_CONCAT, session, [_SIZE.pack(len(a)), a, _encode(args[1])], _decode)
+        if function == 'add_server' and len(args) == 2:
+            return self._submit(_ADD, session, [_INTS.pack(*args)], _decode_int)
+        raise TypeError('cannot submit {}() with {} arguments'.format(function, len(args) + 1))
+
+    # Number of Kotlin objects referenced by the kotlin_bridge of all workers, see kotlin_bridge.stable_pointers().
+    def stable_pointers(self):
+        return sum(self._broadcast(_STABLE_POINTERS, 0, [], _decode_counter))
+
+    # Waits for the requests in progress and stops the workers.
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        for worker in self._workers:
+            try:
+                worker.send([_REQUEST.pack(0, _STOP, 0)])
+            except RuntimeError:
+                pass
+        for worker in self._workers:
+            worker.process.join()
+        self._stopped = True
+        self._responses_ready.release()
+        self._reader.join()
+        self._fail(lambda worker: True, 'server pool is closed')
+        for worker in self._workers:
+            worker.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _submit(self, operation, session, parts, decode, worker=None):
+        future = Future()
+        chosen = worker
+        while True:
+            with self._lock:
+                if self._closed:
+                    raise ValueError('server pool is closed')
+                if chosen is None:
+                    workers = [worker for worker in self._workers if not worker.exited]
+                    if not workers:
+                        raise RuntimeError('all worker processes exited')
+                    # A dead worker answers nothing, so it would have the fewest outstanding requests.
+                    worker = min(workers, key=lambda worker: worker.outstanding)
+                if not worker.exited and worker.process.is_alive():
+                    id = next(self._ids)
+                    self._pending[id] = (future, worker, decode)
+                    worker.outstanding += 1
+                    break
+            # The reader hasn't noticed yet, fail what was sent to the worker and pick another one.
+            self._check_workers()
+            if chosen is not None:
+                raise RuntimeError('worker process exited')
+        try:
+            worker.send([_REQUEST.pack(id, operation, session)] + parts)
+        except BaseException:
+            with self._lock:
+                if self._pending.pop(id, None) is not None:
+                    worker.outstanding -= 1
+            raise
+        return future
+
+    # Sends the request to every live worker, returns their results.
+    def _broadcast(self, operation, session, parts, decode=_decode_none):
+        self._check_workers()
+        workers = [worker for worker in self._workers if not worker.exited]
+        if not workers:
+            raise RuntimeError('all worker processes exited')
+        futures = [self._submit(operation, session, parts, decode, worker) for worker in workers]
+        self._wait(futures)
+        return [future.result() for future in futures]
+
+    def _wait(self, futures):
+        # Results of all requests are taken, so that none is left behind when one of them fails.
+        errors = [future.exception() for future in futures]
+        for error in errors:
+            if error is not None:
+                raise error
+
+    # Resolves futures with responses of all workers, runs on a thread of its own.
+    def _read(self):
+        index = 0
+        checked = time.monotonic()
+        while True:
+            ready = self._responses_ready.acquire(timeout=_POLL_INTERVAL)
+            # Other workers may keep answering while one of them is dead.
+            if time.monotonic() - checked >= _POLL_INTERVAL:
+                self._check_workers()
+                checked = time.monotonic()
+            if not ready:
+                continue
+            message = None
+            for i in range(len(self._workers)):
+                worker = self._workers[(index + i) % len(self._workers)]
+                if not worker.responses.empty():
+                    message = worker.responses.get()
+                    worker.responses_taken.release()
+                    index += i + 1
+                    break
+            if message is None:
+                # This response was taken along with an earlier one.
+                if self._stopped:
+                    return
+                continue
+            id, failed = _RESPONSE.unpack_from(message)
+            with self._lock:
+                pending = self._pending.pop(id, None)
+                if pending is None:
+                    # Answered just before the worker exited, the request has already failed.
+                    continue
+                future, worker, decode = pending
+                worker.outstanding -= 1
+            payload = memoryview(message)[_RESPONSE.size:]
+            if failed:
+                future.set_exception(RuntimeError(bytes(payload).decode()))
+                continue
+            try:
+                future.set_result(decode(payload))
+            except Exception as e:
+                future.set_exception(e)
+
+    def _check_workers(self):
+        with self._lock:
+            exited = [worker for worker in self._workers if not worker.exited and not worker.process.is_alive()]
+            for worker in exited:
+                worker.exited = True
+        if exited:
+            self._fail(lambda worker: worker in exited, 'worker process exited')
+
+    def _fail(self, predicate, message):
+        with self._lock:
+            failed = [id for id, (_, worker, _) in self._pending.items() if predicate(worker)]
+            failed = [self._pending.pop(id) for id in failed]
+            for _, worker, _ in failed:
+                worker.outstanding -= 1
+        for future, _, _ in failed:
+            future.set_exception(RuntimeError(message))
@@ -4,6 +4,9 @@
 # that can be found in the license/LICENSE.txt file.
 #
 
+import array
+import sys
+
 import kotlin_bridge
 
 session = kotlin_bridge.open_session(239, 'konan')
@@ -17,6 +20,15 @@ print("Concat '{}'".format(message))
 message = kotlin_bridge.add_server(session, 1, 60)
 print("Sum '{}'".format(message))
 
+if sys.version_info[0] >= 3:
+    # One call into Kotlin per batch, results are written to the preallocated output.
+    sums = array.array('i', [0]) * 5
+    kotlin_bridge.add_server_batch(session, range(5), array.array('i', [10, 20, 30, 40, 50]), sums)
+    print("Sums '{}'".format(list(sums)))
+
+    messages = kotlin_bridge.concat_server_batch(session, ["Coding", "Debugging"], ["fun", "fun too"])
+    print("Concats '{}'".format(messages))
+
 
 kotlin_bridge.close_session(session)
 
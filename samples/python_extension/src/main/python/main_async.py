@@ -0,0 +1,28 @@
+#!/usr/bin/python3
+#
+# Copyright 2010-2018 JetBrains s.r.o. Use of this source code is governed by the Apache 2.0 license
+# that can be found in the license/LICENSE.txt file.
+#
+
+import asyncio
+
+import kotlin_bridge
+
+
+async def main():
+    session = kotlin_bridge.open_session(239, 'konan')
+
+    message = await kotlin_bridge.greet_server_async(session)
+    print("Greet '{}'".format(message))
+
+    # All requests are in flight at once, served by Kotlin workers.
+    sums = await asyncio.gather(*[kotlin_bridge.add_server_async(session, i, i) for i in range(1000)])
+    print("Sums '{}'".format(sums[:5]))
+
+    message = await kotlin_bridge.concat_server_async(session, "Coding", "fun")
+    print("Concat '{}'".format(message))
+
+    kotlin_bridge.close_session(session)
+
+
+asyncio.run(main())
@@ -15,6 +15,10 @@ setup(name='kotlin_bridge',
       description = 'Kotlin/Native Python bridge',
       long_description = 'Using Kotlin/Native from Python example',
 
+      # Multi-process serving mode, Python 3.8+.
+      package_dir = {'': 'src/main/python'},
+      py_modules = ['kotlin_bridge_pool'],
+
       # data_files=[("/Library/Python/2.7/site-packages/", ['libserver.dylib'])],
 
       ext_modules=[
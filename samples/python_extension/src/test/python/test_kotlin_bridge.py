@@ -0,0 +1,122 @@
+#
+# Copyright 2010-2018 JetBrains s.r.o. Use of this source code is governed by the Apache 2.0 license
+# that can be found in the license/LICENSE.txt file.
+#
+
+# Tests of the kotlin_bridge extension and of kotlin_bridge_pool, run once the extension is built (see build.sh)
+#
+#    PYTHONPATH=src/main/python python3 -m unittest discover src/test/python
+
+import asyncio
+import threading
+import time
+import unittest
+
+import kotlin_bridge
+import kotlin_bridge_pool
+
+# Seconds a request may take before a test fails instead of hanging.
+TIMEOUT = 30
+
+
+@unittest.skipUnless(hasattr(kotlin_bridge, 'add_server_batch'), 'no batch entry points on this platform')
+class ConcurrentSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        kotlin_bridge.set_concurrent(True)
+        self.session = kotlin_bridge.open_session(239, 'konan')
+
+    def tearDown(self):
+        kotlin_bridge.set_concurrent(False)
+
+    def test_close_refused_while_in_use(self):
+        errors = []
+
+        # Arguments of a batch are read once the call is under way, like another thread would close the session.
+        def items():
+            try:
+                kotlin_bridge.close_session(self.session)
+            except RuntimeError as e:
+                errors.append(e)
+            yield 1
+
+        self.assertEqual(list(kotlin_bridge.add_server_batch(self.session, items(), [2])), [242])
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(kotlin_bridge.add_server(self.session, 1, 2), 242)
+        kotlin_bridge.close_session(self.session)
+
+
+@unittest.skipUnless(hasattr(kotlin_bridge, 'add_server_async'), 'no asyncio variants on this platform')
+class AsyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.session = kotlin_bridge.open_session(239, 'konan')
+
+    def tearDown(self):
+        kotlin_bridge.close_session(self.session)
+
+    async def add(self):
+        return await asyncio.wait_for(kotlin_bridge.add_server_async(self.session, 1, 2), TIMEOUT)
+
+    def test_loop_closed_with_request_in_flight(self):
+        async def leave():
+            kotlin_bridge.add_server_async(self.session, 1, 2)
+
+        asyncio.run(leave())
+        self.assertEqual(asyncio.run(self.add()), 242)
+        self.assertEqual(asyncio.run(self.add()), 242)
+
+    def test_loop_abandoned_with_request_in_flight(self):
+        abandoned = asyncio.new_event_loop()
+        try:
+            async def leave():
+                return kotlin_bridge.add_server_async(self.session, 1, 2)
+
+            future = abandoned.run_until_complete(leave())
+            self.assertEqual(asyncio.run(self.add()), 242)
+            # The request was cancelled through its own loop.
+            abandoned.run_until_complete(asyncio.sleep(0))
+            self.assertTrue(future.cancelled())
+        finally:
+            abandoned.close()
+
+
+class ServerPoolTest(unittest.TestCase):
+
+    def test_worker_killed_under_load(self):
+        with kotlin_bridge_pool.ServerPool(processes=2) as pool:
+            session = pool.open_session(239, 'konan')
+            futures = []
+            stop = threading.Event()
+
+            def load():
+                while not stop.is_set():
+                    futures.append(pool.submit('add_server', session, 1, 2))
+                    time.sleep(0.001)
+
+            loader = threading.Thread(target=load)
+            loader.start()
+            try:
+                time.sleep(0.2)
+                pool._workers[0].process.kill()
+                # Requests keep going to the live worker, the dead one must not be picked anymore.
+                time.sleep(3 * kotlin_bridge_pool._POLL_INTERVAL)
+            finally:
+                stop.set()
+                loader.join()
+            answered = failed = 0
+            for future in futures:
+                try:
+                    self.assertEqual(future.result(timeout=TIMEOUT), 242)
+                    answered += 1
+                except RuntimeError as e:
+                    self.assertIn('worker process exited', str(e))
+                    failed += 1
+            self.assertGreater(answered, 0)
+            self.assertTrue(pool._workers[0].exited)
+            self.assertEqual(pool.add_server(session, 1, 2), 242)
+            pool.close_session(session)
+
+
+if __name__ == '__main__':
+    unittest.main()